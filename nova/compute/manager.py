@@ -3149,6 +3149,12 @@ class ComputeManager(manager.SchedulerDependentManager):
             LOG.warn(_("Found %(num_db_instances)s in the database and "
                        "%(num_vm_instances)s on the hypervisor.") % locals())
 
+        try:
+            vm_infos = self.driver.get_info_bulk(
+                    [i for i in db_instances if i['task_state'] is None])
+        except NotImplementedError:
+            vm_infos = None
+
         for db_instance in db_instances:
             db_power_state = db_instance['power_state']
             if db_instance['task_state'] is not None:
@@ -3157,7 +3163,13 @@ class ComputeManager(manager.SchedulerDependentManager):
                 continue
             # No pending tasks. Now try to figure out the real vm_power_state.
             try:
-                vm_instance = self.driver.get_info(db_instance)
+                if vm_infos is None:
+                    vm_instance = self.driver.get_info(db_instance)
+                elif db_instance['uuid'] in vm_infos:
+                    vm_instance = vm_infos[db_instance['uuid']]
+                else:
+                    raise exception.InstanceNotFound(
+                            instance_id=db_instance['uuid'])
                 vm_power_state = vm_instance['state']
             except exception.InstanceNotFound:
                 vm_power_state = power_state.SHUTDOWN
@@ -3193,6 +3205,14 @@ class ComputeManager(manager.SchedulerDependentManager):
                 LOG.info(_("During sync_power_state the instance has a "
                            "pending task. Skip."), instance=db_instance)
                 continue
+            if vm_infos is not None and vm_power_state != db_power_state:
+                # The bulk info was fetched before the loop and may be
+                # stale by now, so the mismatch is confirmed with the
+                # current info before it is acted on.
+                try:
+                    vm_power_state = self.driver.get_info(db_instance)['state']
+                except exception.InstanceNotFound:
+                    vm_power_state = power_state.SHUTDOWN
             if vm_power_state != db_power_state:
                 # power_state is always updated from hypervisor to db
                 self._instance_update(context,
@@ -2616,6 +2616,59 @@ class ComputeTestCase(BaseTestCase):
         self.assertEqual(len(instances), 1)
         self.assertEqual(task_states.POWERING_OFF, instances[0]['task_state'])
 
+    def test_sync_power_states_uses_get_info_bulk(self):
+        self.stubs.Set(compute_manager.ComputeManager,
+                '_report_driver_status', nop_report_driver_status)
+
+        instance = jsonutils.to_primitive(self._create_fake_instance())
+        self.compute.run_instance(self.context, instance=instance)
+
+        def fake_get_info_bulk(instances):
+            self.assertEqual([i['uuid'] for i in instances],
+                             [instance['uuid']])
+            return {}
+
+        self.stubs.Set(self.compute.driver, 'get_info_bulk',
+                       fake_get_info_bulk)
+        # The mismatch is confirmed with the current info of the instance
+        self.mox.StubOutWithMock(self.compute.driver, 'get_info')
+        self.compute.driver.get_info(mox.IgnoreArg()).AndRaise(
+                exception.InstanceNotFound(instance_id=instance['uuid']))
+        self.mox.ReplayAll()
+
+        self.compute._sync_power_states(context.get_admin_context())
+
+        instances = db.instance_get_all(self.context)
+        self.assertEqual(len(instances), 1)
+        self.assertEqual(power_state.SHUTDOWN, instances[0]['power_state'])
+        self.assertEqual(task_states.POWERING_OFF, instances[0]['task_state'])
+
+    def test_sync_power_states_confirms_stale_get_info_bulk(self):
+        self.stubs.Set(compute_manager.ComputeManager,
+                '_report_driver_status', nop_report_driver_status)
+
+        instance = jsonutils.to_primitive(self._create_fake_instance())
+        self.compute.run_instance(self.context, instance=instance)
+
+        # The instance was started again since the bulk info was fetched
+        def fake_get_info_bulk(instances):
+            return {instance['uuid']: {'state': power_state.SHUTDOWN}}
+
+        self.stubs.Set(self.compute.driver, 'get_info_bulk',
+                       fake_get_info_bulk)
+        self.mox.StubOutWithMock(self.compute.driver, 'get_info')
+        self.compute.driver.get_info(mox.IgnoreArg()).AndReturn(
+                {'state': power_state.RUNNING})
+        self.mox.StubOutWithMock(self.compute.compute_api, 'stop')
+        self.mox.ReplayAll()
+
+        self.compute._sync_power_states(context.get_admin_context())
+
+        instances = db.instance_get_all(self.context)
+        self.assertEqual(len(instances), 1)
+        self.assertEqual(power_state.RUNNING, instances[0]['power_state'])
+        self.assertEqual(None, instances[0]['task_state'])
+
     def test_add_instance_fault(self):
         exc_info = None
         instance_uuid = str(uuid.uuid4())
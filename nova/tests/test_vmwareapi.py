@@ -20,16 +20,38 @@
 Test suite for VMwareAPI.
 """
 
+import errno
+import StringIO
+import struct
+
+import eventlet
+from eventlet import greenthread
+
 from nova.compute import power_state
 from nova import context
 from nova import db
 from nova import exception
+from nova.openstack.common import timeutils
 from nova import test
 import nova.tests.image.fake
 from nova.tests.vmwareapi import db_fakes
 from nova.tests.vmwareapi import stubs
+from nova.virt.vmwareapi import call_stats
+from nova.virt.vmwareapi import datastore
 from nova.virt.vmwareapi import driver
+from nova.virt.vmwareapi import error_util
 from nova.virt.vmwareapi import fake as vmwareapi_fake
+from nova.virt.vmwareapi import host
+from nova.virt.vmwareapi import inventory
+from nova.virt.vmwareapi import io_util
+from nova.virt.vmwareapi import network_util
+from nova.virt.vmwareapi import soap_util
+from nova.virt.vmwareapi import vif as vmwarevif
+from nova.virt.vmwareapi import vim
+from nova.virt.vmwareapi import vim_util
+from nova.virt.vmwareapi import vm_util
+from nova.virt.vmwareapi import vmdk_util
+from nova.virt.vmwareapi import vmware_images
 
 
 class VMwareAPIVMTestCase(test.TestCase):
@@ -78,10 +100,12 @@ class VMwareAPIVMTestCase(test.TestCase):
 
     def tearDown(self):
         super(VMwareAPIVMTestCase, self).tearDown()
+        if self.conn._inventory:
+            self.conn._inventory.stop()
         vmwareapi_fake.cleanup()
         nova.tests.image.fake.FakeImageService_reset()
 
-    def _create_instance_in_the_db(self):
+    def _create_instance_in_the_db(self, node=None):
         values = {'name': 1,
                   'id': 1,
                   'project_id': self.project_id,
@@ -91,6 +115,7 @@ class VMwareAPIVMTestCase(test.TestCase):
                   'ramdisk_id': "1",
                   'mac_address': "de:ad:be:ef:be:ef",
                   'instance_type': 'm1.large',
+                  'node': node,
                   }
         self.instance = db.instance_create(None, values)
 
@@ -159,6 +184,29 @@ class VMwareAPIVMTestCase(test.TestCase):
         info = self.conn.get_info({'name': 1})
         self._check_vm_info(info, power_state.RUNNING)
 
+    def test_spawn_existing_vm_not_cached(self):
+        self._create_vm()
+        # The cache is lost, as on a restart of the service
+        self.conn._vmops._vm_ref_cache.clear()
+        self.conn._vmops._vm_ref_cache.refreshed_at = None
+        vmwareapi_fake.reset_call_counts()
+        self.assertRaises(exception.InstanceExists, self._create_vm)
+        call_counts = vmwareapi_fake.get_call_counts()
+        self.assertFalse("CopyVirtualDisk_Task" in call_counts)
+        self.assertFalse("CreateVM_Task" in call_counts)
+
+    def test_spawn_vm_created_since_refresh(self):
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self._create_vm()
+        # The VM was created by someone else since the cache was refreshed
+        vm_ref_cache = self.conn._vmops._vm_ref_cache
+        vm_ref_cache.clear()
+        vm_ref_cache.refreshed_at = timeutils.utcnow_ts()
+        self.assertRaises(exception.InstanceExists, self._create_vm)
+        self.assertEquals(len(vmwareapi_fake._get_objects("VirtualMachine")),
+                          1)
+
     def test_snapshot(self):
         self._create_vm()
         info = self.conn.get_info({'name': 1})
@@ -247,6 +295,1127 @@ class VMwareAPIVMTestCase(test.TestCase):
         instances = self.conn.list_instances()
         self.assertEquals(len(instances), 0)
 
+    def test_destroy_reaps_folder_in_background(self):
+        self._create_vm()
+        reaper = self.conn._vmops._folder_reaper
+        folder = "[fake-ds] %s" % self.instance['name']
+        self.conn.destroy(self.instance, self.network_info)
+        self.assertTrue(folder in reaper._pending)
+        reaper.wait_for(folder)
+        self.assertEquals(reaper._pending, {})
+        self.assertEquals([path for path in vmwareapi_fake._db_content["files"]
+                           if path.startswith(folder)], [])
+
+    def test_spawn_waits_for_reaped_folder(self):
+        self._create_vm()
+        self.conn.destroy(self.instance, self.network_info)
+        # The folder of the instance is reused before the reaper ran
+        self._create_vm()
+        vmdk_path = "[fake-ds] %s/%s.vmdk" % (self.instance['name'],
+                                              self.instance['name'])
+        greenthread.sleep(0)
+        self.assertTrue(vmdk_path in vmwareapi_fake._db_content["files"])
+
+    def test_get_info_uses_vm_ref_cache(self):
+        self._create_vm()
+        self.mox.StubOutWithMock(vim_util, 'get_objects')
+        self.mox.ReplayAll()
+        info = self.conn.get_info({'name': 1})
+        self._check_vm_info(info, power_state.RUNNING)
+
+    def test_get_info_stale_vm_ref(self):
+        self._create_vm()
+        vm_ref = vmwareapi_fake._get_objects("VirtualMachine")[0].obj
+        self.conn._vmops._vm_ref_cache[1] = 'stale-vm-ref'
+        info = self.conn.get_info({'name': 1})
+        self._check_vm_info(info, power_state.RUNNING)
+        self.assertEquals(self.conn._vmops._vm_ref_cache[1], vm_ref)
+
+    def _count_vm_ref_cache_refreshes(self):
+        refreshes = []
+        refresh_vm_ref_cache = self.conn._vmops._refresh_vm_ref_cache
+
+        def fake_refresh_vm_ref_cache():
+            refreshes.append(True)
+            refresh_vm_ref_cache()
+
+        self.stubs.Set(self.conn._vmops, '_refresh_vm_ref_cache',
+                       fake_refresh_vm_ref_cache)
+        return refreshes
+
+    def test_vm_ref_cache_misses_are_cached(self):
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self._create_vm()
+        # The misses of the lookup made by the spawn are no longer fresh
+        timeutils.advance_time_seconds(60)
+        refreshes = self._count_vm_ref_cache_refreshes()
+        missing = [{'name': 'missing', 'uuid': 'missing-uuid'}]
+        for i in range(2):
+            self.assertEquals(self.conn.get_info_bulk(missing), {})
+            self.assertEquals(
+                    self.conn._vmops._get_vm_ref_from_the_name('missing'),
+                    None)
+        self.assertEquals(len(refreshes), 1)
+        timeutils.advance_time_seconds(60)
+        self.conn._vmops._get_vm_ref_from_the_name('missing')
+        self.assertEquals(len(refreshes), 2)
+
+    def test_refresh_vm_ref_cache_keeps_vms_created_meanwhile(self):
+        self._create_fake_vms(3)
+        vmops = self.conn._vmops
+        vmops._vm_ref_cache['gone'] = 'gone-vm-ref'
+        iter_objects = vmops._session._iter_objects
+
+        def fake_iter_objects(*args, **kwargs):
+            for obj in iter_objects(*args, **kwargs):
+                # A VM is created while the VMs are paged through
+                vmops._vm_ref_cache['new'] = 'new-vm-ref'
+                yield obj
+
+        self.stubs.Set(vmops._session, '_iter_objects', fake_iter_objects)
+        vmops._refresh_vm_ref_cache()
+        self.assertEquals(vmops._vm_ref_cache['new'], 'new-vm-ref')
+        self.assertFalse('gone' in vmops._vm_ref_cache)
+        self.assertEquals(len(vmops._vm_ref_cache), 4)
+
+    def _start_inventory_mirror(self):
+        self.flags(vmwareapi_use_inventory_mirror=True)
+        self.conn = driver.VMwareESXDriver(None, False)
+        self.conn.init_host(None)
+
+    def test_inventory_mirror_tracks_power_state(self):
+        self._start_inventory_mirror()
+        self._create_vm()
+        self.conn.suspend(self.instance)
+        self.mox.StubOutWithMock(vim_util, 'get_object_properties')
+        self.mox.StubOutWithMock(vim_util, 'get_objects')
+        self.mox.ReplayAll()
+        info = self.conn.get_info({'name': 1})
+        self._check_vm_info(info, power_state.PAUSED)
+        self.assertEquals(self.conn.list_instances(), [1])
+
+    def test_inventory_mirror_picks_up_external_changes(self):
+        self._start_inventory_mirror()
+        self._create_vm()
+        vm = vmwareapi_fake._get_objects("VirtualMachine")[0]
+        vm.set("runtime.powerState", "poweredOff")
+        self.conn._inventory.update()
+        info = self.conn.get_info({'name': 1})
+        self._check_vm_info(info, power_state.SHUTDOWN)
+        del vmwareapi_fake._db_content["VirtualMachine"][vm.obj]
+        self.conn._inventory.update()
+        self.assertEquals(self.conn.list_instances(), [])
+
+    def test_inventory_mirror_inactive_while_updates_fail(self):
+        self._start_inventory_mirror()
+        self._create_vm()
+        mirror = self.conn._inventory
+        self.assertTrue(mirror.is_active())
+        failing = [True]
+        wait_for_updates_ex = vim_util.wait_for_updates_ex
+
+        def fake_wait_for_updates_ex(*args, **kwargs):
+            if failing:
+                raise error_util.VimException("Update failed: ", None)
+            return wait_for_updates_ex(*args, **kwargs)
+
+        self.stubs.Set(vim_util, 'wait_for_updates_ex',
+                       fake_wait_for_updates_ex)
+        for i in range(inventory.MAX_UPDATE_FAILURES):
+            mirror._periodic_update()
+        self.assertFalse(mirror.is_active())
+        # The queries go to the host instead
+        info = self.conn.get_info({'name': 1})
+        self._check_vm_info(info, power_state.RUNNING)
+        del failing[:]
+        mirror.update()
+        self.assertTrue(mirror.is_active())
+
+    def test_inventory_mirror_inactive_when_stale(self):
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self._start_inventory_mirror()
+        self.assertTrue(self.conn._inventory.is_active())
+        timeutils.advance_time_seconds(60)
+        self.assertFalse(self.conn._inventory.is_active())
+
+    def test_get_info_bulk(self):
+        self._create_vm()
+        self.conn.suspend(self.instance)
+        infos = self.conn.get_info_bulk([{'name': 1, 'uuid': 'fake-uuid'},
+                                         {'name': 2, 'uuid': 'other-uuid'}])
+        self.assertEquals(infos.keys(), ['fake-uuid'])
+        self._check_vm_info(infos['fake-uuid'], power_state.PAUSED)
+
+    def test_get_info_bulk_paged(self):
+        self.flags(vmwareapi_maximum_objects=100)
+        vmwareapi_fake.create_vms(300)
+        instances = [{'name': "vm-%d" % i, 'uuid': "uuid-%d" % i}
+                     for i in range(300)]
+        vmwareapi_fake.reset_call_counts()
+        infos = self.conn.get_info_bulk(instances)
+        self.assertEquals(len(infos), 300)
+        # The VMs are gone through in pages, rather than one call per VM
+        call_counts = vmwareapi_fake.get_call_counts()
+        self.assertEquals(call_counts["RetrievePropertiesEx"], 1)
+        self.assertEquals(call_counts["ContinueRetrievePropertiesEx"], 2)
+        self.assertTrue(sum(call_counts.values()) <= 3 + 1)
+
+    def test_destroy_among_many_vms(self):
+        self.flags(vmwareapi_maximum_objects=100)
+        self._create_vm()
+        vmwareapi_fake.create_vms(300)
+        vmwareapi_fake.reset_call_counts()
+        self.conn.destroy(self.instance, self.network_info)
+        # The VM is found without going through all the VMs
+        call_counts = vmwareapi_fake.get_call_counts()
+        self.assertEquals(call_counts["UnregisterVM"], 1)
+        self.assertFalse("RetrievePropertiesEx" in call_counts)
+
+    def test_get_info_bulk_stale_vm_ref(self):
+        self._create_vm()
+        self.conn._vmops._vm_ref_cache[1] = 'stale-vm-ref'
+        infos = self.conn.get_info_bulk([{'name': 1, 'uuid': 'fake-uuid'}])
+        self._check_vm_info(infos['fake-uuid'], power_state.RUNNING)
+
+    def test_wait_for_tasks_with_one_poller(self):
+        self.flags(vmwareapi_task_poll_min_interval=0.01,
+                   vmwareapi_task_poll_interval=0.02)
+        session = self.conn._vmops._session
+        tasks = [vmwareapi_fake.create_task("CreateVM_Task"),
+                 vmwareapi_fake.create_task("PowerOnVM_Task")]
+        waiters = [greenthread.spawn(session._wait_for_task, 'fake-uuid',
+                                     task.obj) for task in tasks]
+        greenthread.sleep(0.05)
+        self.assertEquals(len(session._task_waiter._tasks), 2)
+        tasks[0].get("info").state = "success"
+        self.assertEquals(waiters[0].wait().name, "CreateVM_Task")
+        self.assertEquals(len(session._task_waiter._tasks), 1)
+        tasks[1].get("info").state = "error"
+        tasks[1].get("info").error = vmwareapi_fake.DataObject()
+        tasks[1].get("info").error.localizedMessage = "Power on failed"
+        self.assertRaises(exception.NovaException, waiters[1].wait)
+        self.assertFalse(session._task_waiter._polling)
+
+    def test_concurrent_calls_use_pooled_sessions(self):
+        self.flags(vmwareapi_api_session_pool_size=2)
+        session = driver.VMwareAPISession('test_url', 'test_username',
+                                          'test_pass', 1)
+        with session._pinned_vim() as first:
+            with session._pinned_vim() as nested:
+                self.assertTrue(nested is first)
+            busy = greenthread.spawn(self._pinned_session_id, session)
+            second_id = busy.wait()
+        self.assertNotEquals(first.session_id, second_id)
+        self.assertEquals(len(session._pooled_vims), 2)
+        self.assertEquals(len(session._idle_vims), 2)
+
+    def test_first_vim_checked_out_when_pinned(self):
+        self.flags(vmwareapi_api_session_pool_size=2)
+        session = driver.VMwareAPISession('test_url', 'test_username',
+                                          'test_pass', 1)
+        first_vim = session._pooled_vims[0]
+        with session._pinned_vim(first=True) as pooled_vim:
+            self.assertTrue(pooled_vim is first_vim)
+            # The calls of other greenthreads do not share it
+            busy = greenthread.spawn(self._pinned_session_id, session)
+            self.assertNotEquals(busy.wait(), first_vim.session_id)
+        # It is waited for while another greenthread uses it
+        pinned = []
+
+        def _pin_first():
+            with session._pinned_vim(first=True) as pooled_vim:
+                pinned.append(pooled_vim)
+
+        checked_out = session._checkout_vim()
+        self.assertTrue(checked_out is first_vim)
+        waiter = greenthread.spawn(_pin_first)
+        greenthread.sleep(0)
+        self.assertEquals(pinned, [])
+        session._checkin_vim(checked_out)
+        waiter.wait()
+        self.assertEquals(pinned, [first_vim])
+        self.assertEquals(session._in_flight, 0)
+        self.assertEquals(len(session._idle_vims), 2)
+
+    def test_waiting_calls_admitted_by_priority(self):
+        self.flags(vmwareapi_api_session_pool_size=1)
+        session = driver.VMwareAPISession('test_url', 'test_username',
+                                          'test_pass', 1)
+        admitted = []
+
+        def _call(priority):
+            pooled_vim = session._checkout_vim(priority)
+            admitted.append(priority)
+            session._checkin_vim(pooled_vim)
+
+        with session._pinned_vim():
+            calls = [greenthread.spawn(_call, priority) for priority in
+                     [driver.PRIORITY_BULK, driver.PRIORITY_NORMAL,
+                      driver.PRIORITY_READ]]
+            greenthread.sleep(0)
+            self.assertEquals(admitted, [])
+        for call in calls:
+            call.wait()
+        self.assertEquals(admitted, [driver.PRIORITY_READ,
+                                     driver.PRIORITY_NORMAL,
+                                     driver.PRIORITY_BULK])
+
+    def test_call_limit_backs_off_on_overload(self):
+        self._create_vm()
+        session = self.conn._vmops._session
+        self.stubs.Set(driver, "_get_retry_delay", lambda retry_count: 0)
+        vmwareapi_fake.simulate(overload_faults=1)
+        self.conn.get_info({'name': 1})
+        self.assertEquals(session._call_limit, 2)
+        # The limit grows back by one for every limit calls going through
+        for i in range(2 + 3):
+            self.conn.get_info({'name': 1})
+        self.assertEquals(session._call_limit, 4)
+
+    def test_heavy_tasks_limited(self):
+        self.flags(vmwareapi_max_concurrent_heavy_tasks=1)
+        session = driver.VMwareAPISession('test_url', 'test_username',
+                                          'test_pass', 1)
+        started = []
+
+        def _heavy_task():
+            with session._heavy_task():
+                started.append(True)
+
+        with session._heavy_task():
+            waiter = greenthread.spawn(_heavy_task)
+            greenthread.sleep(0)
+            self.assertEquals(started, [])
+        waiter.wait()
+        self.assertEquals(started, [True])
+
+    def _pinned_session_id(self, session):
+        with session._pinned_vim() as pooled_vim:
+            session._call_method(vim_util, "get_objects", "VirtualMachine")
+            return pooled_vim.session_id
+
+    def test_call_method_relogin_on_not_authenticated(self):
+        session = self.conn._vmops._session
+        old_session_id = session._session_id
+        vmwareapi_fake._db_content['session'].clear()
+        self.assertEquals(self.conn.list_instances(), [])
+        self.assertNotEquals(session._session_id, old_session_id)
+        self.assertTrue(session._session_id in
+                        vmwareapi_fake._db_content['session'])
+
+    def test_retry_delay_backoff(self):
+        for retry_count in range(1, 10):
+            delay = min(driver.TIME_BETWEEN_API_CALL_RETRIES *
+                        2 ** (retry_count - 1),
+                        driver.MAX_TIME_BETWEEN_API_CALL_RETRIES)
+            retry_delay = driver._get_retry_delay(retry_count)
+            self.assertTrue(delay / 2 <= retry_delay <= delay)
+
+    def test_wsdl_parsed_once(self):
+        parsed = []
+
+        class FakeClient(object):
+            def __init__(self, wsdl_url, **kwargs):
+                parsed.append(wsdl_url)
+                self.options = {}
+
+            def clone(self):
+                clone = FakeClient.__new__(FakeClient)
+                clone.options = dict(self.options)
+                return clone
+
+            def set_options(self, **kwargs):
+                self.options.update(kwargs)
+
+        self.stubs.Set(vim.suds.client, "Client", FakeClient)
+        self.stubs.Set(vim, "_client_templates", {})
+        clients = [vim._get_client("http://wsdl/vimService.wsdl",
+                                   "https://%s/sdk" % host)
+                   for host in ["host1", "host2", "host1"]]
+        self.assertEquals(parsed, ["http://wsdl/vimService.wsdl"])
+        self.assertEquals(clients[1].options["location"], "https://host2/sdk")
+        self.assertFalse(clients[0] is clients[2])
+
+    def test_recursive_traversal_spec_built_once(self):
+        client_factory = vmwareapi_fake.FakeFactory()
+        spec = vim_util.get_recursive_traversal_spec(client_factory)
+        self.assertEquals(spec.name, "visitFolders")
+        self.assertTrue(
+            vim_util.get_recursive_traversal_spec(client_factory) is spec)
+        self.assertFalse(vim_util.get_recursive_traversal_spec(
+                                vmwareapi_fake.FakeFactory()) is spec)
+
+    def test_scoped_traversal_spec(self):
+        client_factory = vmwareapi_fake.FakeFactory()
+        spec = vim_util.get_scoped_traversal_spec(client_factory,
+                                                  "VirtualMachine")
+        self.assertEquals([s.name for s in spec.selectSet],
+                          ["visitFolders", "dc_to_vmf"])
+        self.assertTrue(spec is vim_util.get_scoped_traversal_spec(
+                                        client_factory, "VirtualMachine"))
+        spec = vim_util.get_scoped_traversal_spec(client_factory,
+                                                  "ClusterComputeResource")
+        self.assertEquals([s.name for s in spec.selectSet],
+                          ["visitFolders", "dc_to_hf"])
+        spec = vim_util.get_scoped_traversal_spec(client_factory, "Folder")
+        self.assertEquals(len(spec.selectSet), 9)
+
+    def test_soap_fast_path_request(self):
+        client_factory = soap_util.SPEC_FACTORY
+        object_spec = vim_util.build_object_spec(client_factory,
+                vmwareapi_fake.ManagedObjectReference("group-d1", "Folder"),
+                [vim_util.build_scoped_traversal_spec(client_factory,
+                                                      "VirtualMachine")])
+        property_spec = vim_util.build_property_spec(client_factory,
+                                properties_to_collect=["name"])
+        property_filter_spec = vim_util.build_property_filter_spec(
+                client_factory, [property_spec], [object_spec])
+        options = client_factory.create('ns0:RetrieveOptions')
+        options.maxObjects = 100
+        collector = vmwareapi_fake.ManagedObjectReference(
+                "propertyCollector", "PropertyCollector")
+        envelope = soap_util.build_request("RetrievePropertiesEx", collector,
+                {"specSet": [property_filter_spec], "options": options})
+        self.assertTrue(
+            '<soapenv:Body><RetrievePropertiesEx xmlns="urn:vim25">'
+            '<_this type="PropertyCollector">propertyCollector</_this>'
+            '<specSet><propSet><type>VirtualMachine</type><all>false</all>'
+            '<pathSet>name</pathSet></propSet><objectSet>'
+            '<obj type="Folder">group-d1</obj><skip>false</skip>'
+            '<selectSet xsi:type="TraversalSpec"><name>visitFolders</name>'
+            '<type>Folder</type><path>childEntity</path><skip>false</skip>'
+            '<selectSet><name>visitFolders</name></selectSet>'
+            '<selectSet xsi:type="TraversalSpec"><name>dc_to_vmf</name>'
+            '<type>Datacenter</type><path>vmFolder</path><skip>false</skip>'
+            '<selectSet><name>visitFolders</name></selectSet></selectSet>'
+            '</selectSet></objectSet></specSet>'
+            '<options><maxObjects>100</maxObjects></options>'
+            '</RetrievePropertiesEx></soapenv:Body>' in envelope)
+        vm_ref = vmwareapi_fake.ManagedObjectReference("vm-1",
+                                                       "VirtualMachine")
+        self.assertTrue('<PowerOnVM_Task xmlns="urn:vim25">'
+                        '<_this type="VirtualMachine">vm-1</_this>'
+                        '</PowerOnVM_Task>' in
+                        soap_util.build_request("PowerOnVM_Task", vm_ref, {}))
+        # The other calls, and those given what the templates do not know,
+        # are left to suds
+        self.assertEquals(soap_util.build_request("CreateVM_Task", vm_ref,
+                                                  {}), None)
+        self.assertEquals(soap_util.build_request("PowerOnVM_Task", vm_ref,
+                                                  {"host": vm_ref}), None)
+        self.assertEquals(soap_util.build_request("PowerOnVM_Task",
+                                                  "vm-1", {}), None)
+
+    def _get_soap_reply(self, method_name, body):
+        return ('<?xml version="1.0" encoding="UTF-8"?><soapenv:Envelope '
+                'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+                'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+                'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+                '<soapenv:Body><%sResponse xmlns="urn:vim25">%s</%sResponse>'
+                '</soapenv:Body></soapenv:Envelope>' %
+                (method_name, body, method_name))
+
+    def _get_soap_method(self, name):
+        unmarshalled = []
+
+        class FakeBinding(object):
+            def get_reply(self, method, reply):
+                unmarshalled.append(reply)
+                return None, "unmarshalled by suds"
+
+        class FakeMethod(object):
+            def __init__(self):
+                self.name = name
+                self.binding = FakeBinding()
+                self.binding.output = self.binding
+
+        return FakeMethod(), unmarshalled
+
+    def test_soap_fast_path_parses_retrieve_result(self):
+        method, unmarshalled = self._get_soap_method("RetrievePropertiesEx")
+        result = soap_util.parse_response(method, self._get_soap_reply(
+            "RetrievePropertiesEx",
+            '<returnval><token>1</token>'
+            '<objects><obj type="VirtualMachine">vm-1</obj>'
+            '<propSet><name>name</name>'
+            '<val xsi:type="xsd:string">fake-vm</val></propSet>'
+            '<propSet><name>summary.config.numCpu</name>'
+            '<val xsi:type="xsd:int">2</val></propSet>'
+            '<propSet><name>summary.config.template</name>'
+            '<val xsi:type="xsd:boolean">false</val></propSet>'
+            '<propSet><name>summary.storage.committed</name>'
+            '<val xsi:type="xsd:long">1073741824</val></propSet>'
+            '<propSet><name>runtime.powerState</name>'
+            '<val xsi:type="VirtualMachinePowerState">poweredOn</val>'
+            '</propSet>'
+            '<propSet><name>runtime.host</name>'
+            '<val type="HostSystem" xsi:type="ManagedObjectReference">'
+            'host-1</val></propSet>'
+            '<propSet><name>datastore</name>'
+            '<val xsi:type="ArrayOfManagedObjectReference">'
+            '<ManagedObjectReference type="Datastore" '
+            'xsi:type="ManagedObjectReference">datastore-1'
+            '</ManagedObjectReference></val></propSet></objects>'
+            '<objects><obj type="VirtualMachine">vm-2</obj></objects>'
+            '</returnval>'))
+        self.assertEquals(unmarshalled, [])
+        self.assertEquals(result.token, "1")
+        self.assertEquals([(obj.obj._type, obj.obj.value)
+                           for obj in result.objects],
+                          [("VirtualMachine", "vm-1"),
+                           ("VirtualMachine", "vm-2")])
+        props = dict((prop.name, prop.val)
+                     for prop in result.objects[0].propSet)
+        self.assertEquals(props["name"], "fake-vm")
+        self.assertEquals(props["summary.config.numCpu"], 2)
+        self.assertEquals(props["summary.config.template"], False)
+        self.assertEquals(props["summary.storage.committed"], 1024 ** 3)
+        self.assertEquals(props["runtime.powerState"], "poweredOn")
+        self.assertEquals((props["runtime.host"]._type,
+                           props["runtime.host"].value),
+                          ("HostSystem", "host-1"))
+        self.assertEquals([(mo_ref._type, mo_ref.value) for mo_ref in
+                           props["datastore"].ManagedObjectReference],
+                          [("Datastore", "datastore-1")])
+        # An object without properties has no propSet, as with suds
+        self.assertFalse(hasattr(result.objects[1], "propSet"))
+        self.assertEquals(soap_util.parse_response(method,
+                self._get_soap_reply("RetrievePropertiesEx", "")), None)
+
+    def test_soap_fast_path_parses_task_info(self):
+        method, unmarshalled = self._get_soap_method("RetrieveProperties")
+        task_info = ('<returnval><obj type="Task">task-1</obj>'
+                     '<propSet><name>info</name><val xsi:type="TaskInfo">'
+                     '<key>task-1</key><task type="Task">task-1</task>'
+                     '<entity type="VirtualMachine">vm-1</entity>'
+                     '<state>%s</state><cancelled>false</cancelled>'
+                     '<cancelable>true</cancelable><progress>40</progress>'
+                     '%s</val></propSet></returnval>')
+        result = soap_util.parse_response(method, self._get_soap_reply(
+                "RetrieveProperties", task_info % ("running", "")))
+        self.assertEquals(unmarshalled, [])
+        info = result[0].propSet[0].val
+        self.assertEquals((info.state, info.progress, info.cancelable,
+                           info.task.value, info.entity._type),
+                          ("running", 40, True, "task-1", "VirtualMachine"))
+        self.assertEquals(info.error, None)
+        # The info of a failed task is unmarshalled by suds with its error
+        reply = self._get_soap_reply("RetrieveProperties", task_info %
+                ("error", '<error><localizedMessage>Failed'
+                          '</localizedMessage></error>'))
+        self.assertEquals(soap_util.parse_response(method, reply),
+                          "unmarshalled by suds")
+        self.assertEquals(unmarshalled, [reply])
+
+    def test_soap_fast_path_falls_back_to_suds(self):
+        method, unmarshalled = self._get_soap_method("RetrievePropertiesEx")
+        reply = self._get_soap_reply("RetrievePropertiesEx",
+            '<returnval><objects><obj type="VirtualMachine">vm-1</obj>'
+            '<missingSet><path>name</path><fault><fault '
+            'xsi:type="NoPermission"/></fault></missingSet></objects>'
+            '</returnval>')
+        self.assertEquals(soap_util.parse_response(method, reply),
+                          "unmarshalled by suds")
+        reply = self._get_soap_reply("RetrievePropertiesEx",
+            '<returnval><objects><obj type="VirtualMachine">vm-1</obj>'
+            '<propSet><name>config.hardware</name>'
+            '<val xsi:type="VirtualHardware"><numCPU>1</numCPU></val>'
+            '</propSet></objects></returnval>')
+        self.assertEquals(soap_util.parse_response(method, reply),
+                          "unmarshalled by suds")
+        self.assertEquals(len(unmarshalled), 2)
+
+    def test_vim_soap_fast_path(self):
+        requests = []
+
+        class FakeService(object):
+            def __getattr__(self, name):
+                def request(managed_object, **kwargs):
+                    requests.append(("suds", name))
+                return request
+
+        class FakeClient(object):
+            service = FakeService()
+
+        def fake_send(client, method_name, envelope):
+            requests.append(("fast", method_name))
+
+        self.flags(vmwareapi_wsdl_loc="http://wsdl/vimService.wsdl")
+        self.stubs.Set(vim, "_get_client",
+                       lambda wsdl_url, location: FakeClient())
+        self.stubs.Set(soap_util, "send", fake_send)
+        vm_ref = vmwareapi_fake.ManagedObjectReference("vm-1",
+                                                       "VirtualMachine")
+        session_vim = vim.Vim()
+        session_vim.PowerOnVM_Task(vm_ref)
+        session_vim.CreateSnapshot_Task(vm_ref, name="snapshot")
+        self.flags(vmwareapi_soap_fast_path=False)
+        vim.Vim().PowerOnVM_Task(vm_ref)
+        self.assertEquals(requests, [("suds", "RetrieveServiceContent"),
+                                     ("fast", "PowerOnVM_Task"),
+                                     ("suds", "CreateSnapshot_Task"),
+                                     ("suds", "RetrieveServiceContent"),
+                                     ("suds", "PowerOnVM_Task")])
+
+    def test_get_inner_objects(self):
+        session = self.conn._vmops._session
+        host_mor = session._call_method(vim_util, "get_objects",
+                                        "HostSystem")[0].obj
+        data_stores = session._call_method(vim_util, "get_inner_objects",
+                                           host_mor, "HostSystem",
+                                           "datastore", "Datastore",
+                                           ["summary.name"])
+        self.assertEquals([ds.propSet[0].val for ds in data_stores],
+                          ["fake-ds"])
+
+    def _get_datastore_selector(self):
+        gib = 1024 ** 3
+        vmwareapi_fake.create_datastore(name="ds-big", free=800 * gib)
+        vmwareapi_fake.create_datastore(name="ds-small", free=700 * gib)
+        return datastore.DatastoreSelector(self.conn._vmops._session), gib
+
+    def test_datastore_selector_most_free_space(self):
+        selector, gib = self._get_datastore_selector()
+        self.assertEquals(selector.select(200 * gib)[0], "ds-big")
+        self.assertEquals(selector.select(200 * gib)[0], "ds-small")
+        self.assertEquals(selector.select(200 * gib)[0], "ds-big")
+        self.assertRaises(exception.NovaException, selector.select,
+                          700 * gib)
+
+    def test_datastore_selector_regex(self):
+        self.flags(vmwareapi_datastore_regex="ds-s.*")
+        selector, gib = self._get_datastore_selector()
+        self.assertEquals(selector.select(gib)[0], "ds-small")
+
+    def test_datastore_selector_refresh_interval(self):
+        self.flags(vmwareapi_datastore_refresh_interval=60)
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        selector, gib = self._get_datastore_selector()
+        self.assertEquals(selector.select(200 * gib)[0], "ds-big")
+        timeutils.advance_time_seconds(30)
+        self.assertEquals(selector.select()[0], "ds-small")
+        timeutils.advance_time_seconds(30)
+        self.assertEquals(selector.select()[0], "ds-big")
+
+    def _get_fake_image_service(self, chunks):
+
+        class FakeImageService(object):
+            def download(self, context, image_id, data):
+                for chunk in chunks:
+                    data.write(chunk)
+
+        return FakeImageService()
+
+    def test_fetch_image_streams_to_datastore(self):
+        chunks = ["%05d" % i for i in range(100)]
+        write_file = stubs.FakeWriteFile()
+        vmware_images.start_transfer(self.context, None, 500,
+                write_file_handle=write_file,
+                image_service=self._get_fake_image_service(chunks),
+                image_id="fake-image")
+        self.assertEquals("".join(write_file.written), "".join(chunks))
+
+    def test_io_thread_does_not_sleep(self):
+        sleeps = []
+        sleep = greenthread.sleep
+
+        def fake_sleep(seconds=0):
+            sleeps.append(seconds)
+            sleep(seconds)
+
+        self.stubs.Set(greenthread, "sleep", fake_sleep)
+        write_file = stubs.FakeWriteFile()
+        vmware_images.start_transfer(self.context, None, 500,
+                write_file_handle=write_file,
+                image_service=self._get_fake_image_service(["x" * 5] * 100),
+                image_id="fake-image")
+        self.assertEquals(len(write_file.written), 100)
+        self.assertEquals(sleeps, [])
+
+    def test_transfer_progress_and_stats(self):
+        self.stubs.Set(io_util, "PROGRESS_INTERVAL", 0)
+        progress = []
+        stats = []
+
+        self.stubs.Set(vmware_images, "_log_transfer_stats", stats.append)
+        vmware_images.start_transfer(self.context, None, 500,
+                write_file_handle=stubs.FakeWriteFile(),
+                image_service=self._get_fake_image_service(["x" * 5] * 100),
+                image_id="fake-image",
+                progress_callback=lambda *args: progress.append(args))
+        self.assertEquals(len(progress), 100)
+        self.assertEquals(progress[-1], (500, 500))
+        self.assertEquals(stats[0]["transferred"], 500)
+        self.assertTrue(stats[0]["occupancy"] <= stats[0]["maxsize"])
+
+    def test_fetch_image_write_failure(self):
+        closed = []
+
+        class FailingWriteFile(object):
+            def write(self, data):
+                raise IOError("Connection reset")
+
+            def close(self):
+                closed.append(True)
+
+        # The download is blocked on the full pipe once the write failed, so
+        # the transfer must not wait for it.
+        with eventlet.Timeout(5):
+            self.assertRaises(exception.NovaException,
+                    vmware_images.start_transfer, self.context, None, 500,
+                    write_file_handle=FailingWriteFile(),
+                    image_service=self._get_fake_image_service(
+                            ["x" * 5] * 100),
+                    image_id="fake-image")
+        self.assertEquals(closed, [True])
+
+    def test_upload_image_update_failure(self):
+        closed = []
+
+        class FakeReadFile(object):
+            def read(self, chunk_size):
+                return "x" * 5
+
+            def close(self):
+                closed.append(True)
+
+        class FailingImageService(object):
+            def update(self, context, image_id, image_meta, data=None):
+                data.read(5)
+                raise IOError("Connection reset")
+
+        with eventlet.Timeout(5):
+            self.assertRaises(exception.NovaException,
+                    vmware_images.start_transfer, self.context,
+                    FakeReadFile(), 500,
+                    image_service=FailingImageService(),
+                    image_id="fake-image")
+        self.assertEquals(closed, [True])
+
+    def _get_fake_open_range(self, data, failures):
+
+        class FakeRangeFile(object):
+            def __init__(self, offset, length):
+                self.data = data[offset:offset + length]
+
+            def read(self, chunk_size):
+                chunk, self.data = self.data[:64], self.data[64:]
+                return chunk
+
+            def close(self):
+                pass
+
+        def fake_open_range(offset, length):
+            if failures.get(offset, 0) > 0:
+                failures[offset] -= 1
+                raise IOError("Connection reset")
+            return FakeRangeFile(offset, length)
+
+        return fake_open_range
+
+    def test_range_read_retries_failed_ranges(self):
+        data = "".join(chr(i % 256) for i in range(1000))
+        output = stubs.FakeWriteFile()
+        open_range = self._get_fake_open_range(data, {300: 2})
+        read_thread = io_util.RangeReadThread(open_range, output,
+                                              len(data), 100, 3)
+        read_thread.start()
+        self.assertTrue(read_thread.wait())
+        self.assertEquals("".join(output.written), data)
+
+    def test_range_reads_written_in_order(self):
+        data = "".join(chr(i % 256) for i in range(1000))
+        opened = []
+        reading = []
+        max_reading = []
+        output = stubs.FakeWriteFile()
+
+        class FakeRangeFile(object):
+            def __init__(self, offset, length):
+                self.data = data[offset:offset + length]
+                # The later ranges are read faster
+                self.delay = (1000 - offset) / 100000.0
+
+            def read(self, chunk_size):
+                greenthread.sleep(self.delay)
+                chunk, self.data = self.data[:64], self.data[64:]
+                return chunk
+
+            def close(self):
+                reading.pop()
+
+        def fake_open_range(offset, length):
+            opened.append((offset, length))
+            reading.append(offset)
+            max_reading.append(len(reading))
+            return FakeRangeFile(offset, length)
+
+        read_thread = io_util.RangeReadThread(fake_open_range, output,
+                                              len(data), 300, 3)
+        read_thread.start()
+        self.assertTrue(read_thread.wait())
+        self.assertEquals(opened, [(0, 300), (300, 300), (600, 300),
+                                   (900, 100)])
+        self.assertEquals(max(max_reading), 3)
+        self.assertEquals("".join(output.written), data)
+
+    def test_range_read_failure(self):
+        data = "x" * 1000
+        open_range = self._get_fake_open_range(data,
+                {300: io_util.RANGE_RETRY_COUNT})
+        read_thread = io_util.RangeReadThread(open_range,
+                io_util.ThreadSafePipe(10, len(data)), len(data), 100, 3)
+        read_thread.start()
+        self.assertRaises(IOError, read_thread.wait)
+
+    def _get_flat_disk(self):
+        """Gets the data of a disk of more grains than a grain table holds,
+        most of them zero."""
+        grain = vmdk_util.GRAIN_SIZE * vmdk_util.SECTOR_SIZE
+        flat = ["\0" * grain] * (vmdk_util.NUM_GTES_PER_GT + 8)
+        flat[1] = "".join(chr(i % 251) for i in range(grain))
+        flat[vmdk_util.NUM_GTES_PER_GT + 3] = "x" * grain
+        return "".join(flat) + "y" * 1024
+
+    def _decode_stream_optimized(self, data, flat_size):
+        output = stubs.FakeWriteFile()
+        write_file = vmdk_util.StreamOptimizedWriteFile(output, flat_size)
+        for offset in range(0, len(data), 1000):
+            write_file.write(data[offset:offset + 1000])
+        self.assertTrue(write_file.done)
+        return "".join(output.written)
+
+    def test_stream_optimized_round_trip(self):
+        flat = self._get_flat_disk()
+        read_file = vmdk_util.StreamOptimizedReadFile(StringIO.StringIO(flat),
+                                                      len(flat), "lsiLogic")
+        chunks = []
+        while True:
+            chunk = read_file.read(None)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        data = "".join(chunks)
+        self.assertTrue('createType="streamOptimized"' in data[:2048])
+        self.assertTrue(len(data) < len(flat) / 100)
+        self.assertEquals(self._decode_stream_optimized(data, len(flat)),
+                          flat)
+
+    def test_stream_optimized_grain_aligned(self):
+        # A disk of an odd number of sectors, not a whole grain
+        flat = "z" * (3 * vmdk_util.SECTOR_SIZE)
+        read_file = vmdk_util.StreamOptimizedReadFile(StringIO.StringIO(flat),
+                                                      len(flat), "lsiLogic")
+        header = struct.unpack(vmdk_util.HEADER_FORMAT, read_file.read(None))
+        capacity, grain_size = header[3], header[4]
+        over_head = header[10]
+        self.assertEquals((capacity, grain_size),
+                          (vmdk_util.GRAIN_SIZE, vmdk_util.GRAIN_SIZE))
+        self.assertEquals(over_head % vmdk_util.GRAIN_SIZE, 0)
+        descriptor = read_file.read(None)
+        self.assertEquals(len(descriptor),
+                          (over_head - 1) * vmdk_util.SECTOR_SIZE)
+        self.assertTrue('RW %d SPARSE' % capacity in descriptor)
+        # The first grain starts right after the overhead
+        self.assertEquals(read_file._sector, over_head)
+        lba, size = struct.unpack(vmdk_util.GRAIN_MARKER_FORMAT,
+                read_file.read(None)[:vmdk_util.GRAIN_MARKER_SIZE])
+        self.assertEquals(lba, 0)
+
+    def test_upload_stream_optimized_unknown_size(self):
+        flat = self._get_flat_disk()
+        uploaded = []
+        tell_errors = []
+
+        class FakeImageService(object):
+            def update(self, context, image_id, image_meta, data):
+                try:
+                    data.tell()
+                except IOError, exc:
+                    tell_errors.append(exc.errno)
+                while True:
+                    chunk = data.read(None)
+                    if not chunk:
+                        break
+                    uploaded.append(chunk)
+
+            def show(self, context, image_id):
+                return {"status": "active"}
+
+        read_file = vmdk_util.StreamOptimizedReadFile(StringIO.StringIO(flat),
+                                                      len(flat), "lsiLogic")
+        vmware_images.start_transfer(self.context, read_file, None,
+                image_service=FakeImageService(), image_id="fake-image")
+        self.assertEquals(tell_errors, [errno.ESPIPE])
+        self.assertEquals(self._decode_stream_optimized("".join(uploaded),
+                                                        len(flat)),
+                          flat)
+
+    def _create_fake_vms(self, count):
+        ds = vmwareapi_fake._get_objects("Datastore")[0]
+        for i in range(count):
+            vmwareapi_fake._create_object("VirtualMachine",
+                    vmwareapi_fake.VirtualMachine(name="vm%d" % i, ds=ds))
+
+    def test_list_instances_paged(self):
+        self.flags(vmwareapi_maximum_objects=2)
+        self._create_fake_vms(5)
+        self.assertEquals(sorted(self.conn.list_instances()),
+                          ["vm%d" % i for i in range(5)])
+        session = self.conn._vmops._session
+        self.assertEquals(len(session._call_method(vim_util, "get_objects",
+                                                   "VirtualMachine")), 5)
+
+    def test_iter_objects_cancels_unfinished_retrieval(self):
+        self.flags(vmwareapi_maximum_objects=2)
+        self._create_fake_vms(5)
+        session = self.conn._vmops._session
+        objects = session._iter_objects("VirtualMachine")
+        objects.next()
+        self.assertEquals(len(session._pooled_vims[0].vim._retrievals), 1)
+        objects.close()
+        self.assertEquals(session._pooled_vims[0].vim._retrievals, {})
+        self.assertEquals(session._pinned_vims, {})
+
+    def test_spawn_uses_cached_image(self):
+        fetched = []
+
+        def fake_fetch_image(context, image, instance, **kwargs):
+            fetched.append(image)
+            vmwareapi_fake.fake_fetch_image(context, image, instance,
+                                            **kwargs)
+
+        self.stubs.Set(vmware_images, 'fetch_image', fake_fetch_image)
+        self._create_vm()
+        self.assertTrue("[fake-ds] vmware_base/1/1.vmdk" in
+                        vmwareapi_fake._db_content["files"])
+        self.conn.destroy(self.instance, self.network_info)
+        self._create_vm()
+        self.assertEquals(fetched, ["1"])
+
+    def test_spawn_finds_image_cached_before_restart(self):
+        fetched = []
+
+        def fake_fetch_image(context, image, instance, **kwargs):
+            fetched.append(image)
+            vmwareapi_fake.fake_fetch_image(context, image, instance,
+                                            **kwargs)
+
+        self.stubs.Set(vmware_images, 'fetch_image', fake_fetch_image)
+        self._create_vm()
+        self.conn.destroy(self.instance, self.network_info)
+        self.conn._vmops._image_cache._cached_images.clear()
+        self._create_vm()
+        self.assertEquals(fetched, ["1"])
+
+    def _get_image_cache_files(self):
+        return [file for file in vmwareapi_fake._db_content["files"]
+                if file.startswith("[fake-ds] vmware_base/1/")]
+
+    def test_spawn_image_cached_meanwhile(self):
+        self._create_vm()
+        self.conn.destroy(self.instance, self.network_info)
+        image_cache = self.conn._vmops._image_cache
+        image_cache._cached_images.clear()
+        # Another host caches the image between the search and the move
+        self.stubs.Set(image_cache, '_is_image_cached',
+                       lambda ds_name, image_id: False)
+        self._create_vm()
+        self.assertEquals(sorted(self._get_image_cache_files()),
+                          ["[fake-ds] vmware_base/1/1-flat.vmdk",
+                           "[fake-ds] vmware_base/1/1.vmdk"])
+
+    def test_spawn_image_download_failure(self):
+
+        def fake_fetch_image(context, image, instance, **kwargs):
+            vmwareapi_fake.fake_fetch_image(context, image, instance,
+                                            **kwargs)
+            raise exception.NovaException("Connection reset")
+
+        self.stubs.Set(vmware_images, 'fetch_image', fake_fetch_image)
+        self.assertRaises(exception.NovaException, self._create_vm)
+        self.assertEquals(self._get_image_cache_files(), [])
+
+    def test_spawn_creates_vm_with_disk(self):
+        called_methods = stubs.record_called_methods(self.stubs)
+        self._create_vm()
+        for method in ["CreateVirtualDisk_Task", "DeleteDatastoreFile_Task",
+                       "ReconfigVM_Task"]:
+            self.assertFalse(method in called_methods)
+        self.assertEquals(self._get_vm_disk_backing().fileName,
+                          "[fake-ds] 1/1.vmdk")
+        vm = vmwareapi_fake._get_objects("VirtualMachine")[0]
+        self.assertEquals(vm.get("config.files.vmPathName"),
+                          "[fake-ds] 1/1.vmx")
+
+    def test_network_cache(self):
+        called_methods = stubs.record_called_methods(self.stubs)
+        session = self.conn._vmops._session
+        cache = network_util.HostNetworkCache(session)
+        network = {'vlan': 0, 'bridge': 'vmnet0'}
+        vmwarevif.ensure_vlan_bridge(session, network, cache)
+        self.assertEquals(called_methods,
+                          ["get_objects",
+                           "get_properties_for_a_collection_of_objects"])
+        self.assertEquals(cache._networks,
+                          {'vmnet0': {'type': 'Network', 'name': 'vmnet0'}})
+        del called_methods[:]
+        vmwarevif.ensure_vlan_bridge(session, network, cache)
+        self.assertEquals(called_methods, [])
+
+        cache.create_port_group("br100", "vSwitch0", 100)
+        self.assertTrue("AddPortGroup" in called_methods)
+        del called_methods[:]
+        self.assertEquals(cache.get_vlanid_and_vswitch_for_portgroup("br100"),
+                          (100, "vSwitch0"))
+        self.assertEquals(called_methods, [])
+
+    def test_vmdk_descriptor(self):
+        descriptor = vm_util.get_vmdk_descriptor(1024 * 1024, "lsiLogic",
+                                                 "disk-flat.vmdk")
+        self.assertTrue('RW 2097152 VMFS "disk-flat.vmdk"' in descriptor)
+        self.assertTrue('ddb.adapterType = "lsilogic"' in descriptor)
+        self.assertTrue('ddb.geometry.cylinders = "130"' in descriptor)
+        self.assertTrue('ddb.geometry.heads = "255"' in descriptor)
+
+    def _get_vm_disk_backing(self):
+        vm = vmwareapi_fake._get_objects("VirtualMachine")[0]
+        return vm.get("config.hardware.device")[0].backing
+
+    def test_spawn_linked_clone(self):
+        self.flags(vmwareapi_use_linked_clone=True)
+        self._create_vm()
+        backing = self._get_vm_disk_backing()
+        self.assertEquals(backing.fileName, "[fake-ds] 1/1.vmdk")
+        self.assertEquals(backing.parent.fileName,
+                          "[fake-ds] vmware_base/1/1.vmdk")
+        self.assertTrue("[fake-ds] 1/1-delta.vmdk" in
+                        vmwareapi_fake._db_content["files"])
+        self.assertFalse("[fake-ds] 1/1-flat.vmdk" in
+                         vmwareapi_fake._db_content["files"])
+
+    def test_spawn_linked_clone_image_property(self):
+        self.flags(vmwareapi_use_linked_clone=True)
+
+        def fake_get_vmdk_size_and_properties(context, image_id, instance):
+            size, props = vmwareapi_fake.fake_get_vmdk_size_and_properties(
+                    context, image_id, instance)
+            props["vmware_linked_clone"] = "false"
+            return size, props
+
+        self.stubs.Set(vmware_images, 'get_vmdk_size_and_properties',
+                       fake_get_vmdk_size_and_properties)
+        self._create_vm()
+        backing = self._get_vm_disk_backing()
+        self.assertEquals(backing.fileName, "[fake-ds] 1/1.vmdk")
+        self.assertFalse(hasattr(backing, "parent"))
+        self.assertTrue("[fake-ds] 1/1-flat.vmdk" in
+                        vmwareapi_fake._db_content["files"])
+
+    def test_manage_image_cache(self):
+        self.flags(
+            vmwareapi_remove_unused_cached_images_minimum_age_seconds=60)
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self._create_vm()
+        cached_vmdk_path = "[fake-ds] vmware_base/1/1.vmdk"
+        self.conn.manage_image_cache(self.context, [self.instance])
+        timeutils.advance_time_seconds(120)
+        self.conn.manage_image_cache(self.context, [self.instance])
+        self.assertTrue(cached_vmdk_path in
+                        vmwareapi_fake._db_content["files"])
+        self.conn.manage_image_cache(self.context, [])
+        timeutils.advance_time_seconds(30)
+        self.conn.manage_image_cache(self.context, [])
+        self.assertTrue(cached_vmdk_path in
+                        vmwareapi_fake._db_content["files"])
+        timeutils.advance_time_seconds(30)
+        self.conn.manage_image_cache(self.context, [])
+        self.assertFalse(cached_vmdk_path in
+                         vmwareapi_fake._db_content["files"])
+
+    def test_manage_image_cache_sweeps_orphaned_folders(self):
+        self.flags(instance_name_template='vm-%d')
+        vm_refs = vmwareapi_fake.create_vms(2)
+        # The folder of vm-0 was queued for deletion when the service
+        # stopped
+        del vmwareapi_fake._db_content["VirtualMachine"][vm_refs[0]]
+        files = vmwareapi_fake._db_content["files"]
+        files.extend(["[fake-ds] vm-5/vm-5.vmdk", "[fake-ds] vm-6/vm-6.log",
+                      "[fake-ds] other/other.vmdk"])
+        instances = [{'name': 'vm-5', 'image_ref': '1'}]
+        self.conn.manage_image_cache(self.context, instances)
+        greenthread.sleep(0)
+        self.assertTrue("[fake-ds] vm-0/vm-0.vmdk" in files)
+        # The folder is deleted once found orphaned by a second sweep
+        self.conn.manage_image_cache(self.context, instances)
+        self.conn._vmops._folder_reaper.wait_for("[fake-ds] vm-0")
+        self.assertFalse("[fake-ds] vm-0/vm-0.vmdk" in files)
+        for path in ["[fake-ds] vm-1/vm-1.vmdk", "[fake-ds] vm-5/vm-5.vmdk",
+                     "[fake-ds] vm-6/vm-6.log", "[fake-ds] other/other.vmdk"]:
+            self.assertTrue(path in files)
+
+    def _age_cached_image(self):
+        """Finds the cached image of the instance unused, and ages it past
+        the minimum age."""
+        self.flags(
+            vmwareapi_remove_unused_cached_images_minimum_age_seconds=60)
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        self.conn.manage_image_cache(self.context, [])
+        timeutils.advance_time_seconds(60)
+
+    def test_manage_image_cache_keeps_image_of_vm_disk(self):
+        self._create_vm()
+        # The disk of a VM of another host sharing the datastore sits in the
+        # cache folder
+        self._get_vm_disk_backing().fileName = (
+                "[fake-ds] vmware_base/1/1.vmdk")
+        self._age_cached_image()
+        self.conn.manage_image_cache(self.context, [])
+        self.assertTrue("[fake-ds] vmware_base/1/1.vmdk" in
+                        vmwareapi_fake._db_content["files"])
+
+    def test_manage_image_cache_keeps_parent_of_linked_clone(self):
+        self.flags(vmwareapi_use_linked_clone=True)
+        self._create_vm()
+        # The linked clone is not an instance of this host
+        self._age_cached_image()
+        self.conn.manage_image_cache(self.context, [])
+        self.assertTrue("[fake-ds] vmware_base/1/1.vmdk" in
+                        vmwareapi_fake._db_content["files"])
+
+    def test_manage_image_cache_keeps_parent_of_snapshot_chain(self):
+        self.flags(vmwareapi_use_linked_clone=True)
+        self._create_vm()
+        # A snapshot of the linked clone adds a delta disk whose parent is
+        # the delta disk of the clone
+        disk = vmwareapi_fake._get_objects("VirtualMachine")[0].get(
+                "config.hardware.device")[0]
+        snapshot_backing = vmwareapi_fake.VirtualDiskFlatVer2BackingInfo()
+        snapshot_backing.fileName = "[fake-ds] 1/1-000001.vmdk"
+        snapshot_backing.parent = disk.backing
+        disk.backing = snapshot_backing
+        self._age_cached_image()
+        self.conn.manage_image_cache(self.context, [])
+        self.assertTrue("[fake-ds] vmware_base/1/1.vmdk" in
+                        vmwareapi_fake._db_content["files"])
+
+    def test_manage_image_cache_checks_usage_before_removal(self):
+        self._create_vm()
+        self._age_cached_image()
+        image_cache = self.conn._vmops._image_cache
+        images_in_use = [set(), set([("fake-ds", "1")])]
+        self.stubs.Set(image_cache, '_get_images_in_use',
+                       lambda: images_in_use.pop(0))
+        self.conn.manage_image_cache(self.context, [])
+        self.assertEquals(images_in_use, [])
+        self.assertTrue("[fake-ds] vmware_base/1/1.vmdk" in
+                        vmwareapi_fake._db_content["files"])
+
     def test_destroy_non_existent(self):
         self._create_instance_in_the_db()
         self.assertEquals(self.conn.destroy(self.instance, self.network_info),
@@ -263,3 +1432,175 @@ class VMwareAPIVMTestCase(test.TestCase):
 
     def test_get_console_output(self):
         pass
+
+    def test_get_available_resource(self):
+        self.assertEquals(self.conn.get_available_nodes(), ["ha-host"])
+        called_methods = stubs.record_called_methods(self.stubs)
+        # The node is named from the stats fetched already
+        self.assertEquals(self.conn.get_available_nodes(), ["ha-host"])
+        self.assertEquals(called_methods, [])
+        resources = self.conn.get_available_resource("ha-host")
+        # The stats are fetched afresh with one retrieval of the hosts
+        self.assertEquals(called_methods, ["get_objects"])
+        self.assertEquals(resources["vcpus"], 16)
+        self.assertEquals(resources["memory_mb"], 64 * 1024)
+        self.assertEquals(resources["memory_mb_used"], 4096)
+        self.assertEquals(resources["local_gb"], 1024)
+        self.assertEquals(resources["local_gb_used"], 1024 - 500)
+        self.assertEquals(resources["hypervisor_version"], 5000000)
+        self.assertEquals(resources["hypervisor_hostname"], "ha-host")
+
+    def _set_host_connection_state(self, state):
+        host_system = vmwareapi_fake._get_objects("HostSystem")[0]
+        host_system.set("summary.runtime.connectionState", state)
+
+    def test_get_available_resource_no_connected_host(self):
+        self._set_host_connection_state("disconnected")
+        self.conn = driver.VMwareESXDriver(None, False)
+        self.assertEquals(self.conn.get_available_nodes(), ["ha-host"])
+        resources = self.conn.get_available_resource("ha-host")
+        self.assertEquals(resources["vcpus"], 0)
+        self.assertEquals(resources["memory_mb"], 0)
+        self.assertEquals(resources["hypervisor_hostname"], "ha-host")
+
+    def test_get_available_resource_host_disconnected(self):
+        self.conn.get_available_resource("ha-host")
+        self._set_host_connection_state("disconnected")
+        # The last stats fetched are kept
+        resources = self.conn.get_available_resource("ha-host")
+        self.assertEquals(resources["vcpus"], 16)
+        self.assertEquals(resources["hypervisor_hostname"], "ha-host")
+
+    def _create_vc_driver(self):
+        self.clusters = dict((name, vmwareapi_fake.create_cluster(name))
+                             for name in ["cluster1", "cluster2"])
+        self.flags(vmwareapi_cluster_name=["cluster1", "cluster2"])
+        return driver.VMwareVCDriver(None, False)
+
+    def test_vc_driver_nodes(self):
+        vc_conn = self._create_vc_driver()
+        self.mox.StubOutWithMock(host.HostState, 'update_status')
+        self.mox.ReplayAll()
+        # The nodes are named without the stats of the clusters
+        self.assertEquals(vc_conn.get_available_nodes(),
+                          ["cluster1", "cluster2"])
+        self.mox.UnsetStubs()
+        resources = vc_conn.get_available_resource("cluster2")
+        self.assertEquals(resources["hypervisor_hostname"], "cluster2")
+        self.assertEquals(resources["vcpus"], 16)
+        # Just the datastore of the cluster
+        self.assertEquals(resources["local_gb"], 1024)
+        self.assertRaises(exception.NovaException,
+                          vc_conn.get_available_resource, "ha-host")
+
+    def test_vc_driver_spawn_in_cluster(self):
+        vc_conn = self._create_vc_driver()
+        self._create_instance_in_the_db(node="cluster2")
+        vc_conn.spawn(self.context, self.instance, self.image,
+                      injected_files=[], admin_password=None,
+                      network_info=self.network_info,
+                      block_device_info=None)
+        vm = vmwareapi_fake._get_objects("VirtualMachine")[0]
+        self.assertEquals(vm.get("resourcePool"),
+                          self.clusters["cluster2"].get("resourcePool"))
+        self.assertEquals(vm.get("config.files.vmPathName"),
+                          "[cluster2-ds] 1/1.vmx")
+
+    def _spawn_in_cluster(self, vc_conn, node):
+        self._create_instance_in_the_db(node=node)
+        self.type_data = db.instance_type_get_by_name(None, 'm1.large')
+        vc_conn.spawn(self.context, self.instance, self.image,
+                      injected_files=[], admin_password=None,
+                      network_info=self.network_info,
+                      block_device_info=None)
+
+    def test_vc_driver_list_instances_of_clusters(self):
+        vc_conn = self._create_vc_driver()
+        self._create_fake_vms(2)
+        self._spawn_in_cluster(vc_conn, "cluster2")
+        self.assertEquals(vc_conn.list_instances(), [1])
+
+    def test_vc_driver_shares_vm_ref_cache(self):
+        vc_conn = self._create_vc_driver()
+        # A lookup miss makes the misses trusted for a while
+        self.assertEquals(vc_conn.get_info_bulk(
+                [{'name': 'missing', 'uuid': 'missing-uuid'}]), {})
+        self._spawn_in_cluster(vc_conn, "cluster2")
+        info = vc_conn.get_info({'name': 1})
+        self._check_vm_info(info, power_state.RUNNING)
+
+    def test_vc_driver_destroys_in_cluster(self):
+        vc_conn = self._create_vc_driver()
+        self._spawn_in_cluster(vc_conn, "cluster2")
+        acquired = []
+
+        class FakeSemaphore(object):
+            def __enter__(self):
+                acquired.append(True)
+
+            def __exit__(self, *args):
+                pass
+
+        self.stubs.Set(vc_conn._vmops_by_node["cluster2"],
+                       '_destroy_semaphore', FakeSemaphore())
+        vc_conn.destroy(self.instance, self.network_info)
+        self.assertEquals(acquired, [True])
+        self.assertEquals(vc_conn.list_instances(), [])
+
+    def test_fake_simulates_task_duration(self):
+        vmwareapi_fake.simulate(task_duration=0.05)
+        task = vmwareapi_fake.create_task("PowerOnVM_Task", "success")
+        self.assertEquals(task.get("info").state, "running")
+        greenthread.sleep(0.05)
+        self.assertEquals(task.get("info").state, "success")
+
+    def test_fake_simulates_overload(self):
+        self._create_vm()
+        self.stubs.Set(driver, "_get_retry_delay", lambda retry_count: 0)
+        vmwareapi_fake.simulate(overload_faults=2)
+        vmwareapi_fake.reset_call_counts()
+        info = self.conn.get_info({'name': 1})
+        self._check_vm_info(info, power_state.RUNNING)
+        # The call failed twice with an overload before going through
+        self.assertEquals(vmwareapi_fake.get_call_counts(),
+                          {"RetrieveProperties": 3})
+
+    def test_call_stats(self):
+        self.flags(vmwareapi_call_stats=True)
+        call_stats.reset()
+        self._create_vm()
+        stats = call_stats.get_stats()
+        self.assertEquals(stats["calls"]["CreateVM_Task"]["count"], 1)
+        self.assertEquals(sum(stats["calls"]["CreateVM_Task"]["histogram"]),
+                          1)
+        # The VMs of the host are swept for the name of the new instance, as
+        # the cache was never refreshed
+        self.assertTrue(("driver.spawn", "vmops._refresh_vm_ref_cache",
+                         "vim_util.retrieve_objects") in stats["callers"])
+        self.assertTrue(("driver.spawn", "vmops._execute_create_vm",
+                         "CreateVM_Task") in stats["callers"])
+        # The task waiter polls in a greenthread of its own
+        self.assertTrue(("driver._poll", "driver._poll_tasks",
+                "vim_util.get_properties_for_a_collection_of_objects") in
+                stats["callers"])
+        diagnostics = self.conn.get_diagnostics({'name': 1})
+        self.assertEquals(diagnostics["call:CreateVM_Task:count"], 1)
+
+    def test_call_stats_retries(self):
+        self.flags(vmwareapi_call_stats=True)
+        self._create_vm()
+        self.stubs.Set(driver, "_get_retry_delay", lambda retry_count: 0)
+        vmwareapi_fake.simulate(overload_faults=2)
+        call_stats.reset()
+        self.conn.get_info({'name': 1})
+        method_stats = call_stats.get_stats()["calls"][
+                "vim_util.get_object_properties"]
+        self.assertEquals(method_stats["count"], 3)
+        self.assertEquals(method_stats["retries"], 2)
+        self.assertEquals(method_stats["overloads"], 2)
+
+    def test_call_stats_disabled(self):
+        call_stats.reset()
+        self._create_vm()
+        self.assertEquals(call_stats.get_stats(),
+                          {"calls": {}, "requests": {}, "callers": {}})
@@ -0,0 +1,748 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmarks of the VMware driver against the host simulated by
+nova.virt.vmwareapi.fake, so that the performance of the driver can be
+measured without an ESX host.
+
+The host is populated with the VMs asked for, and the operations of the
+compute manager are driven through VMwareESXDriver. For each operation the
+number of calls made to the host, the wall time and the peak memory of the
+process are reported. Run with:
+
+    python -m nova.tests.vmwareapi.benchmark --vms 2000 --latency 0.002
+
+The SOAP calls of the retrieval path and of the task polling can be timed
+with the requests and replies marshalled by suds and by the fast path of
+soap_util, against canned replies of a host of the VMs asked for. The WSDL
+of the vSphere SDK is needed for it:
+
+    python -m nova.tests.vmwareapi.benchmark --retrieval --vms 1000 \
+        --calls 10 --wsdl file:///path/to/vimService.wsdl
+
+The image transfers of vmware_images can be timed between local socket
+stand-ins of Glance and of the datastore, with the CPU time per GB
+transferred reported for each chunk size the disk file is read in:
+
+    python -m nova.tests.vmwareapi.benchmark --transfer --size-mb 1024 \
+        --chunk-kb 64 --chunk-kb 1024
+"""
+
+import argparse
+import httplib
+import re
+import resource
+import sys
+import time
+import urllib2
+
+import eventlet
+from eventlet import wsgi
+import stubout
+import suds.transport
+
+from nova import context
+from nova import db
+from nova.openstack.common import cfg
+import nova.tests.image.fake
+from nova.tests.vmwareapi import db_fakes
+from nova.tests.vmwareapi import stubs
+from nova.virt.vmwareapi import driver
+from nova.virt.vmwareapi import fake as vmwareapi_fake
+from nova.virt.vmwareapi import read_write_util
+from nova.virt.vmwareapi import soap_util
+from nova.virt.vmwareapi import vim
+from nova.virt.vmwareapi import vim_util
+from nova.virt.vmwareapi import vmware_images
+
+CONF = cfg.CONF
+
+NETWORK_INFO = [({'bridge': 'fa0',
+                  'id': 0,
+                  'vlan': None,
+                  'bridge_interface': None,
+                  'injected': True},
+                 {'broadcast': '192.168.0.255',
+                  'dns': ['192.168.0.1'],
+                  'gateway': '192.168.0.1',
+                  'ips': [{'enabled': '1',
+                           'ip': '192.168.0.100',
+                           'netmask': '255.255.255.0'}],
+                  'label': 'fake',
+                  'mac': 'DE:AD:BE:EF:00:00'})]
+
+IMAGE = {'id': 'c1c8ce3d-c2e0-4247-890c-ccf5cc1c004c',
+         'disk_format': 'vhd',
+         'size': 512}
+
+# The size of the chunks the Glance client reads and sends the image data in
+GLANCE_CHUNKSIZE = 64 * 1024
+
+
+def _get_peak_memory_kb():
+    """Gets the peak resident memory of the process so far, in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _get_cpu_time():
+    """Gets the user and system CPU time of the process so far, in
+    seconds."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Benchmark(object):
+    """
+    Runs the operations of the driver against a simulated host of num_vms
+    VMs, with the latency, task duration and overload faults given, and
+    collects a result for each operation.
+    """
+
+    def __init__(self, stubs, num_vms=1000, num_spawns=10, call_latency=0,
+                 task_duration=0, overload_faults=0):
+        self.stubs = stubs
+        self.num_vms = num_vms
+        self.num_spawns = num_spawns
+        self.call_latency = call_latency
+        self.task_duration = task_duration
+        self.overload_faults = overload_faults
+        self.context = context.RequestContext('fake', 'fake', is_admin=False)
+        self.results = []
+
+    def set_up(self):
+        """Sets up the simulated host and the driver."""
+        vmwareapi_fake.reset()
+        vmwareapi_fake.create_vms(self.num_vms)
+        db_fakes.stub_out_db_instance_api(self.stubs)
+        stubs.set_stubs(self.stubs)
+        nova.tests.image.fake.stub_out_image_service(self.stubs)
+        self.conn = driver.VMwareESXDriver(None, False)
+        vmwareapi_fake.simulate(call_latency=self.call_latency,
+                                task_duration=self.task_duration,
+                                overload_faults=self.overload_faults)
+
+    def tear_down(self):
+        if self.conn._inventory:
+            self.conn._inventory.stop()
+        vmwareapi_fake.cleanup()
+        nova.tests.image.fake.FakeImageService_reset()
+
+    def measure(self, name, func, *args, **kwargs):
+        """Runs the operation and records its result."""
+        vmwareapi_fake.reset_call_counts()
+        start = time.time()
+        func(*args, **kwargs)
+        wall_time = time.time() - start
+        call_counts = vmwareapi_fake.get_call_counts()
+        result = {'name': name,
+                  'calls': sum(call_counts.values()),
+                  'call_counts': call_counts,
+                  'wall_time': wall_time,
+                  'peak_memory_kb': _get_peak_memory_kb()}
+        self.results.append(result)
+        return result
+
+    def _get_instances(self):
+        """Gets the instances of the VMs the host was populated with."""
+        return [{'name': 'vm-%d' % index, 'uuid': 'uuid-%d' % index}
+                for index in xrange(self.num_vms)]
+
+    def _create_instance(self, index):
+        values = {'name': 'bench-%d' % index,
+                  'id': index,
+                  'project_id': 'fake',
+                  'user_id': 'fake',
+                  'image_ref': '1',
+                  'kernel_id': '1',
+                  'ramdisk_id': '1',
+                  'mac_address': 'de:ad:be:ef:be:ef',
+                  'instance_type': 'm1.large'}
+        return db.instance_create(None, values)
+
+    def spawn(self, instances):
+        for instance in instances:
+            self.conn.spawn(self.context, instance, IMAGE,
+                            injected_files=[], admin_password=None,
+                            network_info=NETWORK_INFO,
+                            block_device_info=None)
+
+    def destroy(self, instances):
+        for instance in instances:
+            self.conn.destroy(instance, NETWORK_INFO)
+        # The folders of the VMs are deleted in the background
+        reaper = self.conn._vmops._folder_reaper
+        for done in reaper._pending.values():
+            done.wait()
+
+    def get_info(self, instances):
+        for instance in instances:
+            self.conn.get_info(instance)
+
+    def sync_power_states(self, instances):
+        """Does the calls of the _sync_power_states of the compute
+        manager."""
+        self.conn.get_num_instances()
+        self.conn.get_info_bulk(instances)
+
+    def run(self):
+        """Runs all the operations and returns their results."""
+        self.set_up()
+        try:
+            instances = self._get_instances()
+            spawned = [self._create_instance(index)
+                       for index in xrange(self.num_spawns)]
+            self.measure('list_instances', self.conn.list_instances)
+            self.measure('get_info', self.get_info, instances)
+            self.measure('sync_power_states', self.sync_power_states,
+                         instances)
+            self.measure('spawn', self.spawn, spawned)
+            self.measure('destroy', self.destroy, spawned)
+        finally:
+            self.tear_down()
+        return self.results
+
+
+# The envelope of the canned replies of the ESX host stand-in
+_ENVELOPE = ('<?xml version="1.0" encoding="UTF-8"?>'
+             '<soapenv:Envelope '
+             'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+             'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+             'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+             '<soapenv:Body><%(method)sResponse xmlns="urn:vim25">'
+             '%(body)s</%(method)sResponse></soapenv:Body>'
+             '</soapenv:Envelope>')
+
+_SERVICE_CONTENT = (
+        '<returnval>'
+        '<rootFolder type="Folder">group-d1</rootFolder>'
+        '<propertyCollector type="PropertyCollector">propertyCollector'
+        '</propertyCollector>'
+        '<about><name>VMware ESXi</name><fullName>VMware ESXi 4.1.0</fullName>'
+        '<vendor>VMware, Inc.</vendor><version>4.1.0</version>'
+        '<build>260247</build><localeVersion>INTL</localeVersion>'
+        '<localeBuild>000</localeBuild><osType>vmnix-x86</osType>'
+        '<productLineId>embeddedEsx</productLineId><apiType>HostAgent'
+        '</apiType><apiVersion>4.1</apiVersion></about>'
+        '</returnval>')
+
+_VM_OBJECT = (
+        '<objects><obj type="VirtualMachine">vm-%(index)d</obj>'
+        '<propSet><name>name</name>'
+        '<val xsi:type="xsd:string">%(name)s</val></propSet>'
+        '<propSet><name>runtime.powerState</name>'
+        '<val xsi:type="VirtualMachinePowerState">poweredOn</val></propSet>'
+        '<propSet><name>datastore</name>'
+        '<val xsi:type="ArrayOfManagedObjectReference">'
+        '<ManagedObjectReference type="Datastore" '
+        'xsi:type="ManagedObjectReference">datastore-1'
+        '</ManagedObjectReference></val></propSet>'
+        '</objects>')
+
+_TASK_INFO = (
+        '<returnval><obj type="Task">task-1</obj>'
+        '<propSet><name>info</name><val xsi:type="TaskInfo">'
+        '<key>task-1</key><task type="Task">task-1</task>'
+        '<name>PowerOnVM_Task</name>'
+        '<descriptionId>VirtualMachine.powerOn</descriptionId>'
+        '<entity type="VirtualMachine">vm-0</entity>'
+        '<entityName>%(name)s</entityName><state>success</state>'
+        '<cancelled>false</cancelled><cancelable>false</cancelable>'
+        '<reason xsi:type="TaskReasonUser"><userName>root</userName></reason>'
+        '<queueTime>2013-01-01T00:00:00Z</queueTime>'
+        '<startTime>2013-01-01T00:00:00Z</startTime>'
+        '<completeTime>2013-01-01T00:00:01Z</completeTime>'
+        '<eventChainId>1</eventChainId>'
+        '</val></propSet></returnval>')
+
+
+class HostStandIn(suds.transport.Transport):
+    """
+    A suds transport that answers the requests of a Vim object with the
+    canned replies an ESX host of num_vms VMs would send, paging the VMs
+    by vmwareapi_maximum_objects, and counts the requests sent.
+    """
+
+    def __init__(self, num_vms):
+        suds.transport.Transport.__init__(self)
+        page_size = CONF.vmwareapi_maximum_objects
+        vm_name = "%s-" % IMAGE['id']
+        objects = [_VM_OBJECT % {'index': index,
+                                 'name': vm_name + str(index)}
+                   for index in xrange(num_vms)]
+        self.pages = []
+        for start in xrange(0, num_vms, page_size):
+            page = "".join(objects[start:start + page_size])
+            if start + page_size < num_vms:
+                page = "<token>%d</token>" % (len(self.pages) + 1) + page
+            self.pages.append("<returnval>%s</returnval>" % page)
+        self.replies = {
+            'RetrieveServiceContent': _SERVICE_CONTENT,
+            'RetrieveProperties': _TASK_INFO % {'name': vm_name + "0"},
+            'PowerOnVM_Task': '<returnval type="Task">task-1</returnval>',
+            'PowerOffVM_Task': '<returnval type="Task">task-2</returnval>',
+        }
+        self.call_counts = {}
+
+    def send(self, request):
+        body = request.message.split("Body>", 1)[1]
+        method = re.match(r"<(?:\w+:)?(\w+)", body).group(1)
+        self.call_counts[method] = self.call_counts.get(method, 0) + 1
+        if method == 'RetrievePropertiesEx':
+            reply = self.pages[0]
+        elif method == 'ContinueRetrievePropertiesEx':
+            token = re.search(r"<(?:\w+:)?token>(\d+)<", body).group(1)
+            reply = self.pages[int(token)]
+        else:
+            reply = self.replies[method]
+        return suds.transport.Reply(200, {},
+                _ENVELOPE % {'method': method, 'body': reply})
+
+
+def _to_plain(value):
+    """
+    Converts the objects, the managed object references and the properties
+    returned by a call into lists, tuples and strings, so that the results
+    of the suds path and of the fast path can be compared.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(item) for item in value]
+    if hasattr(value, "_type"):
+        return (str(value._type), str(value.value))
+    if hasattr(value, "ManagedObjectReference"):
+        return _to_plain(value.ManagedObjectReference)
+    if hasattr(value, "propSet"):
+        return (_to_plain(value.obj), _to_plain(value.propSet))
+    if hasattr(value, "val"):
+        return (str(value.name), _to_plain(value.val))
+    if hasattr(value, "state") and hasattr(value, "key"):
+        return dict((name, _to_plain(getattr(value, name, None)))
+                    for name in soap_util.TaskInfo.__slots__)
+    if isinstance(value, basestring):
+        return unicode(value)
+    return value
+
+
+class RetrievalBenchmark(object):
+    """
+    Times the SOAP calls of the retrieval path and of the task polling over
+    num_vms VMs, with the requests and replies marshalled by suds and by the
+    fast path of soap_util. The calls go through a Vim object created from
+    the WSDL of the URL given, whose requests are answered by the canned
+    replies of HostStandIn, so that only the client side is measured. The
+    results of both paths are checked to be the same. The building of the
+    traversal specs with the suds client factory of the WSDL is also timed,
+    with the specs shared by the calls and with them built for every call.
+    """
+
+    def __init__(self, wsdl_url, num_vms=1000, num_calls=10):
+        self.wsdl_url = wsdl_url
+        self.num_vms = num_vms
+        self.num_calls = num_calls
+        self.results = []
+
+    def set_up(self):
+        """Sets up a Vim object of the WSDL answered by the stand-in."""
+        CONF.set_override('vmwareapi_wsdl_loc', self.wsdl_url)
+        self.host = HostStandIn(self.num_vms)
+        get_client = vim._get_client
+
+        def _get_client(wsdl_url, location):
+            client = get_client(wsdl_url, location)
+            client.set_options(transport=self.host)
+            return client
+
+        vim._get_client = _get_client
+        try:
+            self.vim = vim.Vim(protocol="https", host="localhost")
+        finally:
+            vim._get_client = get_client
+        self.vm_ref = vim_util.get_objects(self.vim, "VirtualMachine")[0].obj
+
+    def tear_down(self):
+        CONF.clear_override('vmwareapi_wsdl_loc')
+        vim_util._cached_specs.clear()
+
+    def measure(self, name, func, *args):
+        """
+        Runs the operation num_calls times, records its result and returns
+        what the operation returned.
+        """
+        self.host.call_counts = {}
+        start = time.time()
+        for i in xrange(self.num_calls):
+            value = func(*args)
+        wall_time = time.time() - start
+        call_counts = self.host.call_counts
+        result = {'name': name,
+                  'calls': sum(call_counts.values()),
+                  'call_counts': call_counts,
+                  'wall_time': wall_time,
+                  'peak_memory_kb': _get_peak_memory_kb()}
+        self.results.append(result)
+        return value
+
+    def build_specs(self, shared):
+        client_factory = self.vim.client.factory
+        if shared:
+            vim_util.get_recursive_traversal_spec(client_factory)
+            vim_util.get_scoped_traversal_spec(client_factory,
+                                               "VirtualMachine")
+        else:
+            vim_util.build_recursive_traversal_spec(client_factory)
+            vim_util.build_scoped_traversal_spec(client_factory,
+                                                 "VirtualMachine")
+
+    def get_objects(self):
+        vms = vim_util.get_objects(self.vim, "VirtualMachine",
+                                   ["name", "runtime.powerState",
+                                    "datastore"])
+        assert len(vms) == self.num_vms
+        return vms
+
+    def get_task_info(self):
+        task_ref = self.vim.PowerOnVM_Task(self.vm_ref)
+        return task_ref, vim_util.get_properties_for_a_collection_of_objects(
+                                self.vim, "Task", [task_ref], ["info"])
+
+    def power_off(self):
+        return self.vim.PowerOffVM_Task(self.vm_ref)
+
+    def run(self):
+        """
+        Runs the operations and returns their results. Raises an
+        AssertionError if the two paths return different results.
+        """
+        self.set_up()
+        try:
+            for shared, suffix in [(True, "shared"), (False, "rebuilt")]:
+                vim_util._cached_specs.clear()
+                self.measure("build_specs_" + suffix, self.build_specs,
+                             shared)
+            returned = {}
+            for fast_path, suffix in [(False, "suds"), (True, "fast")]:
+                self.vim.fast_path = fast_path
+                vim_util._cached_specs.clear()
+                returned[suffix] = [
+                    _to_plain(self.measure("get_objects_" + suffix,
+                                           self.get_objects)),
+                    _to_plain(self.measure("task_info_" + suffix,
+                                           self.get_task_info)),
+                    _to_plain(self.measure("power_off_" + suffix,
+                                           self.power_off))]
+            assert returned["suds"] == returned["fast"], \
+                    "The fast path returned different results"
+        finally:
+            self.tear_down()
+        return self.results
+
+
+class _Cookie(object):
+    """The session cookie sent to the stand-in of the datastore."""
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class HTTPStandIn(object):
+    """
+    A local HTTP server standing in for the datastore of the ESX host or for
+    Glance. A GET is served size bytes of the file, or the range of them
+    asked for, and the data of a PUT is read and dropped. The server runs in
+    a greenthread of the process, so the sockets must be green, as they are
+    once eventlet.monkey_patch() is called.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.received = 0
+        self._chunk = "\0" * GLANCE_CHUNKSIZE
+        self._socket = eventlet.listen(("127.0.0.1", 0))
+        self.host = "127.0.0.1:%d" % self._socket.getsockname()[1]
+        self._thread = eventlet.spawn(wsgi.server, self._socket, self._app,
+                                      log=_NullLog(), log_output=False)
+
+    def _iter_data(self, length):
+        while length > 0:
+            chunk = self._chunk[:length]
+            length -= len(chunk)
+            yield chunk
+
+    def _app(self, environ, start_response):
+        if environ["REQUEST_METHOD"] == "PUT":
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            while length > 0:
+                data = environ["wsgi.input"].read(min(length,
+                                                      GLANCE_CHUNKSIZE))
+                if not data:
+                    break
+                length -= len(data)
+                self.received += len(data)
+            start_response("200 OK", [("Content-Length", "0")])
+            return []
+        first, last = 0, self.size - 1
+        status = "200 OK"
+        headers = []
+        if "HTTP_RANGE" in environ:
+            # The range is of the form "bytes=<first>-<last>"
+            first, last = [int(bound) for bound in
+                           environ["HTTP_RANGE"].split("=")[1].split("-")]
+            last = min(last, self.size - 1)
+            status = "206 Partial Content"
+            headers.append(("Content-Range", "bytes %d-%d/%d" %
+                            (first, last, self.size)))
+        headers.append(("Content-Length", str(last - first + 1)))
+        start_response(status, headers)
+        return self._iter_data(last - first + 1)
+
+    def stop(self):
+        self._thread.kill()
+        self._socket.close()
+
+
+class _NullLog(object):
+    """Drops the access log of the stand-ins."""
+
+    def write(self, data):
+        pass
+
+
+class GlanceStandIn(object):
+    """
+    The image service of the transfers, which downloads and uploads the
+    image data from and to the stand-in of Glance in the chunks the Glance
+    client does.
+    """
+
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+
+    def download(self, context, image_id, data):
+        response = urllib2.urlopen("http://%s/v1/images/%s" %
+                                   (self.stand_in.host, image_id))
+        try:
+            while True:
+                chunk = response.read(GLANCE_CHUNKSIZE)
+                if not chunk:
+                    break
+                data.write(chunk)
+        finally:
+            response.close()
+
+    def update(self, context, image_id, image_meta, data=None):
+        size = data.tell()
+        conn = httplib.HTTPConnection(self.stand_in.host)
+        conn.putrequest("PUT", "/v1/images/%s" % image_id)
+        conn.putheader("Content-Length", size)
+        conn.endheaders()
+        sent = 0
+        while sent < size:
+            chunk = data.read(GLANCE_CHUNKSIZE)
+            if not chunk:
+                break
+            conn.send(chunk)
+            sent += len(chunk)
+        conn.getresponse().read()
+        conn.close()
+
+    def show(self, context, image_id):
+        return {"status": "active"}
+
+
+class TransferBenchmark(object):
+    """
+    Times the transfers of size_mb MB of image data between local socket
+    stand-ins of Glance and of the datastore, through the pipe and the
+    threads of io_util and the HTTP files of read_write_util: the download
+    of an image to the datastore, and the upload of a disk file to Glance,
+    read in each of the chunk sizes given. The CPU time of the process per
+    GB transferred is reported, which includes the time the stand-ins take
+    to serve the data.
+    """
+
+    def __init__(self, size_mb=256, chunk_sizes_kb=None):
+        self.size = size_mb * 1024 * 1024
+        self.chunk_sizes_kb = chunk_sizes_kb or [
+                read_write_util.READ_CHUNKSIZE / 1024]
+        self.context = context.RequestContext('fake', 'fake', is_admin=False)
+        self.cookies = [_Cookie("vmware_soap_session", "fake-session")]
+        self.results = []
+
+    def set_up(self):
+        """Starts the stand-ins of Glance and of the datastore."""
+        self.glance = HTTPStandIn(self.size)
+        self.datastore = HTTPStandIn(self.size)
+
+    def tear_down(self):
+        self.glance.stop()
+        self.datastore.stop()
+
+    def measure(self, name, func, *args):
+        """Runs the transfer and records its result."""
+        self.glance.received = 0
+        self.datastore.received = 0
+        cpu_time = _get_cpu_time()
+        start = time.time()
+        func(*args)
+        wall_time = time.time() - start
+        cpu_time = _get_cpu_time() - cpu_time
+        transferred = self.glance.received + self.datastore.received
+        gigabytes = float(transferred) / (1024 * 1024 * 1024)
+        result = {'name': name,
+                  'transferred': transferred,
+                  'wall_time': wall_time,
+                  'rate': transferred / max(wall_time, 0.001) / (1024 * 1024),
+                  'cpu_time': cpu_time,
+                  'cpu_per_gb': cpu_time / max(gigabytes, 1e-9),
+                  'peak_memory_kb': _get_peak_memory_kb()}
+        self.results.append(result)
+        return result
+
+    def download(self):
+        """Downloads the image from Glance to the datastore."""
+        write_file_handle = read_write_util.VMwareHTTPWriteFile(
+                self.datastore.host, "ha-datacenter", "fake-ds",
+                self.cookies, "fake-image/fake-image-flat.vmdk", self.size,
+                scheme="http")
+        vmware_images.start_transfer(self.context, None, self.size,
+                write_file_handle=write_file_handle,
+                image_service=GlanceStandIn(self.glance),
+                image_id="fake-image")
+
+    def upload(self, chunk_size):
+        """Uploads the disk file from the datastore to Glance, read in the
+        chunk size."""
+
+        def _open_range(offset=0, length=None):
+            return read_write_util.VMwareHTTPReadFile(
+                    self.datastore.host, "ha-datacenter", "fake-ds",
+                    self.cookies, "fake-vm/fake-vm-flat.vmdk", scheme="http",
+                    offset=offset, length=length)
+
+        read_chunksize = read_write_util.READ_CHUNKSIZE
+        read_write_util.READ_CHUNKSIZE = chunk_size
+        try:
+            vmware_images.start_transfer(self.context, None, self.size,
+                    image_service=GlanceStandIn(self.glance),
+                    image_id="fake-image", open_range=_open_range)
+        finally:
+            read_write_util.READ_CHUNKSIZE = read_chunksize
+
+    def run(self):
+        """Runs the transfers and returns their results."""
+        self.set_up()
+        try:
+            self.measure("download", self.download)
+            for chunk_size_kb in self.chunk_sizes_kb:
+                self.measure("upload_%dkb" % chunk_size_kb, self.upload,
+                             chunk_size_kb * 1024)
+        finally:
+            self.tear_down()
+        return self.results
+
+
+def print_results(results, out=sys.stdout):
+    print >> out, "%-20s %8s %12s %16s" % ("operation", "calls",
+                                           "wall time (s)", "peak memory (KB)")
+    for result in results:
+        print >> out, "%(name)-20s %(calls)8d %(wall_time)12.3f " \
+                      "%(peak_memory_kb)16d" % result
+
+
+def print_transfer_results(results, out=sys.stdout):
+    print >> out, "%-20s %12s %12s %12s %16s" % ("transfer", "MB/s",
+            "wall time (s)", "CPU (s) / GB", "peak memory (KB)")
+    for result in results:
+        print >> out, "%(name)-20s %(rate)12.1f %(wall_time)12.3f " \
+                      "%(cpu_per_gb)12.3f %(peak_memory_kb)16d" % result
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+            description='Benchmark the VMware driver against a simulated '
+                        'host.')
+    parser.add_argument('--vms', type=int, default=1000,
+                        help="number of VMs the host is populated with")
+    parser.add_argument('--spawns', type=int, default=10,
+                        help="number of instances spawned and destroyed")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="seconds each call to the host takes")
+    parser.add_argument('--task-duration', type=float, default=0,
+                        help="seconds each task takes to complete")
+    parser.add_argument('--overload-faults', type=int, default=0,
+                        help="number of calls failing with an overload")
+    parser.add_argument('--retrieval', action='store_true',
+                        help="time the retrieval path of vim_util instead")
+    parser.add_argument('--calls', type=int, default=10,
+                        help="number of times each retrieval is timed")
+    parser.add_argument('--wsdl', default=None,
+                        help="URL of the WSDL of the vSphere SDK the "
+                             "retrieval is timed with")
+    parser.add_argument('--transfer', action='store_true',
+                        help="time the image transfers between local "
+                             "stand-ins of Glance and of the datastore "
+                             "instead")
+    parser.add_argument('--size-mb', type=int, default=256,
+                        help="size (MB) of the image data transferred")
+    parser.add_argument('--chunk-kb', type=int, action='append',
+                        default=None,
+                        help="size (KB) of the chunks the disk file is read "
+                             "from the datastore in; may be repeated")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="show the calls made by each operation")
+    args = parser.parse_args()
+    if args.retrieval and not args.wsdl:
+        parser.error("--retrieval needs the URL of the WSDL in --wsdl")
+    return args
+
+
+def main():
+    args = _parse_args()
+    CONF([], project='nova')
+    CONF.set_override('vmwareapi_host_ip', 'test_url')
+    CONF.set_override('vmwareapi_host_username', 'test_username')
+    CONF.set_override('vmwareapi_host_password', 'test_pass')
+    CONF.set_override('vmwareapi_api_retry_count', 10)
+    if args.transfer:
+        # The stand-ins serve the transfers from a greenthread
+        eventlet.monkey_patch(os=False)
+        results = TransferBenchmark(size_mb=args.size_mb,
+                                    chunk_sizes_kb=args.chunk_kb).run()
+        print_transfer_results(results)
+        return
+    if args.retrieval:
+        results = RetrievalBenchmark(args.wsdl, num_vms=args.vms,
+                                     num_calls=args.calls).run()
+    else:
+        stub_out = stubout.StubOutForTesting()
+        try:
+            benchmark = Benchmark(stub_out, num_vms=args.vms,
+                                  num_spawns=args.spawns,
+                                  call_latency=args.latency,
+                                  task_duration=args.task_duration,
+                                  overload_faults=args.overload_faults)
+            results = benchmark.run()
+        finally:
+            stub_out.UnsetAll()
+    print_results(results)
+    if args.verbose:
+        for result in results:
+            print "%s: %s" % (result['name'], result['call_counts'])
+
+
+if __name__ == "__main__":
+    main()
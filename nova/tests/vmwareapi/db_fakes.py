@@ -79,6 +79,7 @@ def stub_out_db_instance_api(stubs):
             'vcpus': type_data['vcpus'],
             'mac_addresses': [{'address': values['mac_address']}],
             'root_gb': type_data['root_gb'],
+            'node': values.get('node'),
             }
         return FakeModel(base_options)
 
@@ -40,13 +40,45 @@ def fake_is_vim_object(arg, module):
 def set_stubs(stubs):
     """Set the stubs."""
     stubs.Set(vmops.VMwareVMOps, 'plug_vifs', fake.fake_plug_vifs)
-    stubs.Set(network_util, 'get_network_with_the_name',
+    stubs.Set(network_util.HostNetworkCache, 'get_network_with_the_name',
               fake.fake_get_network)
     stubs.Set(vmware_images, 'fetch_image', fake.fake_fetch_image)
     stubs.Set(vmware_images, 'get_vmdk_size_and_properties',
               fake.fake_get_vmdk_size_and_properties)
     stubs.Set(vmware_images, 'upload_image', fake.fake_upload_image)
+    stubs.Set(vmware_images, 'upload_vmdk_descriptor',
+              fake.fake_upload_vmdk_descriptor)
     stubs.Set(driver.VMwareAPISession, "_get_vim_object",
               fake_get_vim_object)
     stubs.Set(driver.VMwareAPISession, "_is_vim_object",
               fake_is_vim_object)
+
+
+def record_called_methods(stubs):
+    """Stubs out the VMwareAPISession's _call_method to record the names
+    of the methods called, still passing the calls through.
+
+    Returns the list the names are appended to.
+    """
+    called_methods = []
+    call_method = driver.VMwareAPISession._call_method
+
+    def fake_call_method(session, module, method, *args, **kwargs):
+        called_methods.append(method)
+        return call_method(session, module, method, *args, **kwargs)
+
+    stubs.Set(driver.VMwareAPISession, "_call_method", fake_call_method)
+    return called_methods
+
+
+class FakeWriteFile(object):
+    """Write file handle that keeps the chunks written to it."""
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        pass
@@ -127,6 +127,17 @@ class ComputeDriver(object):
         # TODO(Vek): Need to pass context in for access to auth_token
         raise NotImplementedError()
 
+    def get_info_bulk(self, instances):
+        """Get the current status of several instances at once.
+
+        Returns a dict of instance uuid => the dict described in get_info,
+        for each of the instances found on the hypervisor. Drivers for
+        which a single query of many instances is cheaper than one query
+        per instance should implement this; callers fall back to get_info
+        otherwise.
+        """
+        raise NotImplementedError()
+
     def get_num_instances(self):
         """Return the total number of virtual machines.
 
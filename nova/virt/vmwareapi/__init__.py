@@ -20,3 +20,4 @@
 """
 # NOTE(sdague) for nicer compute_driver specification
 from nova.virt.vmwareapi.driver import VMwareESXDriver
+from nova.virt.vmwareapi.driver import VMwareVCDriver
@@ -0,0 +1,238 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Accounting of the calls made to the ESX host.
+
+Two kinds of calls are accounted for: the calls made through the session,
+which may be retried and may each be a number of requests, and the SOAP
+requests sent to the host. For each method the number of calls, retries,
+overloads and faults are counted and the latencies are put in a histogram.
+The calls made through the session are also counted by the operation of
+the driver and the function making them, as found on the stack of the call.
+Nothing is recorded unless vmwareapi_call_stats is set.
+"""
+
+import sys
+
+from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+
+LOG = logging.getLogger(__name__)
+
+vmwareapi_call_stats_opts = [
+    cfg.BoolOpt('vmwareapi_call_stats',
+                default=False,
+                help='Should the calls made to the host be counted and '
+                     'timed, by method and by the operation of the driver '
+                     'making them? '
+                     'Used only if compute_driver is '
+                     'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_call_stats_log_interval',
+               default=600,
+               help='The interval (seconds) at which the stats of the calls '
+                    'made to the host are logged, if they are collected. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(vmwareapi_call_stats_opts)
+
+# The upper bounds (ms) of the buckets of the latency histograms. The last
+# bucket of a histogram holds the latencies above the last bound.
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+OUTCOME_OK = "ok"
+OUTCOME_FAULT = "fault"
+OUTCOME_OVERLOAD = "overload"
+OUTCOME_ERROR = "error"
+
+# The number of callers logged
+NUM_CALLERS_LOGGED = 10
+
+_PACKAGE = "nova.virt.vmwareapi."
+# The modules and functions of the package which make the calls on behalf of
+# others, and are not taken for the callers
+_CALL_MODULES = [_PACKAGE + "vim", _PACKAGE + "vim_util",
+                 _PACKAGE + "call_stats", _PACKAGE + "fake"]
+_CALL_FUNCTIONS = ["_call_method", "_call_method_with_vim", "_iter_objects",
+                   "_pinned_vim"]
+
+
+def is_enabled():
+    return CONF.vmwareapi_call_stats
+
+
+def _new_method_stats():
+    return {"count": 0,
+            "retries": 0,
+            "overloads": 0,
+            "faults": 0,
+            "errors": 0,
+            "time": 0.0,
+            "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+
+
+def _add(method_stats, latency, outcome, retry=False):
+    latency_ms = latency * 1000
+    bucket = 0
+    while (bucket < len(LATENCY_BUCKETS) and
+           latency_ms > LATENCY_BUCKETS[bucket]):
+        bucket += 1
+    method_stats["count"] += 1
+    method_stats["time"] += latency
+    method_stats["histogram"][bucket] += 1
+    if retry:
+        method_stats["retries"] += 1
+    if outcome == OUTCOME_OVERLOAD:
+        method_stats["overloads"] += 1
+    elif outcome == OUTCOME_FAULT:
+        method_stats["faults"] += 1
+    elif outcome == OUTCOME_ERROR:
+        method_stats["errors"] += 1
+
+
+def _copy(method_stats):
+    return dict(method_stats, histogram=list(method_stats["histogram"]))
+
+
+def _get_caller():
+    """
+    Gets the (operation, caller) of the call from the stack. The caller is
+    the innermost function of the driver making the call, and the operation
+    the outermost one, both as <module>.<function>.
+    """
+    operation = None
+    caller = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        name = frame.f_code.co_name
+        if (module.startswith(_PACKAGE) and module not in _CALL_MODULES and
+                name not in _CALL_FUNCTIONS):
+            operation = "%s.%s" % (module[len(_PACKAGE):], name)
+            if caller is None:
+                caller = operation
+        frame = frame.f_back
+    return operation or "unknown", caller or "unknown"
+
+
+class CallStats(object):
+    """The stats of the calls made to the host."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Maps the method called through the session to its stats
+        self._calls = {}
+        # Maps the SOAP method requested to its stats
+        self._requests = {}
+        # Maps the (operation, caller, method) to the number of calls
+        self._callers = {}
+        self._logged_at = timeutils.utcnow_ts()
+
+    def record_call(self, method, latency, outcome, retry=False):
+        """Records an attempt of a call made through the session."""
+        method_stats = self._calls.get(method)
+        if method_stats is None:
+            method_stats = self._calls[method] = _new_method_stats()
+        _add(method_stats, latency, outcome, retry)
+        key = _get_caller() + (method,)
+        self._callers[key] = self._callers.get(key, 0) + 1
+        if (timeutils.utcnow_ts() - self._logged_at >=
+                CONF.vmwareapi_call_stats_log_interval):
+            self.log()
+
+    def record_request(self, method, latency, outcome):
+        """Records a SOAP request sent to the host."""
+        method_stats = self._requests.get(method)
+        if method_stats is None:
+            method_stats = self._requests[method] = _new_method_stats()
+        _add(method_stats, latency, outcome)
+
+    def get_stats(self):
+        """
+        Gets the stats of the calls and of the requests by method, and the
+        number of calls by (operation, caller, method).
+        """
+        return {"calls": dict((method, _copy(method_stats))
+                              for method, method_stats
+                              in self._calls.iteritems()),
+                "requests": dict((method, _copy(method_stats))
+                                 for method, method_stats
+                                 in self._requests.iteritems()),
+                "callers": dict(self._callers)}
+
+    def get_diagnostics(self):
+        """Gets the stats as a flat dictionary of values."""
+        diagnostics = {}
+        for kind, stats in [("call", self._calls),
+                            ("request", self._requests)]:
+            for method, method_stats in stats.iteritems():
+                prefix = "%s:%s:" % (kind, method)
+                for field in ["count", "retries", "overloads", "faults",
+                              "errors"]:
+                    diagnostics[prefix + field] = method_stats[field]
+                diagnostics[prefix + "avg_ms"] = int(
+                        method_stats["time"] * 1000 / method_stats["count"])
+        for (operation, caller, method), count in self._callers.iteritems():
+            diagnostics["caller:%s:%s:%s" % (operation, caller,
+                                             method)] = count
+        return diagnostics
+
+    def log(self):
+        """Logs the callers making the most calls and the stats by
+        method."""
+        self._logged_at = timeutils.utcnow_ts()
+        callers = sorted(self._callers.iteritems(), key=lambda item: item[1],
+                         reverse=True)
+        total = sum(self._callers.itervalues())
+        for (operation, caller, method), count in callers[:NUM_CALLERS_LOGGED]:
+            LOG.info(_("%(count)d of %(total)d calls to the host: "
+                       "%(method)s by %(caller)s in %(operation)s") %
+                     locals())
+        for method, method_stats in sorted(self._calls.iteritems()):
+            LOG.info(_("Calls of %(method)s: %(count)d, retries "
+                       "%(retries)d, overloads %(overloads)d, faults "
+                       "%(faults)d, errors %(errors)d, latency histogram "
+                       "%(histogram)s") %
+                     dict(method_stats, method=method))
+
+
+_stats = CallStats()
+
+
+def record_call(method, latency, outcome, retry=False):
+    _stats.record_call(method, latency, outcome, retry)
+
+
+def record_request(method, latency, outcome):
+    _stats.record_request(method, latency, outcome)
+
+
+def get_stats():
+    return _stats.get_stats()
+
+
+def get_diagnostics():
+    return _stats.get_diagnostics()
+
+
+def reset():
+    _stats.reset()
@@ -0,0 +1,380 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Selection of the datastore the files of an instance are placed on, and the
+deletion of the folders of the instances destroyed.
+"""
+
+import re
+
+from eventlet import event
+from eventlet import greenthread
+
+from nova import exception
+from nova.openstack.common import cfg
+from nova.openstack.common import lockutils
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+from nova.virt.vmwareapi import error_util
+from nova.virt.vmwareapi import vim_util
+from nova.virt.vmwareapi import vm_util
+
+LOG = logging.getLogger(__name__)
+
+vmwareapi_datastore_opts = [
+    cfg.StrOpt('vmwareapi_datastore_regex',
+               default=None,
+               help='Regular expression the names of the datastores used '
+                    'for instances must match. All the datastores are used '
+                    'if not set. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_datastore_refresh_interval',
+               default=60,
+               help='The interval (seconds) after which the cached capacity '
+                    'and free space of the datastores are fetched again. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(vmwareapi_datastore_opts)
+CONF.import_opt('instance_name_template', 'nova.db.api')
+
+DATASTORE_PROPERTIES = ["summary.name", "summary.type", "summary.capacity",
+                        "summary.freeSpace", "summary.accessible"]
+
+# The types of the datastores the instances are placed on
+DATASTORE_TYPES = ["VMFS"]
+
+
+def mkdir(session, ds_path):
+    """
+    Creates the directory on the datastore, along with its parents, unless
+    it exists already.
+    """
+    try:
+        session._call_method(session._get_vim(), "MakeDirectory",
+                session._get_vim().get_service_content().fileManager,
+                name=ds_path, createParentDirectories=True)
+    except error_util.VimFaultException, excep:
+        if error_util.FAULT_FILE_ALREADY_EXISTS not in excep.fault_list:
+            raise
+
+
+def search(session, ds_ref, ds_path, match_pattern=None):
+    """
+    Searches the folder of the datastore for the files matching the pattern,
+    or for all its entries if no pattern is given. Returns the search
+    result, or None if the folder does not exist.
+    """
+    ds_browser = session._call_method(vim_util, "get_dynamic_property",
+                                      ds_ref, "Datastore", "browser")
+    search_spec = None
+    if match_pattern:
+        client_factory = session._get_vim().client.factory
+        search_spec = client_factory.create(
+                'ns0:HostDatastoreBrowserSearchSpec')
+        search_spec.matchPattern = [match_pattern]
+    search_task = session._call_method(session._get_vim(),
+                                       "SearchDatastore_Task",
+                                       ds_browser,
+                                       datastorePath=ds_path,
+                                       searchSpec=search_spec)
+    # If an error state is returned, it means that the path doesn't exist.
+    task_info = session._wait_for_task_completion(search_task)
+    if task_info.state == "error":
+        return None
+    return task_info.result
+
+
+def _get_instance_name_regex():
+    """
+    Gets the regular expression the names made from instance_name_template
+    match, any of its conversions matching any text.
+    """
+    parts = re.split(r"%(?:\(\w+\))?[-#0 +]*\d*[diouxXs]",
+                     CONF.instance_name_template)
+    return re.compile("^%s$" % ".+".join(re.escape(part) for part in parts))
+
+
+class DatastoreSelector(object):
+    """
+    Chooses the datastore with the most free space for the files of an
+    instance. The summaries of the datastores of the host are cached, and
+    the space taken by each placement is deducted from the cached free space
+    until the next refresh. If a cluster is given, the datastores of the
+    cluster are chosen from instead of those of the host.
+    """
+
+    def __init__(self, session, cluster=None):
+        self._session = session
+        self._cluster = cluster
+        # Maps the datastore name to a dictionary of the reference, type,
+        # capacity, free space and accessibility of the datastore.
+        self._datastores = {}
+        self._refreshed_at = None
+
+    def _is_stale(self):
+        """Checks if the cached summaries are due for a refresh."""
+        return (self._refreshed_at is None or
+                timeutils.utcnow_ts() - self._refreshed_at >=
+                CONF.vmwareapi_datastore_refresh_interval)
+
+    def refresh(self):
+        """Fetches the summaries of the datastores of the host."""
+        if self._cluster is None:
+            base_mor = self._session._call_method(vim_util, "get_objects",
+                                                  "HostSystem")[0].obj
+            base_type = "HostSystem"
+        else:
+            base_mor = self._cluster
+            base_type = "ClusterComputeResource"
+        data_stores = self._session._call_method(vim_util,
+                            "get_inner_objects", base_mor, base_type,
+                            "datastore", "Datastore", DATASTORE_PROPERTIES)
+        datastores = {}
+        for elem in data_stores:
+            props = dict((prop.name, prop.val) for prop in elem.propSet)
+            datastores[props.get("summary.name")] = {
+                "ref": elem.obj,
+                "type": props.get("summary.type"),
+                "capacity": props.get("summary.capacity", 0),
+                "free": props.get("summary.freeSpace", 0),
+                "accessible": props.get("summary.accessible", True)}
+        self._datastores = datastores
+        self._refreshed_at = timeutils.utcnow_ts()
+
+    def _is_usable(self, name, summary):
+        """Checks if the instances can be placed on the datastore."""
+        if not summary["accessible"] or summary["type"] not in DATASTORE_TYPES:
+            return False
+        regex = CONF.vmwareapi_datastore_regex
+        return regex is None or re.match(regex, name) is not None
+
+    def _get_datastores(self):
+        """Gets the cached summaries, refreshing them if they are stale."""
+
+        @lockutils.synchronized('vmware-datastore-selector', 'nova-')
+        def _get():
+            if self._is_stale():
+                self.refresh()
+            return self._datastores
+
+        return _get()
+
+    def get_datastore_names(self):
+        """Gets the names of the datastores instances can be placed on."""
+        return [name for name, summary in self._get_datastores().iteritems()
+                if self._is_usable(name, summary)]
+
+    def get_capacity(self):
+        """
+        Gets the total capacity and free space in bytes of the datastores
+        instances can be placed on.
+        """
+        capacity = 0
+        free = 0
+        for name, summary in self._get_datastores().iteritems():
+            if self._is_usable(name, summary):
+                capacity += summary["capacity"]
+                free += summary["free"]
+        return capacity, free
+
+    def get_datastore_ref(self, name):
+        """Gets the reference of the datastore with the name."""
+        summary = self._get_datastores().get(name)
+        if summary is None:
+            # It may have been added since the last refresh
+            self.refresh()
+            summary = self._datastores.get(name)
+        if summary is None:
+            raise exception.DatastoreNotFound()
+        return summary["ref"]
+
+    def select(self, required_bytes=0):
+        """
+        Chooses the usable datastore with the most free space, deducting the
+        bytes the placement requires from its cached free space. Returns the
+        name and reference of the datastore.
+        """
+
+        @lockutils.synchronized('vmware-datastore-selector', 'nova-')
+        def _select():
+            if self._is_stale():
+                self.refresh()
+            best_name = None
+            best_free = None
+            for name, summary in self._datastores.iteritems():
+                if not self._is_usable(name, summary):
+                    continue
+                if best_free is None or summary["free"] > best_free:
+                    best_name = name
+                    best_free = summary["free"]
+            if best_name is None:
+                raise exception.NovaException(_("Couldn't get a local "
+                                                "Datastore reference"))
+            if best_free < required_bytes:
+                raise exception.NovaException(_("No datastore has "
+                        "%(required_bytes)s bytes free, the most free "
+                        "space is %(best_free)s bytes on %(best_name)s") %
+                        locals())
+            summary = self._datastores[best_name]
+            summary["free"] -= required_bytes
+            LOG.debug(_("Chose the datastore %(best_name)s with "
+                        "%(best_free)s bytes free") % locals())
+            return best_name, summary["ref"]
+
+        return _select()
+
+
+class FolderReaper(object):
+    """
+    Deletes folders from the datastores in a greenthread of its own, so that
+    the destroy of an instance does not wait for the deletion of its files.
+    The greenthread starts a DeleteDatastoreFile_Task for each folder queued
+    and waits for the tasks together. The folders queued meanwhile are
+    deleted once those tasks are done.
+
+    The queue is kept in memory only, so the folders queued when the service
+    stops are left on the datastores, as are those whose deletion failed.
+    sweep_orphans finds them again, and is run on every pass of the image
+    cache manager.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        # Maps the datastore path of a queued or deleting folder to the
+        # event sent once it is gone
+        self._pending = {}
+        self._queued = []
+        self._reaping = False
+        # The orphaned folders found by the last sweep
+        self._orphans = set()
+
+    def reap(self, ds_path):
+        """Queue the folder for deletion."""
+        if ds_path in self._pending:
+            return
+        self._pending[ds_path] = event.Event()
+        self._queued.append(ds_path)
+        if not self._reaping:
+            self._reaping = True
+            greenthread.spawn(self._reap)
+
+    def wait_for(self, ds_path):
+        """Wait for the deletion of the folder, if it is pending."""
+        done = self._pending.get(ds_path)
+        if done is not None:
+            done.wait()
+
+    def sweep_orphans(self, datastore_selector, instance_names):
+        """
+        Queues for deletion the orphaned folders of instances on the
+        datastores of the selector. A folder is taken to be orphaned if its
+        name is that of an instance, it holds the disk spawn copies there,
+        no VM the session sees has files in it, and none of the instances
+        of this host, whose names are given, is named after it.
+
+        As the folder may be that of an instance another host sharing the
+        datastore is spawning, it is only deleted if the previous sweep
+        found it orphaned too.
+        """
+        instance_name_regex = _get_instance_name_regex()
+        vm_folders = self._get_vm_folders()
+        orphans = set()
+        for ds_name in datastore_selector.get_datastore_names():
+            ds_ref = datastore_selector.get_datastore_ref(ds_name)
+            result = search(self._session, ds_ref, "[%s]" % ds_name)
+            for file_info in getattr(result, "file", None) or []:
+                name = file_info.path
+                if (not instance_name_regex.match(name) or
+                        name in instance_names or
+                        (ds_name, name) in vm_folders):
+                    continue
+                ds_path = vm_util.build_datastore_path(ds_name, name)
+                result = search(self._session, ds_ref, ds_path,
+                                "%s.vmdk" % name)
+                if getattr(result, "file", None):
+                    orphans.add(ds_path)
+        for ds_path in sorted(orphans & self._orphans):
+            LOG.info(_("Deleting the orphaned folder %s") % ds_path)
+            self.reap(ds_path)
+        self._orphans = orphans
+
+    def _get_vm_folders(self):
+        """
+        Gets the (datastore name, folder name) of the top level folders
+        holding the files of the VMs the session sees.
+        """
+        vm_folders = set()
+
+        def _add_folder(ds_path):
+            if ds_path:
+                ds_name, path = vm_util.split_datastore_path(ds_path)
+                vm_folders.add((ds_name, path.split("/")[0]))
+
+        for vm in self._session._iter_objects("VirtualMachine",
+                ["config.files.vmPathName", "config.hardware.device"]):
+            for prop in getattr(vm, "propSet", []):
+                if prop.name == "config.files.vmPathName":
+                    _add_folder(prop.val)
+                    continue
+                devices = prop.val
+                if devices.__class__.__name__ == "ArrayOfVirtualDevice":
+                    devices = devices.VirtualDevice
+                for device in devices or []:
+                    if device.__class__.__name__ != "VirtualDisk":
+                        continue
+                    backing = device.backing
+                    while backing is not None:
+                        _add_folder(getattr(backing, "fileName", None))
+                        backing = getattr(backing, "parent", None)
+        return vm_folders
+
+    def _reap(self):
+        """Delete the queued folders until none are left."""
+        try:
+            while self._queued:
+                batch = self._queued
+                self._queued = []
+                self._delete_batch(batch)
+        finally:
+            self._reaping = False
+
+    def _delete(self, ds_path):
+        """Delete the folder, returning the error, if any."""
+        try:
+            delete_task = self._session._call_method(
+                    self._session._get_vim(),
+                    "DeleteDatastoreFile_Task",
+                    self._session._get_vim().get_service_content().fileManager,
+                    name=ds_path)
+            self._session._wait_for_task(None, delete_task)
+        except Exception, excep:
+            return excep
+
+    def _delete_batch(self, batch):
+        LOG.debug(_("Deleting %d folders from the datastores") % len(batch))
+        deletions = [(ds_path, greenthread.spawn(self._delete, ds_path))
+                     for ds_path in batch]
+        for ds_path, deletion in deletions:
+            excep = deletion.wait()
+            if excep is not None:
+                LOG.warn(_("Failed to delete the folder %(ds_path)s from "
+                           "the datastore: %(excep)s") % locals())
+            self._pending.pop(ds_path).send()
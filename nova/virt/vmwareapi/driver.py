@@ -24,25 +24,42 @@ A connection to the VMware ESX platform.
 :vmwareapi_host_ip:        IPAddress of VMware ESX server.
 :vmwareapi_host_username:  Username for connection to VMware ESX Server.
 :vmwareapi_host_password:  Password for connection to VMware ESX Server.
-:vmwareapi_task_poll_interval:  The interval (seconds) used for polling of
-                             remote tasks
-                             (default: 1.0).
+:vmwareapi_task_poll_interval:  The maximum interval (seconds) used for
+                             polling of remote tasks
+                             (default: 5.0).
+:vmwareapi_task_poll_min_interval:  The interval (seconds) the polling of
+                             remote tasks starts with
+                             (default: 0.05).
 :vmwareapi_api_retry_count:  The API retry count in case of failure such as
                              network failures (socket errors etc.)
                              (default: 10).
+:vmwareapi_api_session_pool_size:  The maximum number of sessions used for
+                             concurrent API calls
+                             (default: 4).
+:vmwareapi_max_concurrent_heavy_tasks:  The maximum number of disk
+                             copies and image transfers run at the same time
+                             (default: 2).
 
 """
 
+import contextlib
+import heapq
+import itertools
+import random
 import time
 
 from eventlet import event
+from eventlet import greenthread
+from eventlet import semaphore
 
 from nova import exception
 from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
-from nova import utils
 from nova.virt import driver
+from nova.virt.vmwareapi import call_stats
 from nova.virt.vmwareapi import error_util
+from nova.virt.vmwareapi import host
+from nova.virt.vmwareapi import inventory
 from nova.virt.vmwareapi import vim
 from nova.virt.vmwareapi import vim_util
 from nova.virt.vmwareapi import vmops
@@ -67,21 +84,72 @@ vmwareapi_opts = [
                     'vmwareapi.VMWareESXDriver.'),
     cfg.FloatOpt('vmwareapi_task_poll_interval',
                  default=5.0,
-                 help='The interval used for polling of remote tasks. '
-                       'Used only if compute_driver is '
+                 help='The maximum interval used for polling of remote '
+                       'tasks. Used only if compute_driver is '
                        'vmwareapi.VMWareESXDriver.'),
+    cfg.FloatOpt('vmwareapi_task_poll_min_interval',
+                 default=0.05,
+                 help='The interval the polling of remote tasks starts '
+                      'with. It doubles while none of the tasks finish, up '
+                      'to vmwareapi_task_poll_interval. '
+                      'Used only if compute_driver is '
+                      'vmwareapi.VMWareESXDriver.'),
     cfg.IntOpt('vmwareapi_api_retry_count',
                default=10,
                help='The number of times we retry on failures, e.g., '
                     'socket error, etc. '
                     'Used only if compute_driver is '
                     'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_api_session_pool_size',
+               default=4,
+               help='The maximum number of sessions with the ESX host '
+                    'used for making concurrent API calls. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_max_concurrent_heavy_tasks',
+               default=2,
+               help='The maximum number of disk copies and image transfers '
+                    'run at the same time on the host. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    cfg.MultiStrOpt('vmwareapi_cluster_name',
+                    default=[],
+                    help='Name of a VMware Cluster ComputeResource, managed '
+                         'as a node of the compute service. May be given '
+                         'more than once. '
+                         'Used only if compute_driver is '
+                         'vmwareapi.VMwareVCDriver.'),
     ]
 
 CONF = cfg.CONF
 CONF.register_opts(vmwareapi_opts)
 
+# The priorities the calls waiting for a session of the pool are admitted
+# in, the lowest first
+PRIORITY_READ = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# The calls admitted along with the property retrievals, ahead of the others
+POWER_METHODS = ["PowerOnVM_Task", "PowerOffVM_Task", "ResetVM_Task",
+                 "SuspendVM_Task", "RebootGuest", "ShutdownGuest"]
+# The calls moving the data of disks, admitted last
+BULK_METHODS = ["CopyVirtualDisk_Task", "MoveVirtualDisk_Task",
+                "CloneVM_Task", "RelocateVM_Task"]
+
 TIME_BETWEEN_API_CALL_RETRIES = 2.0
+MAX_TIME_BETWEEN_API_CALL_RETRIES = 60.0
+
+
+def _get_retry_delay(retry_count):
+    """
+    Gets the time to wait before the given retry of a call. The
+    delay doubles with every retry and is jittered, so that the calls which
+    failed together on an overloaded host are not retried together.
+    """
+    delay = min(TIME_BETWEEN_API_CALL_RETRIES * 2 ** (retry_count - 1),
+                MAX_TIME_BETWEEN_API_CALL_RETRIES)
+    return random.uniform(delay / 2, delay)
 
 
 class Failure(Exception):
@@ -97,6 +165,10 @@ class Failure(Exception):
 class VMwareESXDriver(driver.ComputeDriver):
     """The ESX host connection object."""
 
+    capabilities = {
+        "has_imagecache": True,
+        }
+
     def __init__(self, virtapi, read_only=False, scheme="https"):
         super(VMwareESXDriver, self).__init__(virtapi)
 
@@ -112,12 +184,19 @@ class VMwareESXDriver(driver.ComputeDriver):
 
         session = VMwareAPISession(host_ip, host_username, host_password,
                                    api_retry_count, scheme=scheme)
-        self._vmops = vmops.VMwareVMOps(session)
+        self._session = session
+        self._inventory = None
+        if CONF.vmwareapi_use_inventory_mirror:
+            self._inventory = inventory.InventoryMirror(session)
+        self._vmops = vmops.VMwareVMOps(session, self.virtapi,
+                                        self._inventory)
+        self._host_state = host.HostState(session,
+                                          self._vmops._datastore_selector)
 
     def init_host(self, host):
         """Do the initialization that needs to be done."""
-        # FIXME(sateesh): implement this
-        pass
+        if self._inventory:
+            self._inventory.start()
 
     def list_instances(self):
         """List VM instances."""
@@ -161,9 +240,19 @@ class VMwareESXDriver(driver.ComputeDriver):
         """Return info about the VM instance."""
         return self._vmops.get_info(instance)
 
+    def get_info_bulk(self, instances):
+        """Return info about several VM instances at once."""
+        return self._vmops.get_info_bulk(instances)
+
     def get_diagnostics(self, instance):
-        """Return data about VM diagnostics."""
-        return self._vmops.get_info(instance)
+        """
+        Return data about VM diagnostics, along with the stats of the calls
+        made to the host, if they are collected.
+        """
+        diagnostics = dict(self._vmops.get_info(instance))
+        if call_stats.is_enabled():
+            diagnostics.update(call_stats.get_diagnostics())
+        return diagnostics
 
     def get_console_output(self, instance):
         """Return snapshot of console."""
@@ -194,8 +283,44 @@ class VMwareESXDriver(driver.ComputeDriver):
                 'password': CONF.vmwareapi_host_password}
 
     def get_available_resource(self, nodename):
-        """This method is supported only by libvirt."""
-        return
+        """Retrieve resource info.
+
+        This method is called when nova-compute launches, and
+        as part of a periodic task, which refreshes the stats.
+
+        :param nodename: ignored in this driver
+        :returns: dictionary describing resources
+        """
+        host_stats = self._get_host_state(nodename).get_host_stats(
+                refresh=True)
+        return {'vcpus': host_stats['vcpus'],
+                'memory_mb': host_stats['host_memory_total'],
+                'local_gb': host_stats['disk_total'],
+                'vcpus_used': 0,
+                'memory_mb_used': (host_stats['host_memory_total'] -
+                                   host_stats['host_memory_free']),
+                'local_gb_used': host_stats['disk_used'],
+                'hypervisor_type': host_stats['hypervisor_type'],
+                'hypervisor_version': host_stats['hypervisor_version'],
+                'hypervisor_hostname': host_stats['hypervisor_hostname'],
+                'cpu_info': host_stats['cpu_info']}
+
+    def get_available_nodes(self):
+        """Returns the name of the host, from the stats last fetched rather
+        than refreshing them on every call."""
+        return [self._host_state.get_host_stats()['hypervisor_hostname']]
+
+    def _get_host_state(self, nodename):
+        return self._host_state
+
+    def get_host_stats(self, refresh=False):
+        """Return the current state of the host. If 'refresh' is
+        True, run the update first."""
+        return self._host_state.get_host_stats(refresh=refresh)
+
+    def manage_image_cache(self, context, all_instances):
+        """Manage the images cached on the datastores."""
+        self._vmops.manage_image_cache(context, all_instances)
 
     def plug_vifs(self, instance, network_info):
         """Plug VIFs into networks."""
@@ -206,10 +331,160 @@ class VMwareESXDriver(driver.ComputeDriver):
         self._vmops.unplug_vifs(instance, network_info)
 
 
+class VMwareVCDriver(VMwareESXDriver):
+    """
+    The vCenter connection object. Each of the clusters named by
+    vmwareapi_cluster_name is a node of the compute service. The instances
+    of a node are created in the resource pool of its cluster, DRS placing
+    and balancing them across the hosts of the cluster.
+    """
+
+    def __init__(self, virtapi, read_only=False, scheme="https"):
+        super(VMwareVCDriver, self).__init__(virtapi, read_only, scheme)
+        if not CONF.vmwareapi_cluster_name:
+            raise Exception(_("Must specify vmwareapi_cluster_name to use "
+                              "compute_driver=vmwareapi.VMwareVCDriver"))
+        clusters = {}
+        for cluster in self._session._call_method(vim_util, "get_objects",
+                                    "ClusterComputeResource", ["name"]):
+            clusters[cluster.propSet[0].val] = cluster.obj
+        # Maps the node, i.e. cluster, name to the VMwareVMOps and the
+        # HostState of the cluster
+        self._vmops_by_node = {}
+        self._host_state_by_node = {}
+        vm_ref_cache = vmops.VMRefCache()
+        for name in CONF.vmwareapi_cluster_name:
+            if name not in clusters:
+                raise exception.NovaException(_("The cluster %s was not "
+                                                "found") % name)
+            node_vmops = vmops.VMwareVMOps(self._session, self.virtapi,
+                                           self._inventory, clusters[name],
+                                           vm_ref_cache)
+            self._vmops_by_node[name] = node_vmops
+            self._host_state_by_node[name] = host.HostState(self._session,
+                    node_vmops._datastore_selector, clusters[name], name)
+        # The operations on existing instances find their VMs by name in
+        # the cache the clusters share, whichever the cluster, so they go
+        # through the VMwareVMOps of the first cluster.
+        self._vmops = self._vmops_by_node[CONF.vmwareapi_cluster_name[0]]
+
+    def _get_vmops(self, nodename):
+        if nodename not in self._vmops_by_node:
+            raise exception.NovaException(_("The node %s is not managed by "
+                                            "this compute service") %
+                                          nodename)
+        return self._vmops_by_node[nodename]
+
+    def get_available_nodes(self):
+        """Returns the names of the clusters, without refreshing their
+        stats."""
+        return list(CONF.vmwareapi_cluster_name)
+
+    def list_instances(self):
+        """List the VM instances of the resource pools of the clusters."""
+        instances = []
+        for name in CONF.vmwareapi_cluster_name:
+            instances.extend(self._vmops_by_node[name].list_instances())
+        return instances
+
+    def spawn(self, context, instance, image_meta, injected_files,
+              admin_password, network_info=None, block_device_info=None):
+        """Create VM instance in the cluster of its node."""
+        self._get_vmops(instance['node']).spawn(context, instance,
+                                                image_meta, network_info)
+
+    def destroy(self, instance, network_info, block_device_info=None):
+        """
+        Destroy VM instance, counting it against the concurrent destroys of
+        the cluster of its node.
+        """
+        node_vmops = self._vmops_by_node.get(instance['node'], self._vmops)
+        node_vmops.destroy(instance, network_info)
+
+    def _get_host_state(self, nodename):
+        self._get_vmops(nodename)
+        return self._host_state_by_node[nodename]
+
+    def get_host_stats(self, refresh=False):
+        """Return the current state of the clusters. If 'refresh' is
+        True, run the update first."""
+        return [self._host_state_by_node[name].get_host_stats(refresh=refresh)
+                for name in CONF.vmwareapi_cluster_name]
+
+    def manage_image_cache(self, context, all_instances):
+        """Manage the images cached on the datastores of the clusters."""
+        for node_vmops in self._vmops_by_node.values():
+            node_vmops.manage_image_cache(context, all_instances)
+
+
+class PooledVim(object):
+    """A VIM object logged in to the ESX host with a session of its own."""
+
+    def __init__(self, api_session):
+        self._api_session = api_session
+        self.vim = None
+        self.session_id = None
+        # Set when the connection of the VIM object may have been left in a
+        # bad state, so that it is logged in afresh before its next use.
+        self.needs_login = True
+
+    def login(self):
+        """Creates a session with the ESX host."""
+        try:
+            # Login and setup the session with the ESX host for making
+            # API calls
+            self.vim = self._api_session._get_vim_object()
+            session = self.vim.Login(
+                           self.vim.get_service_content().sessionManager,
+                           userName=self._api_session._host_username,
+                           password=self._api_session._host_password)
+            # Terminate the earlier session, if possible ( For the sake of
+            # preserving sessions as there is a limit to the number of
+            # sessions we can have )
+            if self.session_id:
+                try:
+                    self.vim.TerminateSession(
+                            self.vim.get_service_content().sessionManager,
+                            sessionId=[self.session_id])
+                except Exception, excep:
+                    # This exception is something we can live with. It is
+                    # just an extra caution on our side. The session may
+                    # have been cleared. We could have made a call to
+                    # SessionIsActive, but that is an overhead because we
+                    # anyway would have to call TerminateSession.
+                    LOG.debug(excep)
+            self.session_id = session.key
+            self.needs_login = False
+        except Exception, excep:
+            LOG.critical(_("In vmwareapi:_create_session, "
+                          "got this exception: %s") % excep)
+            raise exception.NovaException(excep)
+
+    def logout(self):
+        """Logs-out the session."""
+        try:
+            self.vim.Logout(self.vim.get_service_content().sessionManager)
+        except Exception, excep:
+            # It is just cautionary on our part to do a logout just
+            # to ensure that the session is not left active.
+            LOG.debug(excep)
+
+
 class VMwareAPISession(object):
     """
     Sets up a session with the ESX host and handles all
     the calls made to the host.
+
+    The calls are spread over a pool of up to vmwareapi_api_session_pool_size
+    VIM objects, each with a session of its own, so that concurrent calls
+    from different greenthreads do not have to share one connection. The
+    first VIM object of the pool is the one handed out by _get_vim.
+
+    The number of calls in flight is limited to the size of the pool, and
+    halved whenever the host reports an overload, growing back by one as
+    calls go through. The calls waiting for their turn are admitted by
+    priority: property retrievals and power operations first, the calls
+    moving disk data last.
     """
 
     def __init__(self, host_ip, host_username, host_password,
@@ -219,91 +494,240 @@ class VMwareAPISession(object):
         self._host_password = host_password
         self.api_retry_count = api_retry_count
         self._scheme = scheme
-        self._session_id = None
-        self.vim = None
+        self._pool_size = max(1, CONF.vmwareapi_api_session_pool_size)
+        self._pooled_vims = []
+        self._idle_vims = []
+        # The heap of the (priority, sequence number, event) of the calls
+        # waiting for a VIM object
+        self._waiters = []
+        self._waiter_count = itertools.count()
+        self._in_flight = 0
+        self._call_limit = self._pool_size
+        self._calls_since_limit_change = 0
+        self._heavy_tasks = semaphore.Semaphore(
+                max(1, CONF.vmwareapi_max_concurrent_heavy_tasks))
+        # Maps a greenthread to the VIM object all its calls go through.
+        self._pinned_vims = {}
+        # The events of the greenthreads waiting for the first VIM object
+        self._first_vim_waiters = []
+        self._task_waiter = TaskWaiter(self)
         self._create_session()
 
+    @property
+    def vim(self):
+        """The VIM object of the first session of the pool."""
+        if not self._pooled_vims:
+            return None
+        return self._pooled_vims[0].vim
+
+    @property
+    def _session_id(self):
+        """The key of the first session of the pool."""
+        if not self._pooled_vims:
+            return None
+        return self._pooled_vims[0].session_id
+
     def _get_vim_object(self):
         """Create the VIM Object instance."""
         return vim.Vim(protocol=self._scheme, host=self._host_ip)
 
     def _create_session(self):
-        """Creates a session with the ESX host."""
-        while True:
-            try:
-                # Login and setup the session with the ESX host for making
-                # API calls
-                self.vim = self._get_vim_object()
-                session = self.vim.Login(
-                               self.vim.get_service_content().sessionManager,
-                               userName=self._host_username,
-                               password=self._host_password)
-                # Terminate the earlier session, if possible ( For the sake of
-                # preserving sessions as there is a limit to the number of
-                # sessions we can have )
-                if self._session_id:
-                    try:
-                        self.vim.TerminateSession(
-                                self.vim.get_service_content().sessionManager,
-                                sessionId=[self._session_id])
-                    except Exception, excep:
-                        # This exception is something we can live with. It is
-                        # just an extra caution on our side. The session may
-                        # have been cleared. We could have made a call to
-                        # SessionIsActive, but that is an overhead because we
-                        # anyway would have to call TerminateSession.
-                        LOG.debug(excep)
-                self._session_id = session.key
-                return
-            except Exception, excep:
-                LOG.critical(_("In vmwareapi:_create_session, "
-                              "got this exception: %s") % excep)
-                raise exception.NovaException(excep)
+        """Creates the first session of the pool with the ESX host."""
+        if not self._pooled_vims:
+            pooled_vim = PooledVim(self)
+            self._pooled_vims.append(pooled_vim)
+            self._idle_vims.append(pooled_vim)
+        self._pooled_vims[0].login()
 
     def __del__(self):
-        """Logs-out the session."""
+        """Logs-out the sessions."""
         # Logout to avoid un-necessary increase in session count at the
         # ESX host
-        try:
-            self.vim.Logout(self.vim.get_service_content().sessionManager)
-        except Exception, excep:
-            # It is just cautionary on our part to do a logout in del just
-            # to ensure that the session is not left active.
-            LOG.debug(excep)
+        for pooled_vim in self._pooled_vims:
+            pooled_vim.logout()
 
     def _is_vim_object(self, module):
         """Check if the module is a VIM Object instance."""
         return isinstance(module, vim.Vim)
 
+    def _checkout_vim(self, priority=PRIORITY_NORMAL):
+        """
+        Gets an idle VIM object of the pool, logging in a new one if all of
+        them are busy and the pool is not full yet. If as many calls as
+        the limit are in flight already, waits for its turn, the waiting
+        calls being admitted by priority.
+        """
+        if self._waiters or self._in_flight >= self._call_limit:
+            waiter = event.Event()
+            heapq.heappush(self._waiters,
+                           (priority, self._waiter_count.next(), waiter))
+            # Counted in flight by _admit
+            pooled_vim = waiter.wait()
+        else:
+            self._in_flight += 1
+            pooled_vim = self._get_idle_vim()
+        self._login_checked_out_vim(pooled_vim)
+        return pooled_vim
+
+    def _checkout_first_vim(self):
+        """
+        Gets the first VIM object of the pool, for the state kept in its
+        session such as the property filter of the inventory mirror. If it
+        is in use, waits for it to be checked in, ahead of the calls
+        waiting for their turn, so that it is never shared.
+        """
+        pooled_vim = self._pooled_vims[0]
+        if pooled_vim in self._idle_vims:
+            self._idle_vims.remove(pooled_vim)
+            self._in_flight += 1
+        else:
+            waiter = event.Event()
+            self._first_vim_waiters.append(waiter)
+            # Handed over by _checkin_vim, still counted in flight
+            waiter.wait()
+        self._login_checked_out_vim(pooled_vim)
+        return pooled_vim
+
+    def _login_checked_out_vim(self, pooled_vim):
+        """Logs in the VIM object checked out, if it needs to be."""
+        if pooled_vim.needs_login:
+            try:
+                pooled_vim.login()
+            except Exception:
+                self._checkin_vim(pooled_vim)
+                raise
+
+    def _get_idle_vim(self):
+        """Gets an idle VIM object, adding one to the pool if none is
+        idle."""
+        if self._idle_vims:
+            return self._idle_vims.pop()
+        pooled_vim = PooledVim(self)
+        self._pooled_vims.append(pooled_vim)
+        return pooled_vim
+
+    def _checkin_vim(self, pooled_vim):
+        """Returns a VIM object to the pool."""
+        if pooled_vim is self._pooled_vims[0] and self._first_vim_waiters:
+            self._first_vim_waiters.pop(0).send(pooled_vim)
+            return
+        self._idle_vims.append(pooled_vim)
+        self._in_flight -= 1
+        self._admit()
+
+    def _admit(self):
+        """Admits the waiting calls the limit leaves room for."""
+        while self._waiters and self._in_flight < self._call_limit:
+            priority, count, waiter = heapq.heappop(self._waiters)
+            self._in_flight += 1
+            waiter.send(self._get_idle_vim())
+
+    def _note_call_outcome(self, overloaded):
+        """
+        Halves the limit of the calls in flight on an overload of the host,
+        and raises it by one for every limit calls going through since.
+        """
+        if overloaded:
+            self._call_limit = max(1, self._call_limit / 2)
+            self._calls_since_limit_change = 0
+        elif self._call_limit < self._pool_size:
+            self._calls_since_limit_change += 1
+            if self._calls_since_limit_change >= self._call_limit:
+                self._call_limit += 1
+                self._calls_since_limit_change = 0
+                self._admit()
+
+    @contextlib.contextmanager
+    def _heavy_task(self):
+        """
+        Holds one of the vmwareapi_max_concurrent_heavy_tasks slots for a
+        disk copy or an image transfer for the duration of the block.
+        """
+        with self._heavy_tasks:
+            yield
+
+    @contextlib.contextmanager
+    def _pinned_vim(self, first=False, priority=PRIORITY_NORMAL):
+        """
+        Makes all the calls of the current greenthread within the block go
+        through the same VIM object, as needed for state that lives in a
+        session such as property filters. An idle VIM object is checked out
+        of the pool for the block, with the priority given, unless first is
+        set, in which case the first VIM object of the pool is checked out.
+        """
+        current = greenthread.getcurrent()
+        if current in self._pinned_vims:
+            yield self._pinned_vims[current]
+            return
+        if first:
+            pooled_vim = self._checkout_first_vim()
+        else:
+            pooled_vim = self._checkout_vim(priority)
+        self._pinned_vims[current] = pooled_vim
+        try:
+            yield pooled_vim
+        finally:
+            del self._pinned_vims[current]
+            self._checkin_vim(pooled_vim)
+
     def _call_method(self, module, method, *args, **kwargs):
         """
         Calls a method within the module specified with
         args provided.
         """
+        priority = self._get_call_priority(module, method)
+        with self._pinned_vim(priority=priority) as pooled_vim:
+            return self._call_method_with_vim(pooled_vim, module, method,
+                                              args, kwargs)
+
+    def _get_call_priority(self, module, method):
+        """Gets the priority the call is admitted with."""
+        if not self._is_vim_object(module) or method in POWER_METHODS:
+            # The vim_util functions retrieve properties
+            return PRIORITY_READ
+        if method in BULK_METHODS:
+            return PRIORITY_BULK
+        return PRIORITY_NORMAL
+
+    def _call_method_with_vim(self, pooled_vim, module, method, args, kwargs):
+        """Calls the method through the given VIM object of the pool."""
         args = list(args)
         retry_count = 0
         exc = None
         last_fault_list = []
+        record_stats = call_stats.is_enabled()
+        if record_stats and not self._is_vim_object(module):
+            stats_method = "%s.%s" % (module.__name__.split(".")[-1], method)
+        else:
+            stats_method = method
         while True:
+            start = record_stats and time.time()
+            outcome = call_stats.OUTCOME_ERROR
             try:
-                if not self._is_vim_object(module):
+                if self._is_vim_object(module):
+                    temp_module = pooled_vim.vim
+                else:
                     # If it is not the first try, then get the latest
                     # vim object
                     if retry_count > 0:
                         args = args[1:]
-                    args = [self.vim] + args
+                    args = [pooled_vim.vim] + args
+                    temp_module = module
                 retry_count += 1
-                temp_module = module
 
                 for method_elem in method.split("."):
                     temp_module = getattr(temp_module, method_elem)
 
-                return temp_module(*args, **kwargs)
+                result = temp_module(*args, **kwargs)
+                outcome = call_stats.OUTCOME_OK
+                self._note_call_outcome(False)
+                return result
             except error_util.VimFaultException, excep:
                 # If it is a Session Fault Exception, it may point
                 # to a session gone bad. So we try re-creating a session
                 # and then proceeding ahead with the call.
                 exc = excep
+                outcome = call_stats.OUTCOME_FAULT
                 if error_util.FAULT_NOT_AUTHENTICATED in excep.fault_list:
                     # Because of the idle session returning an empty
                     # RetrievePropertiesResponse and also the same is returned
@@ -317,7 +741,10 @@ class VMwareAPISession(object):
                     if error_util.FAULT_NOT_AUTHENTICATED in last_fault_list:
                         return []
                     last_fault_list = excep.fault_list
-                    self._create_session()
+                    pooled_vim.login()
+                    # No need to back off for a call made with a fresh
+                    # session
+                    continue
                 else:
                     # No re-trying for errors for API call has gone through
                     # and is the caller's fault. Caller should handle these
@@ -327,22 +754,61 @@ class VMwareAPISession(object):
                 # For exceptions which may come because of session overload,
                 # we retry
                 exc = excep
+                outcome = call_stats.OUTCOME_OVERLOAD
+                self._note_call_outcome(True)
             except Exception, excep:
                 # If it is a proper exception, say not having furnished
                 # proper data in the SOAP call or the retry limit having
                 # exceeded, we raise the exception
                 exc = excep
                 break
+            finally:
+                if record_stats:
+                    call_stats.record_call(stats_method, time.time() - start,
+                                           outcome, retry=retry_count > 1)
             # If retry count has been reached then break and
             # raise the exception
             if retry_count > self.api_retry_count:
+                # The connection may be left in a bad state by the
+                # overload, so have it set up afresh before its next use
+                pooled_vim.needs_login = True
                 break
-            time.sleep(TIME_BETWEEN_API_CALL_RETRIES)
+            time.sleep(_get_retry_delay(retry_count))
 
         LOG.critical(_("In vmwareapi:_call_method, "
                      "got this exception: %s") % exc)
         raise
 
+    def _iter_objects(self, obj_type, properties_to_collect=None):
+        """
+        Gets the objects of the type specified one at a time, retrieving
+        them from the host a page at a time so that only a page is held in
+        memory. The pages are retrieved through the same session, as the
+        tokens of a paged retrieval are valid only within it.
+        """
+        with self._pinned_vim(priority=PRIORITY_READ):
+            result = self._call_method(vim_util, "retrieve_objects",
+                                       obj_type, properties_to_collect)
+            token = None
+            try:
+                while result:
+                    token = getattr(result, "token", None)
+                    for obj in result.objects:
+                        yield obj
+                    if not token:
+                        break
+                    result = self._call_method(vim_util,
+                                               "continue_retrieval", token)
+                    token = None
+            finally:
+                if token:
+                    # The caller stopped before the last page
+                    try:
+                        self._call_method(vim_util, "cancel_retrieval",
+                                          token)
+                    except Exception, excep:
+                        LOG.debug(excep)
+
     def _get_vim(self):
         """Gets the VIM object reference."""
         if self.vim is None:
@@ -351,37 +817,97 @@ class VMwareAPISession(object):
 
     def _wait_for_task(self, instance_uuid, task_ref):
         """
-        Return a Deferred that will give the result of the given task.
-        The task is polled until it completes.
+        Wait for the given task to complete. On success the task info is
+        returned, whose result holds the output of the task, if any.
         """
-        done = event.Event()
-        loop = utils.LoopingCall(self._poll_task, instance_uuid, task_ref,
-                                      done)
-        loop.start(CONF.vmwareapi_task_poll_interval)
-        ret_val = done.wait()
-        loop.stop()
-        return ret_val
-
-    def _poll_task(self, instance_uuid, task_ref, done):
+        task_info = self._wait_for_task_completion(task_ref)
+        task_name = task_info.name
+        if task_info.state == 'success':
+            LOG.debug(_("Task [%(task_name)s] %(task_ref)s "
+                        "status: success") % locals())
+            return task_info
+        error_info = str(task_info.error.localizedMessage)
+        LOG.warn(_("Task [%(task_name)s] %(task_ref)s "
+                  "status: error %(error_info)s") % locals())
+        raise exception.NovaException(error_info)
+
+    def _wait_for_task_completion(self, task_ref):
         """
-        Poll the given task, and fires the given Deferred if we
-        get a result.
+        Wait for the given task to leave the queued and running states and
+        return its task info, whatever the final state.
         """
+        return self._task_waiter.wait(task_ref)
+
+
+class TaskWaiter(object):
+    """
+    Waits for the tasks of a session to complete. A single poller fetches
+    the info of all the outstanding tasks in one call and wakes up the
+    waiters of the tasks which are done. The poll interval starts at
+    vmwareapi_task_poll_min_interval and doubles, up to
+    vmwareapi_task_poll_interval, for as long as none of the tasks finish.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        # Maps the task reference key to (task reference, event)
+        self._tasks = {}
+        self._polling = False
+
+    def wait(self, task_ref):
+        """Wait for the task to complete and return its task info."""
+        key = vim_util.get_mo_ref_key(task_ref)
+        if key not in self._tasks:
+            self._tasks[key] = (task_ref, event.Event())
+        done = self._tasks[key][1]
+        if not self._polling:
+            self._polling = True
+            greenthread.spawn(self._poll)
+        return done.wait()
+
+    def _poll(self):
+        """Poll the outstanding tasks until there are none left."""
+        interval = CONF.vmwareapi_task_poll_min_interval
         try:
-            task_info = self._call_method(vim_util, "get_dynamic_property",
-                            task_ref, "Task", "info")
-            task_name = task_info.name
-            if task_info.state in ['queued', 'running']:
-                return
-            elif task_info.state == 'success':
-                LOG.debug(_("Task [%(task_name)s] %(task_ref)s "
-                            "status: success") % locals())
-                done.send("success")
-            else:
-                error_info = str(task_info.error.localizedMessage)
-                LOG.warn(_("Task [%(task_name)s] %(task_ref)s "
-                          "status: error %(error_info)s") % locals())
-                done.send_exception(exception.NovaException(error_info))
+            while self._tasks:
+                if self._poll_tasks():
+                    interval = CONF.vmwareapi_task_poll_min_interval
+                else:
+                    interval = min(interval * 2,
+                                   CONF.vmwareapi_task_poll_interval)
+                if self._tasks:
+                    greenthread.sleep(interval)
+        finally:
+            self._polling = False
+
+    def _poll_tasks(self):
+        """
+        Fetch the info of the outstanding tasks and fire the events of the
+        ones which are done. Returns the number of tasks done.
+        """
+        tasks = self._tasks.items()
+        try:
+            task_props = self._session._call_method(vim_util,
+                            "get_properties_for_a_collection_of_objects",
+                            "Task", [task_ref for key, (task_ref, done)
+                                     in tasks], ["info"])
         except Exception, excep:
-            LOG.warn(_("In vmwareapi:_poll_task, Got this error %s") % excep)
-            done.send_exception(excep)
+            LOG.warn(_("In vmwareapi:TaskWaiter:_poll_tasks, "
+                       "got this error %s") % excep)
+            for key, (task_ref, done) in tasks:
+                del self._tasks[key]
+                done.send_exception(excep)
+            return len(tasks)
+
+        num_done = 0
+        for task_prop in task_props:
+            key = vim_util.get_mo_ref_key(task_prop.obj)
+            if key not in self._tasks:
+                continue
+            task_info = task_prop.propSet[0].val
+            if task_info.state in ['queued', 'running']:
+                continue
+            task_ref, done = self._tasks.pop(key)
+            done.send(task_info)
+            num_done += 1
+        return num_done
@@ -22,6 +22,9 @@ Exception classes and SOAP response error checking module.
 
 FAULT_NOT_AUTHENTICATED = "NotAuthenticated"
 FAULT_ALREADY_EXISTS = "AlreadyExists"
+FAULT_MANAGED_OBJECT_NOT_FOUND = "ManagedObjectNotFound"
+FAULT_FILE_ALREADY_EXISTS = "FileAlreadyExists"
+FAULT_DUPLICATE_NAME = "DuplicateName"
 
 
 class VimException(Exception):
@@ -94,3 +97,15 @@ class FaultCheckers(object):
             raise VimFaultException(fault_list, Exception(_("Error(s) %s "
                     "occurred in the call to RetrieveProperties") %
                     exc_msg_list))
+
+    @staticmethod
+    def retrievepropertiesex_fault_checker(resp_obj):
+        """
+        Checks the RetrievePropertiesEx response for errors. The faults are
+        reported the same way as for RetrieveProperties, and an empty
+        response is as ambiguous.
+        """
+        obj_contents = None
+        if resp_obj:
+            obj_contents = getattr(resp_obj, "objects", None)
+        FaultCheckers.retrieveproperties_fault_checker(obj_contents)
@@ -17,23 +17,43 @@
 
 """
 A fake VMWare VI API implementation.
+
+Besides faking the calls for the unit tests, the fake can simulate a host
+for benchmarks of the driver: it counts the calls made to it, can delay
+each call and the completion of the tasks, and can fail calls with a
+SessionOverLoadException as an overloaded host would.
 """
 
+import fnmatch
 import pprint
+import time
 import uuid
 
+from eventlet import greenthread
+
 from nova import exception
 from nova.openstack.common import log as logging
 from nova.virt.vmwareapi import error_util
 
 _CLASSES = ['Datacenter', 'Datastore', 'ResourcePool', 'VirtualMachine',
             'Network', 'HostSystem', 'HostNetworkSystem', 'Task', 'session',
-            'files']
+            'files', 'PropertyFilter', 'ClusterComputeResource']
 
 _FAKE_FILE_SIZE = 1024
 
 _db_content = {}
 
+# The version of the property collector data, as reported by
+# WaitForUpdatesEx. Bumped on every call that reports changes.
+_update_version = 0
+
+# The settings of the simulation, as set by simulate(), and the number of
+# calls made to the fake by method name
+_call_latency = 0
+_task_duration = 0
+_overload_faults = 0
+_call_counts = {}
+
 LOG = logging.getLogger(__name__)
 
 
@@ -45,7 +65,11 @@ def log_db_contents(msg=None):
 
 
 def reset():
-    """Resets the db contents."""
+    """Resets the db contents and the simulation settings."""
+    global _update_version
+    _update_version = 0
+    simulate()
+    reset_call_counts()
     for c in _CLASSES:
         # We fake the datastore by keeping the file references as a list of
         # names in the db
@@ -61,6 +85,41 @@ def reset():
     create_res_pool()
 
 
+def simulate(call_latency=0, task_duration=0, overload_faults=0):
+    """
+    Sets up the simulation of a real host. Each call takes call_latency
+    seconds, the tasks take task_duration seconds to complete, and the next
+    overload_faults calls fail with a SessionOverLoadException.
+    """
+    global _call_latency, _task_duration, _overload_faults
+    _call_latency = call_latency
+    _task_duration = task_duration
+    _overload_faults = overload_faults
+
+
+def reset_call_counts():
+    """Resets the counts of the calls made."""
+    _call_counts.clear()
+
+
+def get_call_counts():
+    """Gets the number of calls made since the last reset, by method."""
+    return dict(_call_counts)
+
+
+def _simulate_call(method):
+    """Counts the call and delays or fails it as set up by simulate()."""
+    global _overload_faults
+    _call_counts[method] = _call_counts.get(method, 0) + 1
+    if _call_latency:
+        greenthread.sleep(_call_latency)
+    if _overload_faults > 0:
+        _overload_faults -= 1
+        raise error_util.SessionOverLoadException(
+                _("Simulated error in %s: ") % method,
+                _("The host is overloaded"))
+
+
 def cleanup():
     """Clear the db contents."""
     for c in _CLASSES:
@@ -138,6 +197,89 @@ class DataObject(object):
     pass
 
 
+class ManagedObjectReference(str):
+    """
+    Managed Object Reference class. Compares equal to the plain string
+    references used elsewhere in the fake, but also carries the type of
+    the object like the references returned by the VI SDK do.
+    """
+
+    def __new__(cls, value, obj_type):
+        mo_ref = str.__new__(cls, value)
+        mo_ref.value = value
+        mo_ref._type = obj_type
+        return mo_ref
+
+
+class PropertyFilter(object):
+    """
+    Property filter class. Keeps the state of the objects last reported to
+    the client so that WaitForUpdatesEx returns just the changes.
+    """
+
+    def __init__(self, spec):
+        self.obj = str(uuid.uuid4())
+        self.spec = spec
+        self.reported = {}
+
+    def _get_current_state(self):
+        """Gets the watched properties of the watched objects."""
+        state = {}
+        for prop_spec in self.spec.propSet:
+            obj_type = prop_spec.type
+            for mdo in _db_content.get(obj_type, {}).values():
+                props = {}
+                for prop in prop_spec.pathSet:
+                    try:
+                        props[prop] = mdo.get(prop)
+                    except exception.NovaException:
+                        # Unset properties are not reported by the VI SDK
+                        continue
+                state[mdo.obj] = (obj_type, props)
+        return state
+
+    def get_updates(self):
+        """Gets the object updates since the state was last reported."""
+        current = self._get_current_state()
+        obj_updates = []
+        for obj_ref, (obj_type, props) in current.iteritems():
+            if obj_ref not in self.reported:
+                kind = "enter"
+                old_props = {}
+            else:
+                kind = "modify"
+                old_props = self.reported[obj_ref][1]
+            change_set = []
+            for name, val in props.iteritems():
+                if name not in old_props or old_props[name] != val:
+                    change = DataObject()
+                    change.name = name
+                    change.op = "assign"
+                    change.val = val
+                    change_set.append(change)
+            for name in old_props:
+                if name not in props:
+                    change = DataObject()
+                    change.name = name
+                    change.op = "remove"
+                    change_set.append(change)
+            if kind == "enter" or change_set:
+                obj_update = DataObject()
+                obj_update.kind = kind
+                obj_update.obj = ManagedObjectReference(obj_ref, obj_type)
+                obj_update.changeSet = change_set
+                obj_updates.append(obj_update)
+        for obj_ref, (obj_type, props) in self.reported.iteritems():
+            if obj_ref not in current:
+                obj_update = DataObject()
+                obj_update.kind = "leave"
+                obj_update.obj = ManagedObjectReference(obj_ref, obj_type)
+                obj_update.changeSet = []
+                obj_updates.append(obj_update)
+        self.reported = current
+        return obj_updates
+
+
 class VirtualDisk(DataObject):
     """
     Virtual Disk class. Does nothing special except setting
@@ -180,29 +322,56 @@ class VirtualMachine(ManagedObject):
         self.set("config.hardware.device", kwargs.get("virtual_disk", None))
         self.set("config.extraConfig", kwargs.get("extra_config", None))
 
+    def attach_disk(self, device_changes):
+        """
+        Sets the disk in the device changes, if there is one, as the disk of
+        the Virtual Machine. Returns whether there was one.
+        """
+        disk_changes = [change for change in device_changes
+                        if hasattr(change.device, "capacityInKB")]
+        if not disk_changes:
+            return False
+        controller_key = disk_changes[0].device.controllerKey
+        backing = disk_changes[0].device.backing
+        filename = backing.fileName
+
+        disk = VirtualDisk()
+        disk.controllerKey = controller_key
+
+        disk_backing = VirtualDiskFlatVer2BackingInfo()
+        disk_backing.fileName = filename
+        disk_backing.key = -101
+        disk.backing = disk_backing
+
+        parent = getattr(backing, "parent", None)
+        if parent is not None:
+            # Case of a linked clone. The delta disk is created in the
+            # folder of the VM.
+            if parent.fileName not in _db_content.get("files"):
+                raise exception.FileNotFound(file_path=parent.fileName)
+            ds_name = self.get("config.files.vmPathName").split("]")[0]
+            disk_backing.fileName = "%s] %s/%s.vmdk" % (ds_name,
+                    self.get("name"), self.get("name"))
+            disk_backing.parent = VirtualDiskFlatVer2BackingInfo()
+            disk_backing.parent.fileName = parent.fileName
+            _add_file(disk_backing.fileName)
+            _add_file(disk_backing.fileName.replace(".vmdk", "-delta.vmdk"))
+        elif filename not in _db_content.get("files"):
+            raise exception.FileNotFound(file_path=filename)
+
+        controller = VirtualLsiLogicController()
+        controller.key = controller_key
+
+        self.set("config.hardware.device", [disk, controller])
+        return True
+
     def reconfig(self, factory, val):
         """
         Called to reconfigure the VM. Actually customizes the property
         setting of the Virtual Machine object.
         """
-        try:
-            # Case of Reconfig of VM to attach disk
-            controller_key = val.deviceChange[1].device.controllerKey
-            filename = val.deviceChange[1].device.backing.fileName
-
-            disk = VirtualDisk()
-            disk.controllerKey = controller_key
-
-            disk_backing = VirtualDiskFlatVer2BackingInfo()
-            disk_backing.fileName = filename
-            disk_backing.key = -101
-            disk.backing = disk_backing
-
-            controller = VirtualLsiLogicController()
-            controller.key = controller_key
-
-            self.set("config.hardware.device", [disk, controller])
-        except AttributeError:
+        # Case of Reconfig of VM to attach disk
+        if not self.attach_disk(getattr(val, "deviceChange", [])):
             # Case of Reconfig of VM to set extra params
             self.set("config.extraConfig", val.extraConfig)
 
@@ -221,15 +390,23 @@ class ResourcePool(ManagedObject):
     def __init__(self):
         super(ResourcePool, self).__init__("ResourcePool")
         self.set("name", "ResPool")
+        vm_do = DataObject()
+        vm_do.ManagedObjectReference = []
+        self.set("vm", vm_do)
 
 
 class Datastore(ManagedObject):
     """Datastore class."""
 
-    def __init__(self):
+    def __init__(self, name="fake-ds", capacity=1024 ** 4,
+                 free=500 * 1024 ** 3):
         super(Datastore, self).__init__("Datastore")
         self.set("summary.type", "VMFS")
-        self.set("summary.name", "fake-ds")
+        self.set("summary.name", name)
+        self.set("summary.capacity", capacity)
+        self.set("summary.freeSpace", free)
+        self.set("summary.accessible", True)
+        self.set("browser", "HostDatastoreBrowser")
 
 
 class HostNetworkSystem(ManagedObject):
@@ -251,9 +428,9 @@ class HostNetworkSystem(ManagedObject):
 class HostSystem(ManagedObject):
     """Host System class."""
 
-    def __init__(self):
+    def __init__(self, name="ha-host"):
         super(HostSystem, self).__init__("HostSystem")
-        self.set("name", "ha-host")
+        self.set("name", name)
         if _db_content.get("HostNetworkSystem", None) is None:
             create_host_network_system()
         host_net_key = _db_content["HostNetworkSystem"].keys()[0]
@@ -264,9 +441,23 @@ class HostSystem(ManagedObject):
             create_network()
         net_ref = _db_content["Network"][_db_content["Network"].keys()[0]].obj
         network_do = DataObject()
-        network_do.ManagedObjectReference = [net_ref]
+        network_do.ManagedObjectReference = [ManagedObjectReference(net_ref,
+                                                                    "Network")]
         self.set("network", network_do)
 
+        pnic_do = DataObject()
+        pnic_do.device = "vmnic0"
+        pnic_do.key = "key-vim.host.PhysicalNic-vmnic0"
+
+        net_info_pnic = DataObject()
+        net_info_pnic.PhysicalNic = [pnic_do]
+        self.set("config.network.pnic", net_info_pnic)
+
+        datastore_do = DataObject()
+        datastore_do.ManagedObjectReference = list(
+                                        _db_content.get("Datastore", {}))
+        self.set("datastore", datastore_do)
+
         vswitch_do = DataObject()
         vswitch_do.pnic = ["vmnic0"]
         vswitch_do.name = "vSwitch0"
@@ -278,6 +469,7 @@ class HostSystem(ManagedObject):
 
         host_pg_do = DataObject()
         host_pg_do.key = "PortGroup-vmnet0"
+        host_pg_do.vswitch = "key-vim.host.VirtualSwitch-vSwitch0"
 
         pg_spec = DataObject()
         pg_spec.vlanId = 0
@@ -289,6 +481,28 @@ class HostSystem(ManagedObject):
         host_pg.HostPortGroup = [host_pg_do]
         self.set("config.network.portgroup", host_pg)
 
+        hardware = DataObject()
+        hardware.vendor = "Intel"
+        hardware.cpuModel = "Intel(R) Xeon(R)"
+        hardware.cpuMhz = 2600
+        hardware.numCpuPkgs = 2
+        hardware.numCpuCores = 8
+        hardware.numCpuThreads = 16
+        hardware.memorySize = 64 * 1024 ** 3
+        self.set("summary.hardware", hardware)
+
+        quick_stats = DataObject()
+        quick_stats.overallCpuUsage = 1300
+        quick_stats.overallMemoryUsage = 4096
+        self.set("summary.quickStats", quick_stats)
+
+        product = DataObject()
+        product.name = "VMware ESXi"
+        product.version = "5.0.0"
+        self.set("summary.config.name", name)
+        self.set("summary.config.product", product)
+        self.set("summary.runtime.connectionState", "connected")
+
     def _add_port_group(self, spec):
         """Adds a port group to the host system object in the db."""
         pg_name = spec.name
@@ -305,6 +519,7 @@ class HostSystem(ManagedObject):
 
         host_pg_do = DataObject()
         host_pg_do.key = "PortGroup-%s" % pg_name
+        host_pg_do.vswitch = "key-vim.host.VirtualSwitch-%s" % vswitch_name
 
         pg_spec = DataObject()
         pg_spec.vlanId = vlanid
@@ -315,6 +530,24 @@ class HostSystem(ManagedObject):
         host_pgrps.append(host_pg_do)
 
 
+class ClusterComputeResource(ManagedObject):
+    """Cluster Compute Resource class."""
+
+    def __init__(self, name, res_pool_ref, host_refs, ds_refs, dc_ref):
+        super(ClusterComputeResource, self).__init__("ClusterComputeResource")
+        self.set("name", name)
+        self.set("resourcePool", res_pool_ref)
+        self.set("parent", ManagedObjectReference(dc_ref, "Datacenter"))
+
+        host_do = DataObject()
+        host_do.ManagedObjectReference = host_refs
+        self.set("host", host_do)
+
+        datastore_do = DataObject()
+        datastore_do.ManagedObjectReference = ds_refs
+        self.set("datastore", datastore_do)
+
+
 class Datacenter(ManagedObject):
     """Datacenter class."""
 
@@ -331,15 +564,33 @@ class Datacenter(ManagedObject):
 
 
 class Task(ManagedObject):
-    """Task class."""
+    """
+    Task class. If a task duration is simulated, a task created in a final
+    state is reported as running until the duration has passed.
+    """
 
-    def __init__(self, task_name, state="running"):
+    def __init__(self, task_name, state="running", result=None, error=None):
         super(Task, self).__init__("Task")
-        info = DataObject
+        info = DataObject()
         info.name = task_name
         info.state = state
+        info.result = result
+        info.error = error
+        if _task_duration and state not in ["queued", "running"]:
+            info.state = "running"
+            object.__setattr__(self, "_final_state", state)
+            object.__setattr__(self, "_done_at",
+                               time.time() + _task_duration)
         self.set("info", info)
 
+    def get(self, attr):
+        info = super(Task, self).get("info")
+        if (attr == "info" and info.state == "running" and
+                "_done_at" in self.__dict__ and
+                time.time() >= self.__dict__["_done_at"]):
+            info.state = self.__dict__["_final_state"]
+        return super(Task, self).get(attr)
+
 
 def create_host_network_system():
     host_net_system = HostNetworkSystem()
@@ -356,14 +607,55 @@ def create_datacenter():
     _create_object('Datacenter', data_center)
 
 
-def create_datastore():
-    data_store = Datastore()
+def create_datastore(**kwargs):
+    data_store = Datastore(**kwargs)
     _create_object('Datastore', data_store)
+    for host_system in _db_content["HostSystem"].values():
+        host_system.get("datastore").ManagedObjectReference.append(
+                                                        data_store.obj)
 
 
 def create_res_pool():
     res_pool = ResourcePool()
     _create_object('ResourcePool', res_pool)
+    return res_pool
+
+
+def create_cluster(name):
+    """
+    Creates a cluster of one host, with a resource pool and a datastore of
+    its own, named after the cluster, in the first datacenter.
+    """
+    data_store = Datastore(name="%s-ds" % name)
+    _create_object('Datastore', data_store)
+    host_system = HostSystem(name="%s-host" % name)
+    host_system.get("datastore").ManagedObjectReference = [data_store.obj]
+    _create_object('HostSystem', host_system)
+    res_pool = create_res_pool()
+    cluster = ClusterComputeResource(name, res_pool.obj, [host_system.obj],
+                                     [data_store.obj],
+                                     _db_content["Datacenter"].keys()[0])
+    _create_object('ClusterComputeResource', cluster)
+    return cluster
+
+
+def create_vms(count, power_state="poweredOn"):
+    """
+    Registers count VMs, named vm-<index>, with their files on the first
+    datastore, to simulate a populated host.
+    """
+    ds = _db_content["Datastore"].values()[0]
+    ds_name = ds.get("summary.name")
+    vm_refs = []
+    for index in xrange(count):
+        name = "vm-%d" % index
+        vmx_path = "[%s] %s/%s.vmx" % (ds_name, name, name)
+        vm = VirtualMachine(name=name, ds=ds, powerstate=power_state,
+                            vmPathName=vmx_path)
+        _create_object("VirtualMachine", vm)
+        _add_file("[%s] %s/%s.vmdk" % (ds_name, name, name))
+        vm_refs.append(vm.obj)
+    return vm_refs
 
 
 def create_network():
@@ -371,12 +663,23 @@ def create_network():
     _create_object('Network', network)
 
 
-def create_task(task_name, state="running"):
-    task = Task(task_name, state)
+def create_task(task_name, state="running", result=None, error=None):
+    task = Task(task_name, state, result, error)
     _create_object("Task", task)
     return task
 
 
+def create_fault_task(task_name, fault_name, message):
+    """
+    Creates a task failed with the fault. Like the faults of the VI SDK, the
+    fault object is of a class named after the type of the fault.
+    """
+    error = DataObject()
+    error.localizedMessage = message
+    error.fault = type(fault_name, (DataObject,), {})()
+    return create_task(task_name, "error", error=error)
+
+
 def _add_file(file_path):
     """Adds a file reference to the  db."""
     _db_content["files"].append(file_path)
@@ -393,7 +696,7 @@ def _remove_file(file_path):
         _db_content.get("files").remove(file_path)
     else:
         # Removes the files in the folder and the folder too from the db
-        for file in _db_content.get("files"):
+        for file in list(_db_content.get("files")):
             if file.find(file_path) != -1:
                 lst_files = _db_content.get("files")
                 if lst_files and lst_files.count(file):
@@ -418,6 +721,15 @@ def fake_fetch_image(context, image, instance, **kwargs):
     _add_file(ds_file_path)
 
 
+def fake_upload_vmdk_descriptor(context, descriptor, instance, **kwargs):
+    """Fakes the write of a vmdk descriptor. Just adds a reference to the db
+    for the file."""
+    ds_name = kwargs.get("datastore_name")
+    file_path = kwargs.get("file_path")
+    ds_file_path = "[" + ds_name + "] " + file_path
+    _add_file(ds_file_path)
+
+
 def fake_upload_image(context, image, instance, **kwargs):
     """Fakes the upload of an image."""
     pass
@@ -457,6 +769,9 @@ class FakeVim(object):
         contents and the cookies for the session.
         """
         self._session = None
+        # Maps the token of a paged retrieval to the session it was started
+        # in and the objects not yet retrieved.
+        self._retrievals = {}
         self.client = DataObject()
         self.client.factory = FakeFactory()
 
@@ -521,6 +836,13 @@ class FakeVim(object):
     def _create_vm(self, method, *args, **kwargs):
         """Creates and registers a VM object with the Host System."""
         config_spec = kwargs.get("config")
+        if [vm for vm in _db_content["VirtualMachine"].itervalues()
+                if vm.get("name") == config_spec.name]:
+            task_mdo = create_fault_task(method,
+                                         error_util.FAULT_DUPLICATE_NAME,
+                                         "The name '%s' already exists." %
+                                         config_spec.name)
+            return task_mdo.obj
         ds = _db_content["Datastore"][_db_content["Datastore"].keys()[0]]
         vm_dict = {"name": config_spec.name,
                   "ds": ds,
@@ -529,8 +851,17 @@ class FakeVim(object):
                   "numCpu": config_spec.numCPUs,
                   "mem": config_spec.memoryMB}
         virtual_machine = VirtualMachine(**vm_dict)
+        virtual_machine.attach_disk(config_spec.deviceChange)
+        virtual_machine.set("config.extraConfig",
+                            getattr(config_spec, "extraConfig", None))
+        virtual_machine.set("resourcePool", kwargs.get("pool"))
         _create_object("VirtualMachine", virtual_machine)
-        task_mdo = create_task(method, "success")
+        res_pool = _db_content["ResourcePool"].get(kwargs.get("pool"))
+        if res_pool is not None:
+            res_pool.get("vm").ManagedObjectReference.append(
+                    virtual_machine.obj)
+        task_mdo = create_task(method, "success",
+                               result=virtual_machine.obj)
         return task_mdo.obj
 
     def _reconfig_vm(self, method, *args, **kwargs):
@@ -550,6 +881,21 @@ class FakeVim(object):
         task_mdo = create_task(method, "success")
         return task_mdo.obj
 
+    def _move_disk(self, method, *args, **kwargs):
+        """Moves the .vmdk and -flat.vmdk files of a disk."""
+        source_path = kwargs.get("sourceName")
+        dest_path = kwargs.get("destName")
+        if dest_path in _db_content["files"] and not kwargs.get("force"):
+            task_mdo = create_fault_task(method,
+                                         error_util.FAULT_FILE_ALREADY_EXISTS,
+                                         "File %s already exists" % dest_path)
+            return task_mdo.obj
+        for suffix in [".vmdk", "-flat.vmdk"]:
+            _remove_file(source_path.replace(".vmdk", suffix))
+            _add_file(dest_path.replace(".vmdk", suffix))
+        task_mdo = create_task(method, "success")
+        return task_mdo.obj
+
     def _snapshot_vm(self, method):
         """Snapshots a VM. Here we do nothing for faking sake."""
         task_mdo = create_task(method, "success")
@@ -579,17 +925,48 @@ class FakeVim(object):
         vm_ref = args[0]
         _get_vm_mdo(vm_ref)
         del _db_content["VirtualMachine"][vm_ref]
+        for res_pool in _db_content["ResourcePool"].values():
+            vm_refs = res_pool.get("vm").ManagedObjectReference
+            if vm_ref in vm_refs:
+                vm_refs.remove(vm_ref)
 
     def _search_ds(self, method, *args, **kwargs):
-        """Searches the datastore for a file."""
+        """
+        Searches the folder of the datastore for the entries matching the
+        patterns of the search spec, or for all its entries if it has none.
+        """
         ds_path = kwargs.get("datastorePath")
+        match_patterns = getattr(kwargs.get("searchSpec"), "matchPattern",
+                                 None) or ["*"]
         if _db_content.get("files", None) is None:
             raise exception.NoFilesFound()
-        for file in _db_content.get("files"):
-            if file.find(ds_path) != -1:
-                task_mdo = create_task(method, "success")
-                return task_mdo.obj
-        task_mdo = create_task(method, "error")
+        files = _db_content.get("files")
+        # The entries of the root of a datastore follow "[datastore] "
+        if ds_path.endswith("]"):
+            prefix = ds_path + " "
+        else:
+            prefix = ds_path + "/"
+        # Like on the host, a file is not a folder to be searched
+        if ds_path.find(".vmdk") != -1 or not [file for file in files
+                if file == ds_path or file.startswith(prefix)]:
+            task_mdo = create_fault_task(method, "FileNotFound",
+                                         "File %s was not found" % ds_path)
+            return task_mdo.obj
+        # The result lists the names of the entries of the folder matching
+        # any of the patterns
+        result = DataObject()
+        result.file = []
+        entry_names = set()
+        for entry in files:
+            if entry.startswith(prefix):
+                entry_names.add(entry[len(prefix):].split("/")[0])
+        for entry_name in sorted(entry_names):
+            if [pattern for pattern in match_patterns
+                    if fnmatch.fnmatch(entry_name, pattern)]:
+                file_info = DataObject()
+                file_info.path = entry_name
+                result.file.append(file_info)
+        task_mdo = create_task(method, "success", result)
         return task_mdo.obj
 
     def _make_dir(self, method, *args, **kwargs):
@@ -635,18 +1012,110 @@ class FakeVim(object):
                         for prop in properties:
                             temp_mdo.set(prop, mdo.get(prop))
                         lst_ret_objs.append(temp_mdo)
-                else:
-                    if obj_ref in _db_content[type]:
-                        mdo = _db_content[type][obj_ref]
-                        temp_mdo = ManagedObject(mdo.objName, obj_ref)
+                elif getattr(obj, "skip", False):
+                    # This means that we are getting the objects the property
+                    # of the base object refers to
+                    traversal_spec = obj.selectSet[0]
+                    base_mdo = _db_content[traversal_spec.type][obj_ref]
+                    inner_refs = base_mdo.get(traversal_spec.path)
+                    for mdo_ref in inner_refs.ManagedObjectReference:
+                        mdo = _db_content[type][mdo_ref]
+                        temp_mdo = ManagedObject(mdo.objName, mdo_ref)
                         for prop in properties:
                             temp_mdo.set(prop, mdo.get(prop))
                         lst_ret_objs.append(temp_mdo)
+                else:
+                    if obj_ref not in _db_content[type]:
+                        raise error_util.VimFaultException(
+                               [error_util.FAULT_MANAGED_OBJECT_NOT_FOUND],
+                               _("The object %s has already been deleted "
+                                 "or has not been completely created")
+                               % obj_ref)
+                    mdo = _db_content[type][obj_ref]
+                    temp_mdo = ManagedObject(mdo.objName, obj_ref)
+                    for prop in properties:
+                        temp_mdo.set(prop, mdo.get(prop))
+                    lst_ret_objs.append(temp_mdo)
+            except error_util.VimFaultException:
+                raise
             except Exception, exc:
                 LOG.exception(exc)
                 continue
         return lst_ret_objs
 
+    def _retrieve_properties_ex(self, method, *args, **kwargs):
+        """Retrieves the first page of the properties based on the type."""
+        objs = self._retrieve_properties(method, *args, **kwargs)
+        return self._get_retrieve_result(objs,
+                                         kwargs.get("options").maxObjects)
+
+    def _continue_retrieve_properties_ex(self, method, *args, **kwargs):
+        """Retrieves the next page of the properties of a retrieval."""
+        token = kwargs.get("token")
+        if self._retrievals.get(token, (None,))[0] != self._session:
+            raise error_util.VimFaultException(["InvalidArgument"],
+                                    _("Invalid token %s") % token)
+        session, objs, max_objects = self._retrievals.pop(token)
+        return self._get_retrieve_result(objs, max_objects)
+
+    def _cancel_retrieve_properties_ex(self, method, *args, **kwargs):
+        """Discards the pages of a retrieval not yet retrieved."""
+        self._retrievals.pop(kwargs.get("token"), None)
+
+    def _get_retrieve_result(self, objs, max_objects):
+        """Pages the objects into a retrieve result."""
+        if not objs:
+            return None
+        result = DataObject()
+        result.objects = objs[:max_objects]
+        if len(objs) > max_objects:
+            result.token = str(uuid.uuid4())
+            self._retrievals[result.token] = (self._session,
+                                              objs[max_objects:], max_objects)
+        return result
+
+    def _create_filter(self, method, *args, **kwargs):
+        """Creates a property filter on the property collector."""
+        prop_filter = PropertyFilter(kwargs.get("spec"))
+        _create_object("PropertyFilter", prop_filter)
+        return prop_filter.obj
+
+    def _destroy_filter(self, method, *args, **kwargs):
+        """Destroys a property filter."""
+        filter_ref = args[0]
+        if filter_ref in _db_content["PropertyFilter"]:
+            del _db_content["PropertyFilter"][filter_ref]
+
+    def _wait_for_updates_ex(self, method, *args, **kwargs):
+        """
+        Reports the changes to the objects watched by the property filters
+        since the version specified. Returns at once, whatever the wait
+        options, with None if nothing has changed.
+        """
+        global _update_version
+        version = kwargs.get("version")
+        if version and version != str(_update_version):
+            raise error_util.VimFaultException(["InvalidCollectorVersion"],
+                            _("Invalid collector version %s") % version)
+        filter_updates = []
+        for prop_filter in _db_content["PropertyFilter"].values():
+            if not version:
+                prop_filter.reported = {}
+            obj_updates = prop_filter.get_updates()
+            if obj_updates:
+                filter_update = DataObject()
+                filter_update.filter = prop_filter.obj
+                filter_update.objectSet = obj_updates
+                filter_updates.append(filter_update)
+        if not filter_updates:
+            return None
+        _update_version += 1
+        update_set = DataObject()
+        update_set.version = str(_update_version)
+        update_set.filterSet = filter_updates
+        update_set.truncated = False
+        return update_set
+
     def _add_port_group(self, method, *args, **kwargs):
         """Adds a port group to the host system."""
         _host_sk = _db_content["HostSystem"].keys()[0]
@@ -654,6 +1123,18 @@ class FakeVim(object):
         host_mdo._add_port_group(kwargs.get("portgrp"))
 
     def __getattr__(self, attr_name):
+        method = self._get_method(attr_name)
+        if not callable(method):
+            return method
+
+        def _call(*args, **kwargs):
+            _simulate_call(attr_name)
+            return method(*args, **kwargs)
+
+        return _call
+
+    def _get_method(self, attr_name):
+        """Gets the fake of the method of the VI SDK."""
         if attr_name != "Login":
             self._check_session()
         if attr_name == "Login":
@@ -694,6 +1175,9 @@ class FakeVim(object):
         elif attr_name == "CopyVirtualDisk_Task":
             return lambda *args, **kwargs: self._create_copy_disk(attr_name,
                                                 kwargs.get("destName"))
+        elif attr_name == "MoveVirtualDisk_Task":
+            return lambda *args, **kwargs: self._move_disk(attr_name,
+                                                *args, **kwargs)
         elif attr_name == "DeleteVirtualDisk_Task":
             return lambda *args, **kwargs: self._delete_disk(attr_name,
                                                 *args, **kwargs)
@@ -709,6 +1193,26 @@ class FakeVim(object):
         elif attr_name == "RetrieveProperties":
             return lambda *args, **kwargs: self._retrieve_properties(
                                                 attr_name, *args, **kwargs)
+        elif attr_name == "RetrievePropertiesEx":
+            return lambda *args, **kwargs: self._retrieve_properties_ex(
+                                                attr_name, *args, **kwargs)
+        elif attr_name == "ContinueRetrievePropertiesEx":
+            return lambda *args, **kwargs: (
+                    self._continue_retrieve_properties_ex(attr_name,
+                                                          *args, **kwargs))
+        elif attr_name == "CancelRetrievePropertiesEx":
+            return lambda *args, **kwargs: (
+                    self._cancel_retrieve_properties_ex(attr_name,
+                                                        *args, **kwargs))
+        elif attr_name == "CreateFilter":
+            return lambda *args, **kwargs: self._create_filter(attr_name,
+                                                *args, **kwargs)
+        elif attr_name == "DestroyPropertyFilter":
+            return lambda *args, **kwargs: self._destroy_filter(attr_name,
+                                                *args, **kwargs)
+        elif attr_name == "WaitForUpdatesEx":
+            return lambda *args, **kwargs: self._wait_for_updates_ex(
+                                                attr_name, *args, **kwargs)
         elif attr_name == "AcquireCloneTicket":
             return lambda *args, **kwargs: self._just_return()
         elif attr_name == "AddPortGroup":
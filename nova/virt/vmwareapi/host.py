@@ -0,0 +1,157 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Management class for the stats of the ESX host.
+"""
+
+from nova.openstack.common import jsonutils
+from nova.openstack.common import log as logging
+from nova.virt.vmwareapi import vim_util
+
+LOG = logging.getLogger(__name__)
+
+HOST_PROPERTIES = ["summary.hardware", "summary.quickStats",
+                   "summary.config.name", "summary.config.product",
+                   "summary.runtime.connectionState"]
+
+# The (architecture, hypervisor type, vm mode) of the instances the host runs
+SUPPORTED_INSTANCES = [("i686", "vmware", "hvm"),
+                       ("x86_64", "vmware", "hvm")]
+
+# The hypervisor type reported while no host is connected
+DEFAULT_HYPERVISOR_TYPE = "VMware ESXi"
+
+
+def _get_version_as_int(version):
+    """Gets the version, e.g. 5.0.0, as an integer, e.g. 5000000."""
+    version_int = 0
+    for part in (version.split(".") + ["0", "0"])[:3]:
+        version_int = version_int * 1000 + int(part)
+    return version_int
+
+
+class HostState(object):
+    """
+    Manages information about the ESX host this compute node is running on,
+    or about the hosts of the cluster, if one is given, which then make up
+    the node. The stats are fetched with one retrieval of the properties of
+    the hosts, the capacities of the datastores coming from the cached
+    summaries of the datastore selector, and are kept until the next
+    refresh.
+    """
+
+    def __init__(self, session, datastore_selector, cluster=None,
+                 cluster_name=None):
+        super(HostState, self).__init__()
+        self._session = session
+        self._datastore_selector = datastore_selector
+        self._cluster = cluster
+        self._cluster_name = cluster_name
+        self._stats = {}
+
+    def get_host_stats(self, refresh=False):
+        """Return the current state of the host. If 'refresh' is
+        True, or the state has not been fetched yet, run the update first.
+        """
+        if refresh or not self._stats:
+            self.update_status()
+        return self._stats
+
+    def _get_hosts(self):
+        """Gets the properties of the hosts."""
+        if self._cluster is None:
+            hosts = self._session._call_method(vim_util, "get_objects",
+                                               "HostSystem", HOST_PROPERTIES)
+        else:
+            hosts = self._session._call_method(vim_util,
+                                "get_inner_objects", self._cluster,
+                                "ClusterComputeResource", "host",
+                                "HostSystem", HOST_PROPERTIES)
+        return [dict((prop.name, prop.val) for prop in host.propSet)
+                for host in hosts]
+
+    def _get_empty_stats(self, all_hosts):
+        """
+        Gets the stats of a node none of whose hosts is connected, which has
+        no resources to offer.
+        """
+        hostname = self._cluster_name
+        if hostname is None and all_hosts:
+            hostname = all_hosts[0].get("summary.config.name")
+        return {
+            "vcpus": 0,
+            "host_memory_total": 0,
+            "host_memory_free": 0,
+            "disk_total": 0,
+            "disk_used": 0,
+            "disk_available": 0,
+            "hypervisor_type": DEFAULT_HYPERVISOR_TYPE,
+            "hypervisor_version": 0,
+            "hypervisor_hostname": hostname,
+            "cpu_info": jsonutils.dumps({}),
+            "supported_instances": SUPPORTED_INSTANCES}
+
+    def update_status(self):
+        """Update the stats of the host, or of the hosts of the cluster,
+        from their summaries."""
+        LOG.debug(_("Updating host stats"))
+        all_hosts = self._get_hosts()
+        hosts = [props for props in all_hosts
+                 if props.get("summary.runtime.connectionState",
+                              "connected") == "connected"]
+        if not hosts:
+            # The last stats fetched are kept, so that the node does not
+            # come and go with the connection of its hosts.
+            LOG.warn(_("No connected host to get the stats of"))
+            if not self._stats:
+                self._stats = self._get_empty_stats(all_hosts)
+            return
+
+        vcpus = 0
+        memory_total = 0
+        memory_used = 0
+        for props in hosts:
+            hardware = props["summary.hardware"]
+            vcpus += hardware.numCpuThreads
+            memory_total += hardware.memorySize / (1024 * 1024)
+            memory_used += props["summary.quickStats"].overallMemoryUsage
+
+        # The CPU and the product of the first host stand for all of them
+        hardware = hosts[0]["summary.hardware"]
+        product = hosts[0]["summary.config.product"]
+        cpu_info = {"vendor": hardware.vendor,
+                    "model": hardware.cpuModel,
+                    "topology": {
+                        "sockets": hardware.numCpuPkgs,
+                        "cores": hardware.numCpuCores / hardware.numCpuPkgs,
+                        "threads": (hardware.numCpuThreads /
+                                    hardware.numCpuCores)}}
+
+        capacity, free = self._datastore_selector.get_capacity()
+        self._stats = {
+            "vcpus": vcpus,
+            "host_memory_total": memory_total,
+            "host_memory_free": memory_total - memory_used,
+            "disk_total": capacity / (1024 * 1024 * 1024),
+            "disk_used": (capacity - free) / (1024 * 1024 * 1024),
+            "disk_available": free / (1024 * 1024 * 1024),
+            "hypervisor_type": product.name,
+            "hypervisor_version": _get_version_as_int(product.version),
+            "hypervisor_hostname": (self._cluster_name or
+                                    hosts[0]["summary.config.name"]),
+            "cpu_info": jsonutils.dumps(cpu_info),
+            "supported_instances": SUPPORTED_INSTANCES}
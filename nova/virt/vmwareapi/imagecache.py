@@ -0,0 +1,349 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Image cache manager for the VMware driver.
+
+The images are downloaded from Glance once per datastore, into
+[datastore] <vmwareapi_image_cache_folder>/<image id>/<image id>.vmdk, and
+the disks of the instances are copied from there on the datastore. Cached
+images which no instance has used for a while are removed. As the datastore
+may be shared with other hosts, an image is taken to be in use as long as
+the disk of any VM the session sees sits in its cache folder or is backed
+by a disk there, and not only while the instances of this host use it.
+"""
+
+import uuid
+
+from nova import exception
+from nova.openstack.common import cfg
+from nova.openstack.common import excutils
+from nova.openstack.common import lockutils
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+from nova.virt.vmwareapi import datastore
+from nova.virt.vmwareapi import error_util
+from nova.virt.vmwareapi import vim_util
+from nova.virt.vmwareapi import vm_util
+from nova.virt.vmwareapi import vmware_images
+
+LOG = logging.getLogger(__name__)
+
+vmwareapi_imagecache_opts = [
+    cfg.StrOpt('vmwareapi_image_cache_folder',
+               default='vmware_base',
+               help='The folder on each datastore the images are cached in. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    cfg.BoolOpt('vmwareapi_remove_unused_cached_images',
+                default=True,
+                help='Should the cached images which no instance uses be '
+                     'removed? '
+                     'Used only if compute_driver is '
+                     'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_remove_unused_cached_images_minimum_age_seconds',
+               default=(24 * 3600),
+               help='The cached images unused for less than this will not '
+                    'be removed. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(vmwareapi_imagecache_opts)
+
+
+def get_image_id(image_ref):
+    """Gets the id of the image from the image reference, which may be an
+    href of the image."""
+    return str(image_ref).rsplit('/', 1)[-1]
+
+
+class ImageCacheManager(object):
+    """Keeps the images used by the instances cached on the datastores."""
+
+    def __init__(self, session, datastore_selector):
+        self._session = session
+        self._datastore_selector = datastore_selector
+        # The (datastore name, image id) of the images known to be cached
+        self._cached_images = set()
+        # Maps the (datastore name, image id) of the cached images not in use
+        # to the time they were first seen unused.
+        self._unused_since = {}
+
+    def _get_cached_folder(self, ds_name, image_id):
+        """Gets the datastore path of the cache folder of the image."""
+        return vm_util.build_datastore_path(ds_name, "%s/%s" %
+                                (CONF.vmwareapi_image_cache_folder, image_id))
+
+    def get_cached_vmdk_path(self, ds_name, image_id):
+        """Gets the datastore path of the cached vmdk of the image."""
+        return "%s/%s.vmdk" % (self._get_cached_folder(ds_name, image_id),
+                               image_id)
+
+    def _lock_name(self, ds_name, image_id):
+        return 'vmware-image-cache-%s-%s' % (ds_name, image_id)
+
+    def _wait_for_task(self, instance, task_ref):
+        self._session._wait_for_task(instance['uuid'], task_ref)
+
+    def _search_datastore(self, ds_name, ds_path, match_pattern=None):
+        """
+        Searches the folder of the datastore for the files matching the
+        pattern, or for all its entries if no pattern is given. Returns the
+        search result, or None if the folder does not exist.
+        """
+        return datastore.search(self._session,
+                        self._datastore_selector.get_datastore_ref(ds_name),
+                        ds_path, match_pattern)
+
+    def _is_image_cached(self, ds_name, image_id):
+        """Checks if the vmdk of the image is in its cache folder."""
+        result = self._search_datastore(ds_name,
+                        self._get_cached_folder(ds_name, image_id),
+                        "%s.vmdk" % image_id)
+        return bool(result is not None and getattr(result, "file", []))
+
+    def fetch_image(self, context, instance, ds_name, dc_ref, dc_name,
+                    vmdk_file_size_in_kb, adapter_type):
+        """
+        Gets the datastore path of the cached vmdk of the image of the
+        instance, downloading the image from Glance first if it is not on
+        the datastore yet. Concurrent calls for an image share one download.
+        """
+        image_id = get_image_id(instance['image_ref'])
+        cached_vmdk_path = self.get_cached_vmdk_path(ds_name, image_id)
+
+        @lockutils.synchronized(self._lock_name(ds_name, image_id), 'nova-')
+        def _fetch_image_if_missing():
+            if (ds_name, image_id) in self._cached_images:
+                return
+            if not self._is_image_cached(ds_name, image_id):
+                self._download_image(context, instance, ds_name, dc_ref,
+                                     dc_name, image_id, vmdk_file_size_in_kb,
+                                     adapter_type)
+            self._cached_images.add((ds_name, image_id))
+
+        _fetch_image_if_missing()
+        self._unused_since.pop((ds_name, image_id), None)
+        return cached_vmdk_path
+
+    def _download_image(self, context, instance, ds_name, dc_ref, dc_name,
+                        image_id, vmdk_file_size_in_kb, adapter_type):
+        """
+        Downloads the image into the cache. The disk is put together under a
+        temporary name and moved into place once complete, so that an
+        interrupted download never looks like a cached image. The files of
+        the temporary disk are deleted if the download or the move fails.
+        """
+        service_content = self._session._get_vim().get_service_content()
+        cache_folder = "%s/%s" % (CONF.vmwareapi_image_cache_folder,
+                                  image_id)
+        datastore.mkdir(self._session,
+                        vm_util.build_datastore_path(ds_name, cache_folder))
+        tmp_name = "%s/%s" % (cache_folder, uuid.uuid4())
+        tmp_vmdk_path = vm_util.build_datastore_path(ds_name,
+                                                     "%s.vmdk" % tmp_name)
+
+        LOG.debug(_("Caching image %(image_id)s on the datastore "
+                    "%(ds_name)s") % locals(), instance=instance)
+        try:
+            self._download_disk(context, instance, ds_name, dc_name,
+                                vmdk_file_size_in_kb, adapter_type, tmp_name)
+            move_task = self._session._call_method(
+                    self._session._get_vim(),
+                    "MoveVirtualDisk_Task",
+                    service_content.virtualDiskManager,
+                    sourceName=tmp_vmdk_path,
+                    sourceDatacenter=dc_ref,
+                    destName=self.get_cached_vmdk_path(ds_name, image_id),
+                    destDatacenter=dc_ref,
+                    force=False)
+            task_info = self._session._wait_for_task_completion(move_task)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                self._delete_tmp_disk(ds_name, tmp_name)
+        if task_info.state == "error":
+            self._delete_tmp_disk(ds_name, tmp_name)
+            # The image may have been cached meanwhile by another host
+            # sharing the datastore, whose copy is as good as this one.
+            fault = getattr(task_info.error, "fault", None)
+            if (fault.__class__.__name__ !=
+                    error_util.FAULT_FILE_ALREADY_EXISTS):
+                raise exception.NovaException(
+                        str(task_info.error.localizedMessage))
+            LOG.debug(_("Image %(image_id)s was cached on the datastore "
+                        "%(ds_name)s meanwhile") % locals(), instance=instance)
+            return
+        LOG.debug(_("Cached image %(image_id)s on the datastore "
+                    "%(ds_name)s") % locals(), instance=instance)
+
+    def _download_disk(self, context, instance, ds_name, dc_name,
+                       vmdk_file_size_in_kb, adapter_type, name):
+        """Downloads the image as the disk of the name on the datastore."""
+        cookies = self._session._get_vim().client.options.transport.cookiejar
+        # The descriptor of the disk is generated here rather than by
+        # creating a disk of the size of the image and deleting its data
+        # file, which costs two tasks.
+        descriptor = vm_util.get_vmdk_descriptor(vmdk_file_size_in_kb,
+                        adapter_type, "%s-flat.vmdk" % name.split("/")[-1])
+        vmware_images.upload_vmdk_descriptor(
+                context,
+                descriptor,
+                instance,
+                host=self._session._host_ip,
+                data_center_name=dc_name,
+                datastore_name=ds_name,
+                cookies=cookies,
+                file_path="%s.vmdk" % name)
+        with self._session._heavy_task():
+            vmware_images.fetch_image(
+                    context,
+                    instance['image_ref'],
+                    instance,
+                    host=self._session._host_ip,
+                    data_center_name=dc_name,
+                    datastore_name=ds_name,
+                    cookies=cookies,
+                    file_path="%s-flat.vmdk" % name)
+
+    def _delete_tmp_disk(self, ds_name, name):
+        """
+        Deletes the files of the temporary disk of the name, each on its
+        own as the disk may be incomplete, logging any failure.
+        """
+        file_manager = self._session._get_vim().get_service_content(
+                ).fileManager
+        for suffix in [".vmdk", "-flat.vmdk"]:
+            ds_path = vm_util.build_datastore_path(ds_name, name + suffix)
+            try:
+                delete_task = self._session._call_method(
+                        self._session._get_vim(),
+                        "DeleteDatastoreFile_Task",
+                        file_manager,
+                        name=ds_path)
+                self._session._wait_for_task(None, delete_task)
+            except Exception, excep:
+                LOG.warn(_("Failed to delete %(ds_path)s from the datastore: "
+                           "%(excep)s") % locals())
+
+    def _list_cached_images(self, ds_name):
+        """Gets the ids of the images cached on the datastore."""
+        result = self._search_datastore(ds_name,
+                        vm_util.build_datastore_path(ds_name,
+                                        CONF.vmwareapi_image_cache_folder))
+        if result is None:
+            return []
+        return [file_info.path for file_info in getattr(result, "file", [])]
+
+    def _get_images_in_use(self):
+        """
+        Gets the (datastore name, image id) of the cached images which the
+        disks of the VMs sit in or are backed by, following the parents of
+        the delta disks of the linked clones.
+        """
+        images_in_use = set()
+        for vm in self._session._iter_objects("VirtualMachine",
+                                              ["config.hardware.device"]):
+            for prop in getattr(vm, "propSet", []):
+                devices = prop.val
+                if devices.__class__.__name__ == "ArrayOfVirtualDevice":
+                    devices = devices.VirtualDevice
+                for device in devices or []:
+                    if device.__class__.__name__ != "VirtualDisk":
+                        continue
+                    backing = device.backing
+                    while backing is not None:
+                        image = self._get_cached_image_of_file(
+                                getattr(backing, "fileName", None))
+                        if image is not None:
+                            images_in_use.add(image)
+                        backing = getattr(backing, "parent", None)
+        return images_in_use
+
+    def _get_cached_image_of_file(self, file_path):
+        """
+        Gets the (datastore name, image id) of the cached image whose
+        folder holds the file of the datastore path, or None if the file is
+        not in the cache.
+        """
+        if not file_path:
+            return None
+        ds_name, path = vm_util.split_datastore_path(file_path)
+        cache_folder = "%s/" % CONF.vmwareapi_image_cache_folder
+        if not path.startswith(cache_folder):
+            return None
+        image_folder = path[len(cache_folder):].split("/")
+        if len(image_folder) < 2:
+            return None
+        return ds_name, image_folder[0]
+
+    def verify_base_images(self, context, all_instances):
+        """
+        Removes the cached images which no VM has used for longer than the
+        minimum age. The images of the instances of this host are taken to
+        be in use too, as they would be fetched again on a rebuild.
+        """
+        used_images = set(get_image_id(instance['image_ref'])
+                          for instance in all_instances)
+        images_in_use = self._get_images_in_use()
+        now = timeutils.utcnow_ts()
+        min_age = (
+            CONF.vmwareapi_remove_unused_cached_images_minimum_age_seconds)
+        for ds_name in self._datastore_selector.get_datastore_names():
+            for image_id in self._list_cached_images(ds_name):
+                key = (ds_name, image_id)
+                if image_id in used_images or key in images_in_use:
+                    self._cached_images.add(key)
+                    self._unused_since.pop(key, None)
+                    continue
+                unused_since = self._unused_since.setdefault(key, now)
+                if (CONF.vmwareapi_remove_unused_cached_images and
+                        now - unused_since >= min_age):
+                    self._remove_cached_image(ds_name, image_id)
+
+    def _remove_cached_image(self, ds_name, image_id):
+        """
+        Removes the cache folder of the image from the datastore, unless a
+        spawn has fetched the image or a VM has come to use it since it was
+        found unused.
+        """
+        key = (ds_name, image_id)
+
+        @lockutils.synchronized(self._lock_name(ds_name, image_id), 'nova-')
+        def _remove():
+            # Fetching the image marks it used, under the same lock
+            if key not in self._unused_since:
+                return
+            if key in self._get_images_in_use():
+                self._unused_since.pop(key, None)
+                return
+            LOG.info(_("Removing unused cached image %(image_id)s from the "
+                       "datastore %(ds_name)s") % locals())
+            self._cached_images.discard(key)
+            self._unused_since.pop(key, None)
+            delete_task = self._session._call_method(
+                    self._session._get_vim(),
+                    "DeleteDatastoreFile_Task",
+                    self._session._get_vim().get_service_content().fileManager,
+                    name=self._get_cached_folder(ds_name, image_id))
+            self._session._wait_for_task(None, delete_task)
+
+        try:
+            _remove()
+        except Exception, excep:
+            LOG.warn(_("Failed to remove the cached image %(image_id)s from "
+                       "the datastore %(ds_name)s: %(excep)s") % locals())
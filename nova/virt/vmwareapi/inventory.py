@@ -0,0 +1,219 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A local mirror of the properties of the ESX inventory objects. The mirror is
+kept current through a property filter on the property collector, which is
+polled for the changes since the last seen version with WaitForUpdatesEx.
+"""
+
+from nova.openstack.common import cfg
+from nova.openstack.common import lockutils
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+from nova import utils
+from nova.virt.vmwareapi import vim_util
+
+LOG = logging.getLogger(__name__)
+
+vmwareapi_inventory_opts = [
+    cfg.BoolOpt('vmwareapi_use_inventory_mirror',
+                default=False,
+                help='Serve VM listing and power state queries from a local '
+                     'copy of the ESX inventory which is updated '
+                     'incrementally, rather than querying the host on each '
+                     'call. Used only if compute_driver is '
+                     'vmwareapi.VMWareESXDriver.'),
+    cfg.FloatOpt('vmwareapi_inventory_poll_interval',
+                 default=5.0,
+                 help='The interval (seconds) at which the local copy of the '
+                      'ESX inventory is brought up to date. '
+                      'Used only if compute_driver is '
+                      'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_inventory_max_staleness',
+               default=60,
+               help='The time (seconds) since the last successful update of '
+                    'the local copy of the ESX inventory after which the '
+                    'queries are made to the host again, until it is '
+                    'brought up to date. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(vmwareapi_inventory_opts)
+
+MIRRORED_PROPERTIES = {
+    "VirtualMachine": ["name", "runtime.connectionState",
+                       "runtime.powerState", "summary.config.numCpu",
+                       "summary.config.memorySizeMB", "resourcePool"],
+    "Datastore": ["summary.name", "summary.type"],
+    "HostSystem": ["name"],
+    "Network": ["summary.name"],
+    }
+
+# The number of updates in a row which may fail before the queries are made
+# to the host again
+MAX_UPDATE_FAILURES = 3
+
+
+class InventoryMirror(object):
+    """In-memory copy of the properties of the ESX inventory objects."""
+
+    def __init__(self, session, properties=None):
+        self._session = session
+        self._properties = properties or MIRRORED_PROPERTIES
+        self._filter = None
+        self._filter_session_id = None
+        self._version = ""
+        # Maps the object type to a dictionary from the reference key to
+        # (reference, properties) of the objects of the type.
+        self._objects = {}
+        self._loop = None
+        # The time of the last successful update, and the number of updates
+        # failed since
+        self._updated_at = None
+        self._update_failures = 0
+
+    def start(self):
+        """Loads the inventory and starts keeping it up to date."""
+        self.update()
+        self._loop = utils.LoopingCall(self._periodic_update)
+        self._loop.start(CONF.vmwareapi_inventory_poll_interval,
+                         initial_delay=CONF.vmwareapi_inventory_poll_interval)
+
+    def stop(self):
+        """Stops updating the inventory and destroys the property filter."""
+        if self._loop:
+            self._loop.stop()
+            self._loop = None
+        if (self._filter is not None and
+                self._filter_session_id == self._session._session_id):
+            try:
+                with self._session._pinned_vim(first=True):
+                    self._session._call_method(vim_util, "destroy_filter",
+                                               self._filter)
+            except Exception, excep:
+                LOG.debug(excep)
+        self._filter = None
+
+    def is_active(self):
+        """
+        Checks if the mirror has been loaded and is being kept current. It
+        is not while its updates fail, or once its last successful update is
+        older than vmwareapi_inventory_max_staleness, so that the queries go
+        to the host instead.
+        """
+        return (self._loop is not None and
+                self._updated_at is not None and
+                self._update_failures < MAX_UPDATE_FAILURES and
+                timeutils.utcnow_ts() - self._updated_at <
+                CONF.vmwareapi_inventory_max_staleness)
+
+    def _periodic_update(self):
+        """Updates the inventory, logging rather than raising any error."""
+        try:
+            self.update()
+        except Exception, excep:
+            LOG.warn(_("In vmwareapi:inventory:_periodic_update, "
+                       "got this exception: %s") % excep)
+
+    def _create_filter(self):
+        """
+        Creates the property filter watching the mirrored properties. The
+        filters of a session go away with it, so a new one is needed after
+        every re-login. The filter is kept on the first session of the pool.
+        """
+        vim = self._session._get_vim()
+        client_factory = vim.client.factory
+        prop_specs = []
+        for obj_type, properties in self._properties.iteritems():
+            prop_specs.append(vim_util.build_property_spec(client_factory,
+                                type=obj_type,
+                                properties_to_collect=properties))
+        object_spec = vim_util.build_object_spec(client_factory,
+                            vim.get_service_content().rootFolder,
+                            [vim_util.get_recursive_traversal_spec(
+                                                        client_factory)])
+        prop_filter_spec = vim_util.build_property_filter_spec(
+                            client_factory, prop_specs, [object_spec])
+        self._filter_session_id = self._session._session_id
+        self._filter = self._session._call_method(vim_util, "create_filter",
+                                                  prop_filter_spec)
+        self._version = ""
+        self._objects = {}
+
+    def update(self):
+        """Applies the changes made to the inventory since the last update."""
+
+        @lockutils.synchronized('vmware-inventory-mirror', 'nova-')
+        def _update():
+            with self._session._pinned_vim(first=True):
+                if (self._filter is None or
+                        self._filter_session_id != self._session._session_id):
+                    self._create_filter()
+                while True:
+                    update_set = self._session._call_method(vim_util,
+                                    "wait_for_updates_ex", self._version)
+                    if not update_set:
+                        break
+                    self._apply_update_set(update_set)
+                    self._version = update_set.version
+                    if not getattr(update_set, "truncated", False):
+                        break
+
+        try:
+            _update()
+        except Exception:
+            self._update_failures += 1
+            raise
+        self._updated_at = timeutils.utcnow_ts()
+        self._update_failures = 0
+
+    def _apply_update_set(self, update_set):
+        """Applies the object updates of the update set."""
+        for filter_update in update_set.filterSet:
+            for obj_update in filter_update.objectSet:
+                obj_ref = obj_update.obj
+                obj_type = obj_ref._type
+                key = vim_util.get_mo_ref_key(obj_ref)
+                objects = self._objects.setdefault(obj_type, {})
+                if obj_update.kind == "leave":
+                    objects.pop(key, None)
+                    continue
+                if obj_update.kind == "enter" or key not in objects:
+                    objects[key] = (obj_ref, {})
+                props = objects[key][1]
+                for change in getattr(obj_update, "changeSet", []):
+                    if change.op in ["assign", "add"]:
+                        props[change.name] = change.val
+                    else:
+                        props.pop(change.name, None)
+
+    def get_objects(self, obj_type):
+        """Gets a list of (reference, properties) of the objects of a type."""
+        return self._objects.get(obj_type, {}).values()
+
+    def get_properties(self, obj_type, obj_ref):
+        """
+        Gets the properties of the object, or None if the object is not
+        known to the mirror.
+        """
+        obj = self._objects.get(obj_type, {}).get(
+                                        vim_util.get_mo_ref_key(obj_ref))
+        if obj is None:
+            return None
+        return obj[1]
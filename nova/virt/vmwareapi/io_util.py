@@ -21,49 +21,120 @@ Utility classes for defining the time saving transfer of data from the reader
 to the write using a LightQueue as a Pipe between the reader and the writer.
 """
 
+import errno
+import time
+
 from eventlet import event
 from eventlet import greenthread
 from eventlet import queue
+from eventlet import semaphore
 
 from nova import exception
 from nova.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
 
-IO_THREAD_SLEEP_TIME = .01
 GLANCE_POLL_INTERVAL = 5
+RANGE_RETRY_COUNT = 3
+# The interval (seconds) at which the progress of a transfer is reported
+PROGRESS_INTERVAL = 10
 
 
 class ThreadSafePipe(queue.LightQueue):
     """The pipe to hold the data which the reader writes to and the writer
-    reads from."""
-
-    def __init__(self, maxsize, transfer_size):
+    reads from. It keeps the statistics of the transfer through it, and
+    reports the progress of the transfer to the progress callback, called
+    with the bytes transferred and the transfer size, every
+    PROGRESS_INTERVAL seconds and at the end of the transfer. If the transfer
+    size is None, i.e. not known ahead, the end of the data is marked by
+    write_eof() instead."""
+
+    def __init__(self, maxsize, transfer_size, progress_callback=None):
         queue.LightQueue.__init__(self, maxsize)
         self.transfer_size = transfer_size
         self.transferred = 0
+        self.eof = False
+        self.progress_callback = progress_callback
+        self.started_at = time.time()
+        self.finished_at = None
+        self._reported_at = self.started_at
+        # The time the writer waited for data, i.e. that the source of the
+        # transfer was the bottleneck, and the time the reader waited for
+        # room, i.e. that the destination was.
+        self.empty_wait = 0.0
+        self.full_wait = 0.0
+        # The sum of the data items in the pipe when each item was put
+        self._occupancy_sum = 0
+        self._puts = 0
 
     def read(self, chunk_size):
         """Read data from the pipe. Chunksize if ignored for we have ensured
         that the data chunks written to the pipe by readers is the same as the
         chunks asked for by the Writer."""
-        if self.transferred < self.transfer_size:
-            data_item = self.get()
-            self.transferred += len(data_item)
-            return data_item
-        else:
+        if self.eof or (self.transfer_size is not None and
+                        self.transferred >= self.transfer_size):
             return ""
+        waited_from = time.time()
+        data_item = self.get()
+        self.empty_wait += time.time() - waited_from
+        if not data_item:
+            self.eof = True
+        self.transferred += len(data_item)
+        self._report_progress()
+        return data_item
 
     def write(self, data):
         """Put a data item in the pipe."""
+        self._occupancy_sum += self.qsize()
+        self._puts += 1
+        waited_from = time.time()
         self.put(data)
+        self.full_wait += time.time() - waited_from
+
+    def write_eof(self):
+        """Mark the end of the data, for a transfer of unknown size."""
+        self.write("")
+
+    def _report_progress(self):
+        """Report the progress if it is due, or the transfer is done."""
+        now = time.time()
+        if self.transfer_size is None:
+            if self.eof:
+                self.finished_at = now
+            return
+        if self.transferred >= self.transfer_size:
+            self.finished_at = now
+        elif now - self._reported_at < PROGRESS_INTERVAL:
+            return
+        self._reported_at = now
+        LOG.debug(_("Transferred %(transferred)d of %(transfer_size)d "
+                    "bytes") % {"transferred": self.transferred,
+                                "transfer_size": self.transfer_size})
+        if self.progress_callback:
+            self.progress_callback(self.transferred, self.transfer_size)
+
+    def get_stats(self):
+        """Get the statistics of the transfer so far."""
+        duration = max((self.finished_at or time.time()) - self.started_at,
+                       0.001)
+        return {"transferred": self.transferred,
+                "duration": duration,
+                "rate": self.transferred / duration / (1024 * 1024),
+                "empty_wait": self.empty_wait,
+                "full_wait": self.full_wait,
+                "occupancy": float(self._occupancy_sum) / max(self._puts, 1),
+                "maxsize": self.maxsize}
 
     def seek(self, offset, whence=0):
         """Set the file's current position at the offset."""
         pass
 
     def tell(self):
-        """Get size of the file to be read."""
+        """Get size of the file to be read. If it is not known, the pipe is
+        not seekable, as far as the glance client is concerned, which then
+        sends the data without a size."""
+        if self.transfer_size is None:
+            raise IOError(errno.ESPIPE, _("The transfer size is not known"))
         return self.transfer_size
 
     def close(self):
@@ -71,6 +142,46 @@ class ThreadSafePipe(queue.LightQueue):
         pass
 
 
+class GlanceReadThread(object):
+    """Downloads the image data from the glance client to the output, which
+    blocks the download whenever it is full."""
+
+    def __init__(self, context, output, image_service, image_id):
+        self.context = context
+        self.output = output
+        self.image_service = image_service
+        self.image_id = image_id
+        self._thread = None
+
+    def start(self):
+        self.done = event.Event()
+
+        def _inner():
+            """Function to do the image data transfer through a download."""
+            try:
+                self.image_service.download(self.context, self.image_id,
+                                            self.output)
+                self.done.send(True)
+            except Exception, exc:
+                LOG.exception(exc)
+                self.done.send_exception(exc)
+
+        self._thread = greenthread.spawn(_inner)
+        return self.done
+
+    def stop(self):
+        # The download may be blocked on the output if the writer stopped,
+        # so it is killed rather than left waiting.
+        if self._thread:
+            self._thread.kill()
+
+    def wait(self):
+        return self.done.wait()
+
+    def close(self):
+        pass
+
+
 class GlanceWriteThread(object):
     """Ensures that image data is written to in the glance client and that
     it is in correct ('active')state."""
@@ -86,6 +197,7 @@ class GlanceWriteThread(object):
         self.image_id = image_id
         self.image_meta = image_meta
         self._running = False
+        self._thread = None
 
     def start(self):
         self.done = event.Event()
@@ -93,10 +205,14 @@ class GlanceWriteThread(object):
         def _inner():
             """Function to do the image data transfer through an update
             and thereon checks if the state is 'active'."""
-            self.image_service.update(self.context,
-                                      self.image_id,
-                                      self.image_meta,
-                                      data=self.input)
+            try:
+                self.image_service.update(self.context,
+                                          self.image_id,
+                                          self.image_meta,
+                                          data=self.input)
+            except Exception, exc:
+                self.done.send_exception(exc)
+                return
             self._running = True
             while self._running:
                 try:
@@ -104,11 +220,11 @@ class GlanceWriteThread(object):
                                                          self.image_id)
                     image_status = image_meta.get("status")
                     if image_status == "active":
-                        self.stop()
+                        self._running = False
                         self.done.send(True)
                     # If the state is killed, then raise an exception.
                     elif image_status == "killed":
-                        self.stop()
+                        self._running = False
                         msg = (_("Glance image %s is in killed state") %
                                  self.image_id)
                         LOG.error(msg)
@@ -116,7 +232,7 @@ class GlanceWriteThread(object):
                     elif image_status in ["saving", "queued"]:
                         greenthread.sleep(GLANCE_POLL_INTERVAL)
                     else:
-                        self.stop()
+                        self._running = False
                         msg = _("Glance image "
                                     "%(image_id)s is in unknown state "
                                     "- %(state)s") % {
@@ -125,14 +241,126 @@ class GlanceWriteThread(object):
                         LOG.error(msg)
                         self.done.send_exception(exception.NovaException(msg))
                 except Exception, exc:
-                    self.stop()
+                    self._running = False
                     self.done.send_exception(exc)
 
-        greenthread.spawn(_inner)
+        self._thread = greenthread.spawn(_inner)
         return self.done
 
     def stop(self):
+        # The update may be blocked on the input if its writer stopped, so
+        # it is killed rather than left waiting.
         self._running = False
+        if self._thread:
+            self._thread.kill()
+
+    def wait(self):
+        return self.done.wait()
+
+    def close(self):
+        pass
+
+
+class RangeReadThread(object):
+    """Reads the input as concurrent range reads and writes the ranges to
+    the output in order. A range whose read fails is read again, rather
+    than the whole input. At most streams ranges are read or waiting to be
+    written at a time, which bounds the data held in memory."""
+
+    def __init__(self, open_range, output, size, range_size, streams):
+        # open_range(offset, length) opens a file handle reading the range
+        self.open_range = open_range
+        self.output = output
+        self.size = size
+        self.range_size = range_size
+        self.streams = streams
+        self._read_threads = []
+        self._write_thread = None
+
+    def _read_range(self, offset, length, result):
+        """Read the range, retrying on failures, and send the chunks read
+        to the result."""
+        for attempt in range(1, RANGE_RETRY_COUNT + 1):
+            try:
+                chunks = []
+                read = 0
+                handle = self.open_range(offset, length)
+                try:
+                    while True:
+                        data = handle.read(None)
+                        if not data:
+                            break
+                        chunks.append(data)
+                        read += len(data)
+                finally:
+                    handle.close()
+                if read != length:
+                    raise IOError(_("Read %(read)d bytes of the range of "
+                                    "%(length)d bytes at %(offset)d") %
+                                  locals())
+                result.send(chunks)
+                return
+            except Exception, exc:
+                if attempt == RANGE_RETRY_COUNT:
+                    result.send_exception(exc)
+                    return
+                LOG.warn(_("Reading the range of %(length)d bytes at "
+                           "%(offset)d failed, retrying: %(exc)s") % locals())
+
+    def start(self):
+        self.done = event.Event()
+        ranges = [(offset, min(self.range_size, self.size - offset))
+                  for offset in xrange(0, self.size, self.range_size)]
+        results = [event.Event() for offset_length in ranges]
+        window = semaphore.Semaphore(self.streams)
+
+        def _dispatch():
+            """Start the reads of the ranges as the window allows."""
+            for index, (offset, length) in enumerate(ranges):
+                window.acquire()
+                self._read_threads.append(greenthread.spawn(
+                        self._read_range, offset, length, results[index]))
+
+        def _inner():
+            """Write the ranges to the output in order as they are read."""
+            started_at = time.time()
+            try:
+                for index in xrange(len(results)):
+                    chunks = results[index].wait()
+                    # The result holds the chunks of the range, which are
+                    # let go of once written, or the whole input would be
+                    # held in memory by the end of the transfer.
+                    results[index] = None
+                    while chunks:
+                        self.output.write(chunks.pop(0))
+                    window.release()
+            except Exception, exc:
+                LOG.exception(exc)
+                self._stop_reads()
+                self.done.send_exception(exc)
+                return
+            elapsed = max(time.time() - started_at, 0.001)
+            LOG.debug(_("Read %(size)d bytes in %(elapsed).2f seconds, at "
+                        "%(rate).2f MB/s over %(streams)d streams") %
+                      {"size": self.size, "elapsed": elapsed,
+                       "rate": self.size / elapsed / (1024 * 1024),
+                       "streams": self.streams})
+            self.done.send(True)
+
+        self._read_threads.append(greenthread.spawn(_dispatch))
+        self._write_thread = greenthread.spawn(_inner)
+        return self.done
+
+    def _stop_reads(self):
+        for thread in self._read_threads:
+            thread.kill()
+
+    def stop(self):
+        # The writes may be blocked on the output if its reader stopped, so
+        # they are killed rather than left waiting.
+        self._stop_reads()
+        if self._write_thread:
+            self._write_thread.kill()
 
     def wait(self):
         return self.done.wait()
@@ -143,12 +371,15 @@ class GlanceWriteThread(object):
 
 class IOThread(object):
     """Class that reads chunks from the input file and writes them to the
-    output file till the transfer is completely done."""
+    output file till the transfer is completely done. The thread yields only
+    when the input or the output blocks, i.e. when the pipe it reads from is
+    empty or the one it writes to is full, or a socket would block."""
 
     def __init__(self, input, output):
         self.input = input
         self.output = output
         self._running = False
+        self._thread = None
         self.got_exception = False
 
     def start(self):
@@ -158,24 +389,29 @@ class IOThread(object):
             """Read data from the input and write the same to the output
             until the transfer completes."""
             self._running = True
-            while self._running:
-                try:
+            try:
+                while self._running:
                     data = self.input.read(None)
                     if not data:
-                        self.stop()
-                        self.done.send(True)
+                        break
                     self.output.write(data)
-                    greenthread.sleep(IO_THREAD_SLEEP_TIME)
-                except Exception, exc:
-                    self.stop()
-                    LOG.exception(exc)
-                    self.done.send_exception(exc)
-
-        greenthread.spawn(_inner)
+            except Exception, exc:
+                self._running = False
+                LOG.exception(exc)
+                self.done.send_exception(exc)
+                return
+            self._running = False
+            self.done.send(True)
+
+        self._thread = greenthread.spawn(_inner)
         return self.done
 
     def stop(self):
+        # The thread may be blocked on a pipe whose other end stopped, so it
+        # is killed rather than left waiting.
         self._running = False
+        if self._thread:
+            self._thread.kill()
 
     def wait(self):
         return self.done.wait()
@@ -20,13 +20,31 @@ Utility functions for ESX Networking.
 """
 
 from nova import exception
+from nova.openstack.common import cfg
+from nova.openstack.common import lockutils
 from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
 from nova.virt.vmwareapi import error_util
 from nova.virt.vmwareapi import vim_util
 from nova.virt.vmwareapi import vm_util
 
 LOG = logging.getLogger(__name__)
 
+vmwareapi_network_opts = [
+    cfg.IntOpt('vmwareapi_network_refresh_interval',
+               default=600,
+               help='The interval (seconds) after which the cached network '
+                    'topology of the host is fetched again. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(vmwareapi_network_opts)
+
+HOST_NETWORK_PROPERTIES = ["config.network.pnic", "config.network.vswitch",
+                           "config.network.portgroup", "network"]
+
 
 def get_network_with_the_name(session, network_name="vmnet0"):
     """
@@ -136,10 +154,12 @@ def get_vlanid_and_vswitch_for_portgroup(session, pg_name):
             return p_gp.spec.vlanId, p_grp_vswitch_name
 
 
-def create_port_group(session, pg_name, vswitch_name, vlan_id=0):
+def create_port_group(session, pg_name, vswitch_name, vlan_id=0,
+                      host_mor=None):
     """
     Creates a port group on the host system with the vlan tags
-    supplied. VLAN id 0 means no vlan id association.
+    supplied. VLAN id 0 means no vlan id association. The host system is
+    the first one found, unless given.
     """
     client_factory = session._get_vim().client.factory
     add_prt_grp_spec = vm_util.get_add_vswitch_port_group_spec(
@@ -147,8 +167,9 @@ def create_port_group(session, pg_name, vswitch_name, vlan_id=0):
                     vswitch_name,
                     pg_name,
                     vlan_id)
-    host_mor = session._call_method(vim_util, "get_objects",
-         "HostSystem")[0].obj
+    if host_mor is None:
+        host_mor = session._call_method(vim_util, "get_objects",
+             "HostSystem")[0].obj
     network_system_mor = session._call_method(vim_util,
         "get_dynamic_property", host_mor,
         "HostSystem", "configManager.networkSystem")
@@ -168,3 +189,169 @@ def create_port_group(session, pg_name, vswitch_name, vlan_id=0):
             raise exception.NovaException(exc)
     LOG.debug(_("Created Port Group with name %s on "
                 "the ESX host") % pg_name)
+
+
+class HostNetworkCache(object):
+    """
+    Caches the network topology of the host: its physical network adapters,
+    vSwitches, port groups with their VLAN ids and networks, including the
+    distributed virtual port groups. The topology is fetched with one
+    retrieval of the properties of the host and one per type of network,
+    kept current by the port groups created through the cache, and fetched
+    again after the refresh interval or when a lookup misses. If a cluster
+    is given, the topology is that of the first host of the cluster.
+    """
+
+    def __init__(self, session, cluster=None):
+        self._session = session
+        self._cluster = cluster
+        self._host_ref = None
+        # The device names of the physical network adapters
+        self._pnics = set()
+        # Maps the vSwitch name to the keys of its physical network adapters
+        self._vswitches = {}
+        # Maps the port group name to its VLAN id and vSwitch name
+        self._port_groups = {}
+        # Maps the network name to the network object as returned by
+        # get_network_with_the_name
+        self._networks = {}
+        self._refreshed_at = None
+
+    def _is_stale(self):
+        """Checks if the cached topology is due for a refresh."""
+        return (self._refreshed_at is None or
+                timeutils.utcnow_ts() - self._refreshed_at >=
+                CONF.vmwareapi_network_refresh_interval)
+
+    def refresh(self):
+        """Fetches the network topology of the host."""
+        if self._cluster is None:
+            host = self._session._call_method(vim_util, "get_objects",
+                                "HostSystem", HOST_NETWORK_PROPERTIES)[0]
+        else:
+            host = self._session._call_method(vim_util,
+                                "get_inner_objects", self._cluster,
+                                "ClusterComputeResource", "host",
+                                "HostSystem", HOST_NETWORK_PROPERTIES)[0]
+        props = dict((prop.name, prop.val) for prop in host.propSet)
+
+        pnics = set()
+        # suds responds with a "" rather than an empty array for the
+        # properties without elements
+        for pnic in getattr(props.get("config.network.pnic"),
+                            "PhysicalNic", []):
+            pnics.add(pnic.device)
+
+        vswitches = {}
+        for vswitch in getattr(props.get("config.network.vswitch"),
+                               "HostVirtualSwitch", []):
+            # A vSwitch may not be associated with a physical NIC
+            vswitches[vswitch.name] = [str(nic) for nic in
+                                       getattr(vswitch, "pnic", [])]
+
+        port_groups = {}
+        for p_gp in getattr(props.get("config.network.portgroup"),
+                            "HostPortGroup", []):
+            port_groups[p_gp.spec.name] = (p_gp.spec.vlanId,
+                                           p_gp.vswitch.split("-")[-1])
+
+        network_refs = getattr(props.get("network"),
+                               "ManagedObjectReference", [])
+        dvpg_refs = [ref for ref in network_refs
+                     if ref._type == "DistributedVirtualPortgroup"]
+        network_refs = [ref for ref in network_refs if ref not in dvpg_refs]
+        networks = {}
+        if network_refs:
+            for network in self._session._call_method(vim_util,
+                    "get_properties_for_a_collection_of_objects", "Network",
+                    network_refs, ["summary.name"]):
+                name = network.propSet[0].val
+                networks[name] = {'type': 'Network', 'name': name}
+        if dvpg_refs:
+            for dvpg in self._session._call_method(vim_util,
+                    "get_properties_for_a_collection_of_objects",
+                    "DistributedVirtualPortgroup", dvpg_refs, ["config"]):
+                # NOTE(asomya): This only works on ESXi if the port binding
+                # is set to ephemeral
+                config = dvpg.propSet[0].val
+                networks[config.name] = {
+                    'type': 'DistributedVirtualPortgroup',
+                    'dvpg': config.key,
+                    'dvsw': config.distributedVirtualSwitch.value}
+
+        self._host_ref = host.obj
+        self._pnics = pnics
+        self._vswitches = vswitches
+        self._port_groups = port_groups
+        self._networks = networks
+        self._refreshed_at = timeutils.utcnow_ts()
+
+    def _lookup(self, lookup):
+        """
+        Looks the topology up, fetching it first if it is stale, and once
+        more if the lookup misses, in case the topology changed since.
+        """
+
+        @lockutils.synchronized('vmware-host-network', 'nova-')
+        def _lookup_topology():
+            refreshed = self._is_stale()
+            if refreshed:
+                self.refresh()
+            result = lookup()
+            if result is None and not refreshed:
+                self.refresh()
+                result = lookup()
+            return result
+
+        return _lookup_topology()
+
+    def check_if_vlan_interface_exists(self, vlan_interface):
+        """Checks if the vlan_inteface exists on the esx host."""
+
+        def _lookup():
+            if vlan_interface in self._pnics:
+                return True
+
+        return bool(self._lookup(_lookup))
+
+    def get_vswitch_for_vlan_interface(self, vlan_interface):
+        """
+        Gets the vswitch associated with the physical network adapter
+        with the name supplied.
+        """
+
+        def _lookup():
+            for name, pnics in self._vswitches.iteritems():
+                for nic in pnics:
+                    if nic.split('-')[-1].find(vlan_interface) != -1:
+                        return name
+
+        return self._lookup(_lookup)
+
+    def get_network_with_the_name(self, network_name="vmnet0"):
+        """
+        Gets the network object of the network whose name is passed as the
+        argument.
+        """
+        return self._lookup(lambda: self._networks.get(network_name))
+
+    def get_vlanid_and_vswitch_for_portgroup(self, pg_name):
+        """Get the vlan id and vswicth associated with the port group."""
+        return self._lookup(lambda: self._port_groups.get(pg_name))
+
+    def create_port_group(self, pg_name, vswitch_name, vlan_id=0):
+        """
+        Creates a port group on the host system with the vlan tags
+        supplied, and records it and its network in the cache.
+        """
+        if self._host_ref is None:
+            self.refresh()
+        create_port_group(self._session, pg_name, vswitch_name, vlan_id,
+                          self._host_ref)
+
+        @lockutils.synchronized('vmware-host-network', 'nova-')
+        def _record():
+            self._port_groups[pg_name] = (vlan_id, vswitch_name)
+            self._networks[pg_name] = {'type': 'Network', 'name': pg_name}
+
+        _record()
@@ -0,0 +1,430 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A fast path for the SOAP calls the driver makes the most.
+
+suds builds the request of a call out of objects of the types of the WSDL,
+and unmarshals the response into such objects, which takes milliseconds for
+a request and seconds for the response to a retrieval of the properties of
+a thousand VMs. For the retrievals of properties, which the tasks are also
+polled with, and the calls taking only the managed object, such as the
+power operations, the requests are instead written out from templates, and
+the responses parsed with a streaming XML parser into compact objects having
+the attributes of the suds objects that the callers use.
+
+The specs of the retrievals are built by vim_util with SPEC_FACTORY, whose
+plain objects are written out in the order of their schema. A response
+holding anything the parser does not know, such as the faults of a
+missingSet or a value of a data object type other than TaskInfo, is
+unmarshalled by suds from the same reply, so that the caller gets what suds
+would have given it. The requests are sent through the transport of the
+suds client, and so with its cookies, and the SOAP faults are raised by
+suds as WebFault.
+"""
+
+import cStringIO
+import types
+from xml.etree import cElementTree
+from xml.sax import saxutils
+
+try:
+    import suds
+    from suds import client as suds_client
+    from suds import sudsobject
+    from suds import transport as suds_transport
+except ImportError:
+    suds = None
+
+from nova.openstack.common import cfg
+
+vmwareapi_soap_fast_path_opt = cfg.BoolOpt('vmwareapi_soap_fast_path',
+        default=True,
+        help='Should the retrievals of properties, the polls of the tasks '
+             'and the power operations write their SOAP requests from '
+             'templates and parse the responses without suds? '
+             'Used only if compute_driver is vmwareapi.VMWareESXDriver.')
+
+CONF = cfg.CONF
+CONF.register_opt(vmwareapi_soap_fast_path_opt)
+
+# The printer of the managed object references parsed, which keeps no state
+_PRINTER = sudsobject.Printer() if suds else None
+
+ENVELOPE = (u'<?xml version="1.0" encoding="UTF-8"?>'
+            u'<soapenv:Envelope '
+            u'xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+            u'xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+            u'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            u'<soapenv:Body><%(method)s xmlns="urn:vim25">%(body)s'
+            u'</%(method)s></soapenv:Body></soapenv:Envelope>')
+
+XSI_TYPE = "{http://www.w3.org/2001/XMLSchema-instance}type"
+
+# The elements of the specs, in the order of their schema
+SPEC_ELEMENTS = {
+    "PropertyFilterSpec": ["propSet", "objectSet",
+                           "reportMissingObjectsInResults"],
+    "PropertySpec": ["type", "all", "pathSet"],
+    "ObjectSpec": ["obj", "skip", "selectSet"],
+    "SelectionSpec": ["name"],
+    "TraversalSpec": ["name", "type", "path", "skip", "selectSet"],
+    "RetrieveOptions": ["maxObjects"],
+    }
+
+# The converters of the text of the values of the XML schema types
+XSD_CONVERTERS = {
+    "string": lambda text: text,
+    "boolean": lambda text: text == "true",
+    "byte": int,
+    "short": int,
+    "int": int,
+    "long": long,
+    }
+
+
+class Unsupported(Exception):
+    """Raised for a request or a response the fast path does not handle."""
+    pass
+
+
+class Spec(object):
+    """A spec of a retrieval, built as a plain object of the type named."""
+
+    def __init__(self, type_name):
+        self.spec_type = type_name
+        self._xml = None
+
+
+class SpecFactory(object):
+    """Creates the specs of the retrievals written out by the fast path."""
+
+    def create(self, name):
+        return Spec(name.split(":")[-1])
+
+
+SPEC_FACTORY = SpecFactory()
+
+
+class ObjectContent(object):
+    """The properties of an object retrieved."""
+    __slots__ = ["obj", "propSet"]
+
+
+class DynamicProperty(object):
+    """A property of an object retrieved."""
+    __slots__ = ["name", "val"]
+
+
+class RetrieveResult(object):
+    """A page of the objects of a retrieval."""
+    __slots__ = ["token", "objects"]
+
+
+class ArrayOfManagedObjectReference(object):
+    """A value listing managed object references."""
+    __slots__ = ["ManagedObjectReference"]
+
+
+class TaskInfo(object):
+    """The info of a task which has not failed."""
+    __slots__ = ["key", "task", "name", "descriptionId", "entity",
+                 "entityName", "state", "cancelled", "cancelable", "progress",
+                 "result", "error"]
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+
+def _escape(value):
+    if isinstance(value, bool):
+        return value and u"true" or u"false"
+    if isinstance(value, str):
+        value = value.decode("utf-8")
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+    return saxutils.escape(value)
+
+
+def _mo_ref_element(tag, mo_ref):
+    """Writes out the managed object reference as the element."""
+    mo_type = getattr(mo_ref, "_type", None)
+    value = getattr(mo_ref, "value", None)
+    if mo_type is None or value is None:
+        raise Unsupported(tag)
+    return u'<%s type="%s">%s</%s>' % (tag,
+            _escape(mo_type).replace('"', "&quot;"), _escape(value), tag)
+
+
+def _spec_element(tag, spec):
+    """
+    Writes out the spec as the element. The elements of the selection sets
+    are declared of the type SelectionSpec, so a TraversalSpec among them
+    names its type. The XML of the selection and traversal specs, which are
+    shared by the calls, is kept with them.
+    """
+    cache = spec.spec_type in ("SelectionSpec", "TraversalSpec")
+    if cache and spec._xml is not None:
+        return spec._xml
+    type_attr = u""
+    if tag == "selectSet" and spec.spec_type != "SelectionSpec":
+        type_attr = u' xsi:type="%s"' % spec.spec_type
+    parts = [u"<%s%s>" % (tag, type_attr)]
+    for name in SPEC_ELEMENTS[spec.spec_type]:
+        parts.append(_element(name, getattr(spec, name, None)))
+    parts.append(u"</%s>" % tag)
+    xml = u"".join(parts)
+    if cache:
+        spec._xml = xml
+    return xml
+
+
+def _element(tag, value):
+    """Writes out the value, which may be a list, as the element."""
+    if value is None:
+        return u""
+    if isinstance(value, (list, tuple)):
+        return u"".join([_element(tag, item) for item in value])
+    if isinstance(value, Spec):
+        return _spec_element(tag, value)
+    if hasattr(value, "_type"):
+        return _mo_ref_element(tag, value)
+    if suds and isinstance(value, sudsobject.Object):
+        # A spec built with the client factory of suds
+        raise Unsupported(tag)
+    return u"<%s>%s</%s>" % (tag, _escape(value), tag)
+
+
+def _parse_nothing(reply):
+    return None
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _iter_elements(reply, depths):
+    """
+    Parses the reply as a stream, yielding the (depth, element) of the
+    elements at the depths specified as they end. Each element is cleared
+    once the caller is done with it, so that the tree of the whole reply is
+    not kept. The Envelope is at the depth 1, and the elements of the
+    response at the depth 4.
+    """
+    depth = 0
+    for event, element in cElementTree.iterparse(
+            cStringIO.StringIO(reply), ("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        if depth in depths:
+            yield depth, element
+            element.clear()
+        depth -= 1
+
+
+def _parse_mo_ref(element):
+    # The constructors of the suds objects take most of the time of the
+    # parsing, so the objects are created with the attributes they would
+    # set, which suds marshals and prints as it does those it creates.
+    metadata = types.InstanceType(sudsobject.Metadata,
+                                  {"__keylist__": [],
+                                   "__printer__": _PRINTER})
+    return types.InstanceType(sudsobject.Property,
+                              {"__keylist__": ["value", "_type"],
+                               "__printer__": _PRINTER,
+                               "__metadata__": metadata,
+                               "value": element.text,
+                               "_type": element.get("type")})
+
+
+def _parse_value(element):
+    """Parses the value of a property, or of a field of a TaskInfo."""
+    xsi_type = element.get(XSI_TYPE) or ""
+    prefix, sep, type_name = xsi_type.rpartition(":")
+    if len(element):
+        if type_name == "ArrayOfManagedObjectReference":
+            value = ArrayOfManagedObjectReference()
+            value.ManagedObjectReference = [_parse_mo_ref(child)
+                                            for child in element]
+            return value
+        if type_name == "TaskInfo":
+            return _parse_task_info(element)
+        raise Unsupported(xsi_type)
+    if element.get("type") is not None:
+        return _parse_mo_ref(element)
+    if prefix:
+        # A type of the XML schema
+        converter = XSD_CONVERTERS.get(type_name)
+        if converter is None:
+            raise Unsupported(xsi_type)
+        return converter(element.text or "")
+    if not element.text:
+        # An empty array or data object
+        raise Unsupported(xsi_type)
+    # A value of an enumeration
+    return element.text
+
+
+def _parse_task_info(element):
+    """
+    Parses the fields of the TaskInfo that the callers use. The info of a
+    failed task is left to suds, for its error to be unmarshalled in full.
+    """
+    task_info = TaskInfo()
+    for child in element:
+        name = _local_name(child.tag)
+        if name == "error":
+            raise Unsupported(name)
+        if name in ("task", "entity"):
+            setattr(task_info, name, _parse_mo_ref(child))
+        elif name == "result":
+            task_info.result = _parse_value(child)
+        elif name in ("cancelled", "cancelable"):
+            setattr(task_info, name, child.text == "true")
+        elif name == "progress":
+            task_info.progress = int(child.text)
+        elif name in TaskInfo.__slots__:
+            setattr(task_info, name, child.text)
+    if task_info.state == "error":
+        raise Unsupported("error")
+    return task_info
+
+
+def _parse_object_content(element):
+    obj_content = ObjectContent()
+    prop_set = []
+    for child in element:
+        name = _local_name(child.tag)
+        if name == "obj":
+            obj_content.obj = _parse_mo_ref(child)
+        elif name == "propSet":
+            prop = DynamicProperty()
+            for prop_child in child:
+                if _local_name(prop_child.tag) == "name":
+                    prop.name = prop_child.text
+                else:
+                    prop.val = _parse_value(prop_child)
+            prop_set.append(prop)
+        else:
+            # The faults of a missingSet
+            raise Unsupported(name)
+    if prop_set:
+        obj_content.propSet = prop_set
+    return obj_content
+
+
+def _parse_object_contents(reply):
+    """Parses the response to RetrieveProperties."""
+    return [_parse_object_content(element)
+            for depth, element in _iter_elements(reply, (4,))]
+
+
+def _parse_retrieve_result(reply):
+    """Parses the response to RetrievePropertiesEx or to
+    ContinueRetrievePropertiesEx."""
+    result = None
+    objects = []
+    for depth, element in _iter_elements(reply, (4, 5)):
+        if result is None:
+            result = RetrieveResult()
+        if depth == 4:
+            continue
+        if _local_name(element.tag) == "token":
+            result.token = element.text
+        else:
+            objects.append(_parse_object_content(element))
+    if objects:
+        result.objects = objects
+    return result
+
+
+def _parse_returned_mo_ref(reply):
+    """Parses the managed object reference returned, if any."""
+    for depth, element in _iter_elements(reply, (4,)):
+        return _parse_mo_ref(element)
+    return None
+
+
+# Maps the methods of the fast path to the names of their parameters after
+# _this, in the order of their schema, and to the parser of their responses.
+# The parameters are all optional but for the specSet of a retrieval.
+METHODS = {
+    "RetrieveProperties": (["specSet"], _parse_object_contents),
+    "RetrievePropertiesEx": (["specSet", "options"], _parse_retrieve_result),
+    "ContinueRetrievePropertiesEx": (["token"], _parse_retrieve_result),
+    "CancelRetrievePropertiesEx": (["token"], _parse_nothing),
+    "PowerOnVM_Task": ([], _parse_returned_mo_ref),
+    "PowerOffVM_Task": ([], _parse_returned_mo_ref),
+    "SuspendVM_Task": ([], _parse_returned_mo_ref),
+    "ResetVM_Task": ([], _parse_returned_mo_ref),
+    "Destroy_Task": ([], _parse_returned_mo_ref),
+    "RebootGuest": ([], _parse_nothing),
+    "ShutdownGuest": ([], _parse_nothing),
+    "UnregisterVM": ([], _parse_nothing),
+    }
+
+
+def build_request(method_name, managed_object, kwargs):
+    """
+    Writes out the SOAP envelope of the call from its template. Returns None
+    if the fast path does not handle the call, which is then made by suds.
+    """
+    if method_name not in METHODS:
+        return None
+    params = METHODS[method_name][0]
+    if [name for name in kwargs if name not in params]:
+        return None
+    try:
+        body = [_mo_ref_element("_this", managed_object)]
+        body.extend(_element(name, kwargs.get(name)) for name in params)
+    except Unsupported:
+        return None
+    return ENVELOPE % {"method": method_name, "body": u"".join(body)}
+
+
+def parse_response(method, reply):
+    """
+    Parses the reply to the call of the method, a method of the WSDL, with
+    the parser of the fast path, or with suds if the reply holds what the
+    parser does not know.
+    """
+    if not reply:
+        return None
+    try:
+        return METHODS[method.name][1](reply)
+    except Unsupported:
+        return method.binding.output.get_reply(method, reply)[1]
+
+
+def send(client, method_name, envelope):
+    """
+    Sends the SOAP envelope of the call through the transport of the suds
+    client and parses the reply. The SOAP faults are raised by suds.
+    """
+    method = getattr(client.service, method_name).method
+    soap_client = suds_client.SoapClient(client, method)
+    request = suds_transport.Request(soap_client.location(),
+                                     envelope.encode("utf-8"))
+    request.headers = soap_client.headers()
+    try:
+        reply = client.options.transport.send(request)
+    except suds_transport.TransportError, excep:
+        if excep.httpcode in (202, 204):
+            return None
+        return soap_client.failed(method.binding.output, excep)
+    return parse_response(method, reply.message)
@@ -36,37 +36,43 @@ vmwareapi_vif_opts = [
 CONF.register_opts(vmwareapi_vif_opts)
 
 
-def ensure_vlan_bridge(self, session, network):
-    """Create a vlan and bridge unless they already exist."""
+def ensure_vlan_bridge(session, network, network_cache=None):
+    """
+    Create a vlan and bridge unless they already exist, and return the
+    network object of the bridge. The network topology of the host is
+    looked up in the network cache, if given.
+    """
+    if network_cache is None:
+        network_cache = network_util.HostNetworkCache(session)
     vlan_num = network['vlan']
     bridge = network['bridge']
     vlan_interface = CONF.vmwareapi_vlan_interface
 
     # Check if the vlan_interface physical network adapter exists on the
     # host.
-    if not network_util.check_if_vlan_interface_exists(session,
-                                                        vlan_interface):
+    if not network_cache.check_if_vlan_interface_exists(vlan_interface):
         raise exception.NetworkAdapterNotFound(adapter=vlan_interface)
 
     # Get the vSwitch associated with the Physical Adapter
-    vswitch_associated = network_util.get_vswitch_for_vlan_interface(
-                                        session, vlan_interface)
+    vswitch_associated = network_cache.get_vswitch_for_vlan_interface(
+                                        vlan_interface)
     if vswitch_associated is None:
         raise exception.SwitchNotFoundForNetworkAdapter(
             adapter=vlan_interface)
     # Check whether bridge already exists and retrieve the the ref of the
     # network whose name_label is "bridge"
-    network_ref = network_util.get_network_with_the_name(session, bridge)
+    network_ref = network_cache.get_network_with_the_name(bridge)
     if network_ref is None:
         # Create a port group on the vSwitch associated with the
         # vlan_interface corresponding physical network adapter on the ESX
         # host.
-        network_util.create_port_group(session, bridge,
-                                        vswitch_associated, vlan_num)
+        network_cache.create_port_group(bridge, vswitch_associated,
+                                        vlan_num)
+        network_ref = network_cache.get_network_with_the_name(bridge)
     else:
         # Get the vlan id and vswitch corresponding to the port group
-        _get_pg_info = network_util.get_vlanid_and_vswitch_for_portgroup
-        pg_vlanid, pg_vswitch = _get_pg_info(session, bridge)
+        _get_pg_info = network_cache.get_vlanid_and_vswitch_for_portgroup
+        pg_vlanid, pg_vswitch = _get_pg_info(bridge)
 
         # Check if the vswitch associated is proper
         if pg_vswitch != vswitch_associated:
@@ -78,3 +84,4 @@ def ensure_vlan_bridge(self, session, network):
         if pg_vlanid != vlan_num:
             raise exception.InvalidVLANTag(bridge=bridge, tag=vlan_num,
                                            pgroup=pg_vlanid)
+    return network_ref
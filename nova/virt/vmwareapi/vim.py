@@ -21,6 +21,8 @@ Classes for making VMware VI SOAP calls.
 """
 
 import httplib
+import os
+import time
 
 try:
     import suds
@@ -28,7 +30,9 @@ except ImportError:
     suds = None
 
 from nova.openstack.common import cfg
+from nova.virt.vmwareapi import call_stats
 from nova.virt.vmwareapi import error_util
+from nova.virt.vmwareapi import soap_util
 
 RESP_NOT_XML_ERROR = 'Response is "text/html", not "text/xml"'
 CONN_ABORT_ERROR = 'Software caused connection abort'
@@ -44,6 +48,11 @@ vmwareapi_wsdl_loc_opt = cfg.StrOpt('vmwareapi_wsdl_loc',
 CONF = cfg.CONF
 CONF.register_opt(vmwareapi_wsdl_loc_opt)
 
+# Maps the WSDL location to the suds client that the clients of the VIM
+# objects are cloned from, so that the WSDL is parsed once per process
+# rather than on every login.
+_client_templates = {}
+
 
 if suds:
 
@@ -67,6 +76,36 @@ if suds:
             context.envelope.walk(self.addAttributeForValue)
 
 
+def _get_wsdl_version(wsdl_url):
+    """
+    Gets the modification time of a local WSDL file, so that the parsed
+    WSDL is not used after the file is replaced.
+    """
+    if wsdl_url.startswith("file://"):
+        try:
+            return os.path.getmtime(wsdl_url[len("file://"):])
+        except OSError:
+            pass
+    return None
+
+
+def _get_client(wsdl_url, location):
+    """
+    Gets a suds client for the WSDL that sends its requests to the location.
+    The parsed WSDL is shared by the clients, each of which has options, and
+    so a transport and cookies, of its own.
+    """
+    version = _get_wsdl_version(wsdl_url)
+    template = _client_templates.get(wsdl_url)
+    if template is None or template[0] != version:
+        template = (version, suds.client.Client(wsdl_url,
+                                    plugins=[VIMMessagePlugin()]))
+        _client_templates[wsdl_url] = template
+    client = template[1].clone()
+    client.set_options(location=location)
+    return client
+
+
 class Vim:
     """The VIM Object."""
 
@@ -92,8 +131,9 @@ class Vim:
         #wsdl_url = '%s://%s/sdk/vimService.wsdl' % (self._protocol,
         #        self._host_name)
         url = '%s://%s/sdk' % (self._protocol, self._host_name)
-        self.client = suds.client.Client(wsdl_url, location=url,
-                            plugins=[VIMMessagePlugin()])
+        self.client = _get_client(wsdl_url, url)
+        # Whether the hot calls take the fast path of soap_util
+        self.fast_path = CONF.vmwareapi_soap_fast_path
         self._service_content = self.RetrieveServiceContent("ServiceInstance")
 
     def get_service_content(self):
@@ -115,8 +155,16 @@ class Vim:
             try:
                 request_mo = self._request_managed_object_builder(
                              managed_object)
-                request = getattr(self.client.service, attr_name)
-                response = request(request_mo, **kwargs)
+                envelope = None
+                if self.fast_path:
+                    envelope = soap_util.build_request(attr_name, request_mo,
+                                                       kwargs)
+                if envelope is not None:
+                    response = soap_util.send(self.client, attr_name,
+                                              envelope)
+                else:
+                    request = getattr(self.client.service, attr_name)
+                    response = request(request_mo, **kwargs)
                 # To check for the faults that are part of the message body
                 # and not returned as Fault object response from the ESX
                 # SOAP server
@@ -160,6 +208,27 @@ class Vim:
                 else:
                     raise error_util.VimException(
                        _("Exception in %s ") % (attr_name), excep)
+
+        def vim_request_recorder(managed_object, **kwargs):
+            """Makes the request, recording it in the call stats."""
+            start = time.time()
+            outcome = call_stats.OUTCOME_ERROR
+            try:
+                response = vim_request_handler(managed_object, **kwargs)
+                outcome = call_stats.OUTCOME_OK
+                return response
+            except error_util.VimFaultException:
+                outcome = call_stats.OUTCOME_FAULT
+                raise
+            except error_util.SessionOverLoadException:
+                outcome = call_stats.OUTCOME_OVERLOAD
+                raise
+            finally:
+                call_stats.record_request(attr_name, time.time() - start,
+                                          outcome)
+
+        if call_stats.is_enabled():
+            return vim_request_recorder
         return vim_request_handler
 
     def _request_managed_object_builder(self, managed_object):
@@ -19,6 +19,41 @@
 The VMware API utility module.
 """
 
+import weakref
+
+from nova.openstack.common import cfg
+from nova.virt.vmwareapi import soap_util
+
+vmwareapi_maximum_objects_opt = cfg.IntOpt('vmwareapi_maximum_objects',
+        default=100,
+        help='The maximum number of objects retrieved from the ESX host in '
+             'one response when listing the objects of a type. The rest are '
+             'retrieved with further calls. '
+             'Used only if compute_driver is vmwareapi.VMWareESXDriver.')
+
+CONF = cfg.CONF
+CONF.register_opt(vmwareapi_maximum_objects_opt)
+
+# Maps a suds client factory to the specs built with it which do not depend
+# on the arguments of the calls using them, so that they are built only once.
+_cached_specs = weakref.WeakKeyDictionary()
+
+
+def _get_spec_factory(vim):
+    """
+    Gets the factory the specs of a retrieval are built with: the one of the
+    fast path of the SOAP calls, whose specs are written out from templates,
+    if the VIM object takes it, and the client factory of suds otherwise.
+    """
+    if getattr(vim, "fast_path", False):
+        return soap_util.SPEC_FACTORY
+    return vim.client.factory
+
+
+def get_mo_ref_key(mo_ref):
+    """Gets the hashable value identifying the managed object reference."""
+    return getattr(mo_ref, "value", mo_ref)
+
 
 def build_selection_spec(client_factory, name):
     """Builds the selection spec."""
@@ -94,6 +129,72 @@ def build_recursive_traversal_spec(client_factory):
     return traversal_spec
 
 
+def get_recursive_traversal_spec(client_factory):
+    """
+    Gets the Recursive Traversal Spec built with the client factory. The spec
+    is shared by the calls, so it must not be modified.
+    """
+    specs = _cached_specs.setdefault(client_factory, {})
+    if "recursive_traversal_spec" not in specs:
+        specs["recursive_traversal_spec"] = build_recursive_traversal_spec(
+                                                            client_factory)
+    return specs["recursive_traversal_spec"]
+
+
+def build_scoped_traversal_spec(client_factory, type):
+    """
+    Builds the Traversal Spec to reach the objects of the type from the root
+    folder, walking only the parts of the hierarchy they can be in. Falls
+    back to the Recursive Traversal Spec for the other types.
+    """
+    visit_folders_select_spec = build_selection_spec(client_factory,
+                                    "visitFolders")
+    # For getting to hostFolder from datacenter
+    dc_to_hf = build_traversal_spec(client_factory, "dc_to_hf", "Datacenter",
+                                    "hostFolder", False,
+                                    [visit_folders_select_spec])
+    # The traversal specs to be followed from the objects reached through the
+    # folders, to get to the objects of the type
+    scoped_specs = {
+        "Datacenter": [],
+        # All the VMs are in the VM folder hierarchy of their datacenter
+        "VirtualMachine": [build_traversal_spec(client_factory, "dc_to_vmf",
+                                "Datacenter", "vmFolder", False,
+                                [visit_folders_select_spec])],
+        "HostSystem": [dc_to_hf,
+                       build_traversal_spec(client_factory, "cr_to_h",
+                                "ComputeResource", "host", False, [])],
+        "Datastore": [build_traversal_spec(client_factory, "dc_to_ds",
+                                "Datacenter", "datastore", False, [])],
+        "Network": [build_traversal_spec(client_factory, "dc_to_net",
+                                "Datacenter", "network", False, [])],
+        "ClusterComputeResource": [dc_to_hf],
+        # Only the root resource pools of the compute resources
+        "ResourcePool": [dc_to_hf,
+                         build_traversal_spec(client_factory, "cr_to_rp",
+                                "ComputeResource", "resourcePool", False,
+                                [])],
+        }
+    if type not in scoped_specs:
+        return build_recursive_traversal_spec(client_factory)
+    return build_traversal_spec(client_factory, "visitFolders", "Folder",
+                                "childEntity", False,
+                                [visit_folders_select_spec] +
+                                scoped_specs[type])
+
+
+def get_scoped_traversal_spec(client_factory, type):
+    """
+    Gets the Scoped Traversal Spec for the type built with the client
+    factory. The spec is shared by the calls, so it must not be modified.
+    """
+    specs = _cached_specs.setdefault(client_factory, {})
+    key = "scoped_traversal_spec_" + type
+    if key not in specs:
+        specs[key] = build_scoped_traversal_spec(client_factory, type)
+    return specs[key]
+
+
 def build_property_spec(client_factory, type="VirtualMachine",
                         properties_to_collect=None,
                         all_properties=False):
@@ -127,7 +228,7 @@ def build_property_filter_spec(client_factory, property_specs, object_specs):
 
 def get_object_properties(vim, collector, mobj, type, properties):
     """Gets the properties of the Managed object specified."""
-    client_factory = vim.client.factory
+    client_factory = _get_spec_factory(vim)
     if mobj is None:
         return None
     usecoll = collector
@@ -159,13 +260,77 @@ def get_dynamic_property(vim, mobj, type, property_name):
 
 def get_objects(vim, type, properties_to_collect=None, all=False):
     """Gets the list of objects of the type specified."""
+    objects = []
+    result = retrieve_objects(vim, type, properties_to_collect, all)
+    while result:
+        objects.extend(result.objects)
+        token = getattr(result, "token", None)
+        if not token:
+            break
+        result = continue_retrieval(vim, token)
+    return objects
+
+
+def retrieve_objects(vim, type, properties_to_collect=None, all=False):
+    """
+    Gets the first page of the objects of the type specified, of at most
+    vmwareapi_maximum_objects objects. The token of the result, if any, is
+    used with continue_retrieval to get the next page within the same
+    session. Returns None if there are no objects.
+    """
     if not properties_to_collect:
         properties_to_collect = ["name"]
 
-    client_factory = vim.client.factory
+    client_factory = _get_spec_factory(vim)
     object_spec = build_object_spec(client_factory,
                         vim.get_service_content().rootFolder,
-                        [build_recursive_traversal_spec(client_factory)])
+                        [get_scoped_traversal_spec(client_factory, type)])
+    property_spec = build_property_spec(client_factory, type=type,
+                                properties_to_collect=properties_to_collect,
+                                all_properties=all)
+    property_filter_spec = build_property_filter_spec(client_factory,
+                                [property_spec],
+                                [object_spec])
+    options = client_factory.create('ns0:RetrieveOptions')
+    options.maxObjects = CONF.vmwareapi_maximum_objects
+    return vim.RetrievePropertiesEx(
+                                vim.get_service_content().propertyCollector,
+                                specSet=[property_filter_spec],
+                                options=options)
+
+
+def continue_retrieval(vim, token):
+    """Gets the next page of the objects of a paged retrieval."""
+    return vim.ContinueRetrievePropertiesEx(
+                                vim.get_service_content().propertyCollector,
+                                token=token)
+
+
+def cancel_retrieval(vim, token):
+    """Discards the pages of a paged retrieval not yet gotten."""
+    return vim.CancelRetrievePropertiesEx(
+                                vim.get_service_content().propertyCollector,
+                                token=token)
+
+
+def get_inner_objects(vim, base_obj, base_type, path, type,
+                      properties_to_collect=None, all=False):
+    """
+    Gets the objects of the type specified which the property path of the
+    base object refers to, e.g. the datastores of a host, without walking
+    the rest of the inventory.
+    """
+    if not properties_to_collect:
+        properties_to_collect = ["name"]
+
+    client_factory = _get_spec_factory(vim)
+    traversal_spec = build_traversal_spec(client_factory,
+                                          "%s_to_%s" % (base_type, path),
+                                          base_type, path, False, [])
+    object_spec = build_object_spec(client_factory, base_obj,
+                                    [traversal_spec])
+    # Only the objects reached from the base object are wanted
+    object_spec.skip = True
     property_spec = build_property_spec(client_factory, type=type,
                                 properties_to_collect=properties_to_collect,
                                 all_properties=all)
@@ -173,7 +338,7 @@ def get_objects(vim, type, properties_to_collect=None, all=False):
                                 [property_spec],
                                 [object_spec])
     return vim.RetrieveProperties(vim.get_service_content().propertyCollector,
-                                specSet=[property_filter_spec])
+                                  specSet=[property_filter_spec])
 
 
 def get_prop_spec(client_factory, spec_type, properties):
@@ -208,7 +373,7 @@ def get_properties_for_a_collection_of_objects(vim, type,
     Gets the list of properties for the collection of
     objects of the type specified.
     """
-    client_factory = vim.client.factory
+    client_factory = _get_spec_factory(vim)
     if len(obj_list) == 0:
         return []
     prop_spec = get_prop_spec(client_factory, type, properties)
@@ -219,3 +384,31 @@ def get_properties_for_a_collection_of_objects(vim, type,
                                             lst_obj_specs, [prop_spec])
     return vim.RetrieveProperties(vim.get_service_content().propertyCollector,
                                    specSet=[prop_filter_spec])
+
+
+def create_filter(vim, prop_filter_spec, collector=None):
+    """Creates a property filter on the property collector."""
+    if collector is None:
+        collector = vim.get_service_content().propertyCollector
+    return vim.CreateFilter(collector, spec=prop_filter_spec,
+                            partialUpdates=False)
+
+
+def destroy_filter(vim, filter_ref):
+    """Destroys a property filter."""
+    return vim.DestroyPropertyFilter(filter_ref)
+
+
+def wait_for_updates_ex(vim, version, collector=None, max_wait_seconds=0):
+    """
+    Gets the changes to the objects watched by the property filters of the
+    collector since the version specified. An empty version gets the full
+    state of the objects. Returns None if there are no changes within
+    max_wait_seconds.
+    """
+    if collector is None:
+        collector = vim.get_service_content().propertyCollector
+    wait_options = vim.client.factory.create('ns0:WaitOptions')
+    wait_options.maxWaitSeconds = max_wait_seconds
+    return vim.WaitForUpdatesEx(collector, version=version,
+                                options=wait_options)
@@ -18,6 +18,13 @@
 The VMware API VM utility module to build SOAP object specs.
 """
 
+# Maps the adapter types of the image properties to those of the
+# descriptors of the vmdk files
+VMDK_ADAPTER_TYPES = {"lsiLogic": "lsilogic",
+                      "busLogic": "buslogic",
+                      "lsiLogicsas": "lsisas1068",
+                      "ide": "ide"}
+
 
 def build_datastore_path(datastore_name, path):
     """Build the datastore compliant path."""
@@ -39,14 +46,22 @@ def split_datastore_path(datastore_path):
 
 
 def get_vm_create_spec(client_factory, instance, data_store_name,
-                       vif_infos, os_type="otherGuest"):
-    """Builds the VM Create spec."""
+                       vif_infos, os_type="otherGuest", vmx_path=None,
+                       disk_specs=None):
+    """
+    Builds the VM Create spec. The config file of the VM is put at
+    vmx_path, if given, and in a folder named after the VM otherwise. The
+    devices of disk_specs are added along with the network adapters.
+    """
     config_spec = client_factory.create('ns0:VirtualMachineConfigSpec')
     config_spec.name = instance.name
     config_spec.guestId = os_type
 
     vm_file_info = client_factory.create('ns0:VirtualMachineFileInfo')
-    vm_file_info.vmPathName = "[" + data_store_name + "]"
+    if vmx_path is not None:
+        vm_file_info.vmPathName = vmx_path
+    else:
+        vm_file_info.vmPathName = "[" + data_store_name + "]"
     config_spec.files = vm_file_info
 
     tools_info = client_factory.create('ns0:ToolsConfigInfo')
@@ -66,6 +81,8 @@ def get_vm_create_spec(client_factory, instance, data_store_name,
         vif_spec_list.append(vif_spec)
 
     device_config_spec = vif_spec_list
+    if disk_specs:
+        device_config_spec.extend(disk_specs)
 
     config_spec.deviceChange = device_config_spec
     return config_spec
@@ -143,10 +160,25 @@ def create_network_spec(client_factory, vif_info):
 
 
 def get_vmdk_attach_config_spec(client_factory, disksize, file_path,
-                                adapter_type="lsiLogic"):
-    """Builds the vmdk attach config spec."""
+                                adapter_type="lsiLogic", linked_clone=False):
+    """
+    Builds the vmdk attach config spec. For a linked clone, a delta disk
+    whose parent is the vmdk file is created and attached instead.
+    """
     config_spec = client_factory.create('ns0:VirtualMachineConfigSpec')
+    config_spec.deviceChange = get_vmdk_device_specs(client_factory,
+                                    disksize, file_path, adapter_type,
+                                    linked_clone)
+    return config_spec
 
+
+def get_vmdk_device_specs(client_factory, disksize, file_path,
+                          adapter_type="lsiLogic", linked_clone=False):
+    """
+    Builds the specs of the devices for attaching the vmdk, i.e. the disk
+    and, unless it is an IDE disk, its controller. For a linked clone, a
+    delta disk whose parent is the vmdk file is created and attached instead.
+    """
     # The controller Key pertains to the Key of the LSI Logic Controller, which
     # controls this Hard Disk
     device_config_spec = []
@@ -160,12 +192,11 @@ def get_vmdk_attach_config_spec(client_factory, disksize, file_path,
                                             controller_key)
         device_config_spec.append(controller_spec)
     virtual_device_config_spec = create_virtual_disk_spec(client_factory,
-                                disksize, controller_key, file_path)
+                                disksize, controller_key, file_path,
+                                linked_clone)
 
     device_config_spec.append(virtual_device_config_spec)
-
-    config_spec.deviceChange = device_config_spec
-    return config_spec
+    return device_config_spec
 
 
 def get_vmdk_file_path_and_adapter_type(client_factory, hardware_devices):
@@ -213,16 +244,53 @@ def get_vmdk_create_spec(client_factory, size_in_kb, adapter_type="lsiLogic"):
     return create_vmdk_spec
 
 
+def get_vmdk_descriptor(size_in_kb, adapter_type, flat_file_name,
+                        create_type="vmfs", extent_type="VMFS"):
+    """
+    Builds the descriptor of a thick provisioned (monolithicFlat) vmdk whose
+    data is in flat_file_name, the -flat.vmdk file next to it. Other kinds
+    of vmdk are described by their create and extent types.
+    """
+    sectors = size_in_kb * 2
+    if adapter_type == "ide":
+        heads = 16
+        cylinders = min(sectors / (heads * 63), 16383)
+    else:
+        heads = 255
+        cylinders = sectors / (heads * 63)
+    return "\n".join([
+        "# Disk DescriptorFile",
+        "version=1",
+        "CID=fffffffe",
+        "parentCID=ffffffff",
+        'createType="%s"' % create_type,
+        "",
+        "# Extent description",
+        'RW %d %s "%s"' % (sectors, extent_type, flat_file_name),
+        "",
+        "# The Disk Data Base",
+        "#DDB",
+        "",
+        'ddb.adapterType = "%s"' % VMDK_ADAPTER_TYPES.get(adapter_type,
+                                                         adapter_type.lower()),
+        'ddb.geometry.cylinders = "%d"' % cylinders,
+        'ddb.geometry.heads = "%d"' % heads,
+        'ddb.geometry.sectors = "63"',
+        'ddb.virtualHWVersion = "4"',
+        ""])
+
+
 def create_virtual_disk_spec(client_factory, disksize, controller_key,
-                             file_path=None):
+                             file_path=None, linked_clone=False):
     """
     Builds spec for the creation of a new/ attaching of an already existing
-    Virtual Disk to the VM.
+    Virtual Disk to the VM. For a linked clone, a delta disk backed by the
+    existing Virtual Disk at file_path is created.
     """
     virtual_device_config = client_factory.create(
                             'ns0:VirtualDeviceConfigSpec')
     virtual_device_config.operation = "add"
-    if file_path is None:
+    if file_path is None or linked_clone:
         virtual_device_config.fileOperation = "create"
 
     virtual_disk = client_factory.create('ns0:VirtualDisk')
@@ -231,10 +299,17 @@ def create_virtual_disk_spec(client_factory, disksize, controller_key,
                         'ns0:VirtualDiskFlatVer2BackingInfo')
     disk_file_backing.diskMode = "persistent"
     disk_file_backing.thinProvisioned = False
-    if file_path is not None:
+    if file_path is not None and not linked_clone:
         disk_file_backing.fileName = file_path
     else:
+        # The host names the new disk after the VM, in the VM folder
         disk_file_backing.fileName = ""
+    if linked_clone:
+        parent_file_backing = client_factory.create(
+                              'ns0:VirtualDiskFlatVer2BackingInfo')
+        parent_file_backing.diskMode = "persistent"
+        parent_file_backing.fileName = file_path
+        disk_file_backing.parent = parent_file_backing
 
     connectable_spec = client_factory.create('ns0:VirtualDeviceConnectInfo')
     connectable_spec.startConnected = True
@@ -0,0 +1,283 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright (c) 2012 VMware, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Conversion of the data of flat vmdk files to and from the streamOptimized
+vmdk format, on the fly as the data is transferred. In a streamOptimized
+vmdk, the grains of the disk are compressed and the grains holding only
+zeros are left out, so that its size follows the blocks in use rather than
+the size of the disk.
+"""
+
+import struct
+import zlib
+
+from nova import exception
+from nova.openstack.common import log as logging
+from nova.virt.vmwareapi import vm_util
+
+LOG = logging.getLogger(__name__)
+
+SECTOR_SIZE = 512
+# The grain size (sectors) and the number of entries of the grain tables of
+# the streamOptimized vmdk files written
+GRAIN_SIZE = 128
+NUM_GTES_PER_GT = 512
+
+SPARSE_MAGIC_NUMBER = 0x564d444b
+SPARSE_VERSION = 3
+FLAG_VALID_NEW_LINE_DETECTION = 0x1
+FLAG_COMPRESSED = 0x10000
+FLAG_MARKERS = 0x20000
+COMPRESSION_DEFLATE = 1
+GD_AT_END = 0xffffffffffffffff
+
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+# The SparseExtentHeader, which the stream starts and its footer ends with
+HEADER_FORMAT = "<IIIQQQQIQQQB4sH433s"
+# The marker of a compressed grain, which the grain data follows
+GRAIN_MARKER_FORMAT = "<QI"
+GRAIN_MARKER_SIZE = struct.calcsize(GRAIN_MARKER_FORMAT)
+# The marker of the metadata sectors following it
+METADATA_MARKER_FORMAT = "<QII496s"
+
+ZERO_CHUNK = "\0" * (1024 * 1024)
+
+
+def _pad(data):
+    """Pad the data with zeros to a sector boundary."""
+    return data + "\0" * (-len(data) % SECTOR_SIZE)
+
+
+def _pack_header(capacity, descriptor_size, gd_offset, over_head):
+    return struct.pack(HEADER_FORMAT, SPARSE_MAGIC_NUMBER, SPARSE_VERSION,
+                       (FLAG_VALID_NEW_LINE_DETECTION | FLAG_COMPRESSED |
+                        FLAG_MARKERS),
+                       capacity, GRAIN_SIZE, 1, descriptor_size,
+                       NUM_GTES_PER_GT, 0, gd_offset, over_head, 0,
+                       "\n \r\n", COMPRESSION_DEFLATE, "")
+
+
+def _pack_metadata_marker(num_sectors, marker_type):
+    return struct.pack(METADATA_MARKER_FORMAT, num_sectors, 0, marker_type,
+                       "")
+
+
+class StreamOptimizedReadFile(object):
+    """Reads the data of a flat vmdk file from the file handle as a
+    streamOptimized vmdk."""
+
+    def __init__(self, flat_file_handle, flat_size, adapter_type,
+                 file_name="disk.vmdk"):
+        self.flat_file_handle = flat_file_handle
+        # The capacity (sectors) is rounded up to whole grains, the last
+        # grain being padded with zeros
+        grain_bytes = GRAIN_SIZE * SECTOR_SIZE
+        self.capacity = ((flat_size + grain_bytes - 1) / grain_bytes *
+                         GRAIN_SIZE)
+        self.adapter_type = adapter_type
+        self.file_name = file_name
+        self._sector = 0
+        self._chunks = self._get_chunks()
+
+    def read(self, chunk_size):
+        """Read a chunk of the streamOptimized vmdk. The chunk size is
+        ignored, the chunks being the grains and metadata of the vmdk."""
+        try:
+            return self._chunks.next()
+        except StopIteration:
+            return ""
+
+    def close(self):
+        self.flat_file_handle.close()
+
+    def _get_grains(self):
+        """Generate the grains of the flat data."""
+        grain_bytes = GRAIN_SIZE * SECTOR_SIZE
+        pending = ""
+        while True:
+            data = self.flat_file_handle.read(grain_bytes)
+            if not data:
+                break
+            if pending:
+                data = pending + data
+            offset = 0
+            while len(data) - offset >= grain_bytes:
+                yield data[offset:offset + grain_bytes]
+                offset += grain_bytes
+            pending = data[offset:]
+        if pending:
+            yield _pad(pending)
+
+    def _emit(self, data):
+        self._sector += len(data) / SECTOR_SIZE
+        return data
+
+    def _get_grain_table(self, gt, gd):
+        """Get the grain table, unless all of its grains are zero, and add
+        it to the grain directory."""
+        if not any(gt):
+            gd.append(0)
+            return ""
+        gd.append(self._sector + 1)
+        gt_data = _pad(struct.pack("<%dI" % len(gt), *gt))
+        return self._emit(_pack_metadata_marker(len(gt_data) / SECTOR_SIZE,
+                                                MARKER_GT) + gt_data)
+
+    def _get_chunks(self):
+        descriptor = _pad(vm_util.get_vmdk_descriptor(self.capacity / 2,
+                            self.adapter_type, self.file_name,
+                            create_type="streamOptimized",
+                            extent_type="SPARSE"))
+        descriptor_size = len(descriptor) / SECTOR_SIZE
+        # The grains start at a grain boundary, the header and the
+        # descriptor being padded with zeros up to it
+        over_head = (descriptor_size + GRAIN_SIZE) / GRAIN_SIZE * GRAIN_SIZE
+        padding = "\0" * ((over_head - 1 - descriptor_size) * SECTOR_SIZE)
+        yield self._emit(_pack_header(self.capacity, descriptor_size,
+                                      GD_AT_END, over_head))
+        yield self._emit(descriptor + padding)
+
+        gd = []
+        gt = [0] * NUM_GTES_PER_GT
+        grain_index = 0
+        for grain in self._get_grains():
+            if grain.count("\0") != len(grain):
+                data = zlib.compress(grain)
+                gt[grain_index % NUM_GTES_PER_GT] = self._sector
+                yield self._emit(_pad(struct.pack(GRAIN_MARKER_FORMAT,
+                                                  grain_index * GRAIN_SIZE,
+                                                  len(data)) + data))
+            grain_index += 1
+            if grain_index % NUM_GTES_PER_GT == 0:
+                yield self._get_grain_table(gt, gd)
+                gt = [0] * NUM_GTES_PER_GT
+        if grain_index % NUM_GTES_PER_GT:
+            yield self._get_grain_table(gt, gd)
+
+        gd_offset = self._sector + 1
+        gd_data = _pad(struct.pack("<%dI" % len(gd), *gd))
+        yield self._emit(_pack_metadata_marker(len(gd_data) / SECTOR_SIZE,
+                                               MARKER_GD) + gd_data)
+        yield self._emit(_pack_metadata_marker(1, MARKER_FOOTER) +
+                         _pack_header(self.capacity, descriptor_size,
+                                      gd_offset, over_head))
+        yield self._emit(_pack_metadata_marker(0, MARKER_EOS))
+
+
+class StreamOptimizedWriteFile(object):
+    """Writes the data of the streamOptimized vmdk written to it to the
+    output as the data of a flat vmdk file of the flat size."""
+
+    def __init__(self, output, flat_size):
+        self.output = output
+        self.flat_size = flat_size
+        self.done = False
+        self._buffer = ""
+        self._offset = 0
+        self._header = None
+        self._skip = 0
+        self._written = 0
+
+    def write(self, data):
+        """Write a chunk of the streamOptimized vmdk."""
+        if self.done:
+            return
+        self._buffer = self._buffer[self._offset:] + data
+        self._offset = 0
+        self._process()
+
+    def close(self):
+        pass
+
+    def _available(self):
+        return len(self._buffer) - self._offset
+
+    def _take(self, size):
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return data
+
+    def _write_flat(self, data):
+        data = data[:self.flat_size - self._written]
+        self._written += len(data)
+        self.output.write(data)
+
+    def _write_zeros(self, size):
+        while size > 0:
+            if size >= len(ZERO_CHUNK):
+                self._write_flat(ZERO_CHUNK)
+            else:
+                self._write_flat(ZERO_CHUNK[:size])
+            size -= len(ZERO_CHUNK)
+
+    def _process(self):
+        """Convert as much of the buffered data as there is whole grains
+        and markers of."""
+        while not self.done:
+            if self._header is None:
+                if self._available() < SECTOR_SIZE:
+                    return
+                self._header = struct.unpack(HEADER_FORMAT,
+                                             self._take(SECTOR_SIZE))
+                flags = self._header[2]
+                if (self._header[0] != SPARSE_MAGIC_NUMBER or
+                        not flags & FLAG_COMPRESSED or
+                        not flags & FLAG_MARKERS):
+                    raise exception.NovaException(_("The image is not a "
+                                                    "streamOptimized vmdk"))
+                # Skip the descriptor, up to the first grain
+                self._skip = (self._header[10] - 1) * SECTOR_SIZE
+            elif self._skip:
+                skipped = min(self._skip, self._available())
+                if not skipped:
+                    return
+                self._offset += skipped
+                self._skip -= skipped
+            else:
+                if self._available() < GRAIN_MARKER_SIZE:
+                    return
+                lba, size = struct.unpack(GRAIN_MARKER_FORMAT,
+                        self._buffer[self._offset:
+                                     self._offset + GRAIN_MARKER_SIZE])
+                if size:
+                    grain_size = len(_pad("\0" * (GRAIN_MARKER_SIZE + size)))
+                    if self._available() < grain_size:
+                        return
+                    data = self._take(grain_size)
+                    if lba * SECTOR_SIZE < self._written:
+                        raise exception.NovaException(_("The grains of the "
+                                                        "vmdk are out of "
+                                                        "order"))
+                    self._write_zeros(lba * SECTOR_SIZE - self._written)
+                    self._write_flat(zlib.decompress(
+                            data[GRAIN_MARKER_SIZE:GRAIN_MARKER_SIZE + size]))
+                else:
+                    if self._available() < SECTOR_SIZE:
+                        return
+                    num_sectors, size, marker_type, pad = struct.unpack(
+                            METADATA_MARKER_FORMAT, self._take(SECTOR_SIZE))
+                    if marker_type == MARKER_EOS:
+                        self._write_zeros(self.flat_size - self._written)
+                        self.done = True
+                    else:
+                        # The grain tables, directory and the footer are
+                        # not needed, the grains coming in order
+                        self._skip = num_sectors * SECTOR_SIZE
@@ -22,16 +22,22 @@ Class for VM tasks like spawn, snapshot, suspend, resume etc.
 
 import base64
 import os
-import time
 import urllib
 import urllib2
 import uuid
 
+from eventlet import semaphore
+
 from nova.compute import power_state
 from nova import exception
 from nova.openstack.common import cfg
 from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+from nova import utils
+from nova.virt.vmwareapi import datastore
+from nova.virt.vmwareapi import error_util
+from nova.virt.vmwareapi import imagecache
 from nova.virt.vmwareapi import network_util
 from nova.virt.vmwareapi import vif as vmwarevif
 from nova.virt.vmwareapi import vim_util
@@ -39,7 +45,33 @@ from nova.virt.vmwareapi import vm_util
 from nova.virt.vmwareapi import vmware_images
 
 
+vmware_vmops_opts = [
+    cfg.BoolOpt('vmwareapi_use_linked_clone',
+                default=False,
+                help='Should the disk of an instance be a delta disk backed '
+                     'by the cached image, rather than a full copy of it? '
+                     'The vmware_linked_clone property of an image overrides '
+                     'this. '
+                     'Used only if compute_driver is '
+                     'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_max_concurrent_destroys',
+               default=8,
+               help='The maximum number of instances destroyed at the same '
+                    'time on the host, or on the cluster. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_vm_ref_cache_miss_ttl',
+               default=60,
+               help='The time (seconds) after a lookup of the VMs of the '
+                    'host during which a VM not found is taken not to '
+                    'exist, rather than looked up again. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    ]
+
 CONF = cfg.CONF
+CONF.register_opts(vmware_vmops_opts)
+CONF.import_opt('flat_injected', 'nova.network.manager')
 
 LOG = logging.getLogger(__name__)
 
@@ -49,31 +81,82 @@ VMWARE_POWER_STATES = {
                     'suspended': power_state.PAUSED}
 
 
+class VMRefCache(dict):
+    """
+    Maps the VM name to its Managed Object Reference. Kept current by the
+    VMs the driver creates and unregisters, and refreshed from the inventory
+    on a lookup miss, unless it was refreshed less than
+    vmwareapi_vm_ref_cache_miss_ttl ago. The VMwareVMOps of the clusters of
+    a driver share one, as the VMs are found by name whichever the cluster.
+    """
+
+    def __init__(self):
+        super(VMRefCache, self).__init__()
+        self.refreshed_at = None
+
+
 class VMwareVMOps(object):
     """Management class for VM-related tasks."""
 
-    def __init__(self, session):
-        """Initializer."""
+    def __init__(self, session, virtapi, inventory=None, cluster=None,
+                 vm_ref_cache=None):
+        """
+        Initializer. If a cluster is given, the instances are created in
+        its resource pool, on its datastores, and just the VMs of its
+        resource pool are listed.
+        """
         self._session = session
+        self._virtapi = virtapi
+        self._inventory = inventory
+        self._cluster = cluster
+        # The (reference, name) of the datacenter of the cluster
+        self._cluster_datacenter = None
+        # The resource pool of the cluster
+        self._cluster_res_pool = None
+        if vm_ref_cache is None:
+            vm_ref_cache = VMRefCache()
+        self._vm_ref_cache = vm_ref_cache
+        self._datastore_selector = datastore.DatastoreSelector(session,
+                                                               cluster)
+        self._network_cache = network_util.HostNetworkCache(session, cluster)
+        self._image_cache = imagecache.ImageCacheManager(session,
+                                                self._datastore_selector)
+        self._folder_reaper = datastore.FolderReaper(session)
+        self._destroy_semaphore = semaphore.Semaphore(
+                max(1, CONF.vmwareapi_max_concurrent_destroys))
 
     def list_instances(self):
         """Lists the VM instances that are registered with the ESX host."""
         LOG.debug(_("Getting list of instances"))
-        vms = self._session._call_method(vim_util, "get_objects",
-                     "VirtualMachine",
-                     ["name", "runtime.connectionState"])
+        if self._inventory_is_active():
+            vms = [props for vm_ref, props in
+                   self._inventory.get_objects("VirtualMachine")]
+            if self._cluster is not None:
+                res_pool_key = vim_util.get_mo_ref_key(
+                        self._get_cluster_res_pool())
+                vms = [props for props in vms
+                       if vim_util.get_mo_ref_key(
+                           props.get("resourcePool")) == res_pool_key]
+        elif self._cluster is not None:
+            vms = []
+            for vm in self._session._call_method(vim_util,
+                        "get_inner_objects", self._get_cluster_res_pool(),
+                        "ResourcePool", "vm", "VirtualMachine",
+                        ["name", "runtime.connectionState"]):
+                vms.append(dict((prop.name, prop.val)
+                                for prop in vm.propSet))
+        else:
+            vms = []
+            for vm in self._session._iter_objects("VirtualMachine",
+                         ["name", "runtime.connectionState"]):
+                vms.append(dict((prop.name, prop.val)
+                                for prop in vm.propSet))
         lst_vm_names = []
-        for vm in vms:
-            vm_name = None
-            conn_state = None
-            for prop in vm.propSet:
-                if prop.name == "name":
-                    vm_name = prop.val
-                elif prop.name == "runtime.connectionState":
-                    conn_state = prop.val
+        for props in vms:
             # Ignoring the oprhaned or inaccessible VMs
-            if conn_state not in ["orphaned", "inaccessible"]:
-                lst_vm_names.append(vm_name)
+            if (props.get("runtime.connectionState") not in
+                    ["orphaned", "inaccessible"]):
+                lst_vm_names.append(props.get("name"))
         LOG.debug(_("Got total of %s instances") % str(len(lst_vm_names)))
         return lst_vm_names
 
@@ -83,47 +166,24 @@ class VMwareVMOps(object):
 
         Steps followed are:
 
-        1. Create a VM with no disk and the specifics in the instance object
-           like RAM size.
-        2. Create a dummy vmdk of the size of the disk file that is to be
-           uploaded. This is required just to create the metadata file.
-        3. Delete the -flat.vmdk file created in the above step and retain
-           the metadata .vmdk file.
-        4. Upload the disk file.
-        5. Attach the disk to the VM by reconfiguring the same.
-        6. Power on the VM.
+        1. Get the image disk cached on the datastore, downloading it from
+           Glance if it is not there yet.
+        2. Copy the cached disk to the folder of the VM, unless the VM is a
+           linked clone.
+        3. Create a VM with the disk, the network adapters and the specifics
+           in the instance object like RAM size. A linked clone gets a delta
+           disk backed by the cached disk instead.
+        4. Power on the VM.
         """
-        vm_ref = self._get_vm_ref_from_the_name(instance.name)
-        if vm_ref:
+        # A name missing from the cache is looked up on the host, at most
+        # once in vmwareapi_vm_ref_cache_miss_ttl. A VM of the name created
+        # since is refused by the host, as checked by _execute_create_vm.
+        if self._get_vm_ref_from_the_name(instance.name):
             raise exception.InstanceExists(name=instance.name)
 
         client_factory = self._session._get_vim().client.factory
         service_content = self._session._get_vim().get_service_content()
 
-        def _get_datastore_ref():
-            """Get the datastore list and choose the first local storage."""
-            data_stores = self._session._call_method(vim_util, "get_objects",
-                        "Datastore", ["summary.type", "summary.name"])
-            for elem in data_stores:
-                ds_name = None
-                ds_type = None
-                for prop in elem.propSet:
-                    if prop.name == "summary.type":
-                        ds_type = prop.val
-                    elif prop.name == "summary.name":
-                        ds_name = prop.val
-                # Local storage identifier
-                if ds_type == "VMFS":
-                    data_store_name = ds_name
-                    return data_store_name
-
-            if data_store_name is None:
-                msg = _("Couldn't get a local Datastore reference")
-                LOG.error(msg, instance=instance)
-                raise exception.NovaException(msg)
-
-        data_store_name = _get_datastore_ref()
-
         def _get_image_properties():
             """
             Get the Size of the flat vmdk file that is there on the storage
@@ -137,12 +197,28 @@ class VMwareVMOps(object):
             os_type = image_properties.get("vmware_ostype", "otherGuest")
             adapter_type = image_properties.get("vmware_adaptertype",
                                                 "lsiLogic")
-            return vmdk_file_size_in_kb, os_type, adapter_type
+            linked_clone = image_properties.get("vmware_linked_clone")
+            if linked_clone is None:
+                linked_clone = CONF.vmwareapi_use_linked_clone
+            else:
+                linked_clone = utils.bool_from_str(linked_clone)
+            return vmdk_file_size_in_kb, os_type, adapter_type, linked_clone
+
+        (vmdk_file_size_in_kb, os_type, adapter_type,
+         linked_clone) = _get_image_properties()
 
-        vmdk_file_size_in_kb, os_type, adapter_type = _get_image_properties()
+        data_store_name = self._datastore_selector.select(
+                                        vmdk_file_size_in_kb * 1024)[0]
 
         def _get_vmfolder_and_res_pool_mors():
             """Get the Vm folder ref from the datacenter."""
+            if self._cluster is not None:
+                dc_ref = self._get_datacenter_name_and_ref()[0]
+                vm_folder_mor = self._session._call_method(vim_util,
+                        "get_dynamic_property", dc_ref, "Datacenter",
+                        "vmFolder")
+                return vm_folder_mor, self._get_cluster_res_pool()
+
             dc_objs = self._session._call_method(vim_util, "get_objects",
                                     "Datacenter", ["vmFolder"])
             # There is only one default datacenter in a standalone ESX host
@@ -157,8 +233,8 @@ class VMwareVMOps(object):
         vm_folder_mor, res_pool_mor = _get_vmfolder_and_res_pool_mors()
 
         def _check_if_network_bridge_exists(network_name):
-            network_ref = network_util.get_network_with_the_name(
-                          self._session, network_name)
+            network_ref = self._network_cache.get_network_with_the_name(
+                          network_name)
             if network_ref is None:
                 raise exception.NetworkNotFoundForBridge(bridge=network_name)
             return network_ref
@@ -170,7 +246,7 @@ class VMwareVMOps(object):
                 network_name = network['bridge']
                 if mapping.get('should_create_vlan'):
                     network_ref = vmwarevif.ensure_vlan_bridge(
-                        self._session, network)
+                        self._session, network, self._network_cache)
                 else:
                     network_ref = _check_if_network_bridge_exists(network_name)
                 vif_infos.append({'network_name': network_name,
@@ -181,10 +257,87 @@ class VMwareVMOps(object):
 
         vif_infos = _get_vif_infos()
 
-        # Get the create vm config spec
+        dc_ref, dc_name = self._get_datacenter_name_and_ref()
+
+        # Get the image cached on the datastore, downloading it from Glance
+        # if it is not there yet
+        cached_vmdk_path = self._image_cache.fetch_image(context, instance,
+                                    data_store_name, dc_ref, dc_name,
+                                    vmdk_file_size_in_kb, adapter_type)
+
+        # The delta disk of a linked clone must be on the datastore of its
+        # parent
+        if (linked_clone and vm_util.split_datastore_path(
+                cached_vmdk_path)[0] != data_store_name):
+            LOG.debug(_("The cached image %s is on another datastore, "
+                        "copying it instead of linking to it") %
+                      cached_vmdk_path, instance=instance)
+            linked_clone = False
+
+        # Naming the VM files in correspondence with the VM instance name
+        vm_folder_path = vm_util.build_datastore_path(data_store_name,
+                                                      instance.name)
+        # The folder of an instance of the same name destroyed before may
+        # still be queued for deletion
+        self._folder_reaper.wait_for(vm_folder_path)
+        # The vmdk meta-data file
+        uploaded_vmdk_path = "%s/%s.vmdk" % (vm_folder_path, instance.name)
+
+        def _copy_cached_image():
+            """Copy the cached image disk to the folder of the VM."""
+            LOG.debug(_("Copying the cached image %(cached_vmdk_path)s to "
+                        "%(uploaded_vmdk_path)s") %
+                        {"cached_vmdk_path": cached_vmdk_path,
+                         "uploaded_vmdk_path": uploaded_vmdk_path},
+                      instance=instance)
+            # The folder is made here, rather than by the creation of the
+            # VM, so that the disk can be part of the creation.
+            datastore.mkdir(self._session, vm_folder_path)
+            copy_spec = vm_util.get_copy_virtual_disk_spec(client_factory,
+                                                           adapter_type)
+            with self._session._heavy_task():
+                copy_disk_task = self._session._call_method(
+                    self._session._get_vim(),
+                    "CopyVirtualDisk_Task",
+                    service_content.virtualDiskManager,
+                    sourceName=cached_vmdk_path,
+                    sourceDatacenter=dc_ref,
+                    destName=uploaded_vmdk_path,
+                    destDatacenter=dc_ref,
+                    destSpec=copy_spec,
+                    force=False)
+                self._session._wait_for_task(instance['uuid'],
+                                             copy_disk_task)
+            LOG.debug(_("Copied the cached image to %s") % uploaded_vmdk_path,
+                      instance=instance)
+
+        if linked_clone:
+            # The host creates the folder of the VM, along with the delta
+            # disk in it
+            vmdk_path = cached_vmdk_path
+            vmx_path = None
+        else:
+            _copy_cached_image()
+            vmdk_path = uploaded_vmdk_path
+            vmx_path = "%s/%s.vmx" % (vm_folder_path, instance.name)
+
+        # Get the create vm config spec. The disk and the network adapters
+        # are added by the creation itself, rather than by reconfiguring the
+        # VM afterwards.
+        disk_specs = vm_util.get_vmdk_device_specs(client_factory,
+                                vmdk_file_size_in_kb, vmdk_path,
+                                adapter_type, linked_clone)
         config_spec = vm_util.get_vm_create_spec(
                             client_factory, instance,
-                            data_store_name, vif_infos, os_type)
+                            data_store_name, vif_infos, os_type,
+                            vmx_path=vmx_path, disk_specs=disk_specs)
+
+        # Set the machine.id parameter of the instance to inject
+        # the NIC configuration inside the VM
+        if CONF.flat_injected:
+            config_spec.extraConfig = vm_util.get_machine_id_change_spec(
+                    client_factory,
+                    self._get_machine_id_str(network_info)).extraConfig
 
         def _execute_create_vm():
             """Create VM on ESX host."""
@@ -194,134 +347,21 @@ class VMwareVMOps(object):
                                     self._session._get_vim(),
                                     "CreateVM_Task", vm_folder_mor,
                                     config=config_spec, pool=res_pool_mor)
-            self._session._wait_for_task(instance['uuid'], vm_create_task)
+            task_info = self._session._wait_for_task_completion(
+                                                    vm_create_task)
+            if task_info.state == "error":
+                fault = getattr(task_info.error, "fault", None)
+                if (fault.__class__.__name__ ==
+                        error_util.FAULT_DUPLICATE_NAME):
+                    raise exception.InstanceExists(name=instance.name)
+                raise exception.NovaException(
+                        str(task_info.error.localizedMessage))
+            self._vm_ref_cache[instance.name] = task_info.result
 
             LOG.debug(_("Created VM on the ESX  host"), instance=instance)
+            return task_info.result
 
-        _execute_create_vm()
-
-        # Set the machine.id parameter of the instance to inject
-        # the NIC configuration inside the VM
-        if CONF.flat_injected:
-            self._set_machine_id(client_factory, instance, network_info)
-
-        # Naming the VM files in correspondence with the VM instance name
-        # The flat vmdk file name
-        flat_uploaded_vmdk_name = "%s/%s-flat.vmdk" % (instance.name,
-                                                       instance.name)
-        # The vmdk meta-data file
-        uploaded_vmdk_name = "%s/%s.vmdk" % (instance.name, instance.name)
-        flat_uploaded_vmdk_path = vm_util.build_datastore_path(data_store_name,
-                                            flat_uploaded_vmdk_name)
-        uploaded_vmdk_path = vm_util.build_datastore_path(data_store_name,
-                                            uploaded_vmdk_name)
-
-        def _create_virtual_disk():
-            """Create a virtual disk of the size of flat vmdk file."""
-            # Create a Virtual Disk of the size of the flat vmdk file. This is
-            # done just to generate the meta-data file whose specifics
-            # depend on the size of the disk, thin/thick provisioning and the
-            # storage adapter type.
-            # Here we assume thick provisioning and lsiLogic for the adapter
-            # type
-            LOG.debug(_("Creating Virtual Disk of size  "
-                      "%(vmdk_file_size_in_kb)s KB and adapter type  "
-                      "%(adapter_type)s on the ESX host local store"
-                      " %(data_store_name)s") %
-                       {"vmdk_file_size_in_kb": vmdk_file_size_in_kb,
-                        "adapter_type": adapter_type,
-                        "data_store_name": data_store_name},
-                      instance=instance)
-            vmdk_create_spec = vm_util.get_vmdk_create_spec(client_factory,
-                                    vmdk_file_size_in_kb, adapter_type)
-            vmdk_create_task = self._session._call_method(
-                self._session._get_vim(),
-                "CreateVirtualDisk_Task",
-                service_content.virtualDiskManager,
-                name=uploaded_vmdk_path,
-                datacenter=self._get_datacenter_name_and_ref()[0],
-                spec=vmdk_create_spec)
-            self._session._wait_for_task(instance['uuid'], vmdk_create_task)
-            LOG.debug(_("Created Virtual Disk of size %(vmdk_file_size_in_kb)s"
-                        " KB on the ESX host local store "
-                        "%(data_store_name)s") %
-                        {"vmdk_file_size_in_kb": vmdk_file_size_in_kb,
-                         "data_store_name": data_store_name},
-                      instance=instance)
-
-        _create_virtual_disk()
-
-        def _delete_disk_file():
-            LOG.debug(_("Deleting the file %(flat_uploaded_vmdk_path)s "
-                        "on the ESX host local"
-                        "store %(data_store_name)s") %
-                        {"flat_uploaded_vmdk_path": flat_uploaded_vmdk_path,
-                         "data_store_name": data_store_name},
-                      instance=instance)
-            # Delete the -flat.vmdk file created. .vmdk file is retained.
-            vmdk_delete_task = self._session._call_method(
-                        self._session._get_vim(),
-                        "DeleteDatastoreFile_Task",
-                        service_content.fileManager,
-                        name=flat_uploaded_vmdk_path)
-            self._session._wait_for_task(instance['uuid'], vmdk_delete_task)
-            LOG.debug(_("Deleted the file %(flat_uploaded_vmdk_path)s on the "
-                        "ESX host local store %(data_store_name)s") %
-                        {"flat_uploaded_vmdk_path": flat_uploaded_vmdk_path,
-                         "data_store_name": data_store_name},
-                      instance=instance)
-
-        _delete_disk_file()
-
-        cookies = self._session._get_vim().client.options.transport.cookiejar
-
-        def _fetch_image_on_esx_datastore():
-            """Fetch image from Glance to ESX datastore."""
-            LOG.debug(_("Downloading image file data %(image_ref)s to the ESX "
-                        "data store %(data_store_name)s") %
-                        {'image_ref': instance.image_ref,
-                         'data_store_name': data_store_name},
-                      instance=instance)
-            # Upload the -flat.vmdk file whose meta-data file we just created
-            # above
-            vmware_images.fetch_image(
-                context,
-                instance.image_ref,
-                instance,
-                host=self._session._host_ip,
-                data_center_name=self._get_datacenter_name_and_ref()[1],
-                datastore_name=data_store_name,
-                cookies=cookies,
-                file_path=flat_uploaded_vmdk_name)
-            LOG.debug(_("Downloaded image file data %(image_ref)s to the ESX "
-                        "data store %(data_store_name)s") %
-                        {'image_ref': instance.image_ref,
-                         'data_store_name': data_store_name},
-                      instance=instance)
-        _fetch_image_on_esx_datastore()
-
-        vm_ref = self._get_vm_ref_from_the_name(instance.name)
-
-        def _attach_vmdk_to_the_vm():
-            """
-            Attach the vmdk uploaded to the VM. VM reconfigure is done
-            to do so.
-            """
-            vmdk_attach_config_spec = vm_util.get_vmdk_attach_config_spec(
-                                client_factory,
-                                vmdk_file_size_in_kb, uploaded_vmdk_path,
-                                adapter_type)
-            LOG.debug(_("Reconfiguring VM instance to attach the image disk"),
-                      instance=instance)
-            reconfig_task = self._session._call_method(
-                               self._session._get_vim(),
-                               "ReconfigVM_Task", vm_ref,
-                               spec=vmdk_attach_config_spec)
-            self._session._wait_for_task(instance['uuid'], reconfig_task)
-            LOG.debug(_("Reconfigured VM instance to attach the image disk"),
-                      instance=instance)
-
-        _attach_vmdk_to_the_vm()
+        vm_ref = _execute_create_vm()
 
         def _power_on_vm():
             """Power on the VM."""
@@ -333,6 +373,7 @@ class VMwareVMOps(object):
             self._session._wait_for_task(instance['uuid'], power_on_task)
             LOG.debug(_("Powered on the VM instance"), instance=instance)
         _power_on_vm()
+        self._update_inventory()
 
     def snapshot(self, context, instance, snapshot_name):
         """Create snapshot from a running VM instance.
@@ -412,8 +453,7 @@ class VMwareVMOps(object):
             tmp_folder_path = vm_util.build_datastore_path(datastore_name,
                                                            "vmware-tmp")
             if not self._path_exists(ds_browser, tmp_folder_path):
-                self._mkdir(vm_util.build_datastore_path(datastore_name,
-                                                         "vmware-tmp"))
+                datastore.mkdir(self._session, tmp_folder_path)
 
         _check_if_tmp_folder_exists()
 
@@ -432,17 +472,19 @@ class VMwareVMOps(object):
                                                             adapter_type)
             LOG.debug(_('Copying disk data before snapshot of the VM'),
                       instance=instance)
-            copy_disk_task = self._session._call_method(
-                self._session._get_vim(),
-                "CopyVirtualDisk_Task",
-                service_content.virtualDiskManager,
-                sourceName=vmdk_file_path_before_snapshot,
-                sourceDatacenter=dc_ref,
-                destName=dest_vmdk_file_location,
-                destDatacenter=dc_ref,
-                destSpec=copy_spec,
-                force=False)
-            self._session._wait_for_task(instance['uuid'], copy_disk_task)
+            with self._session._heavy_task():
+                copy_disk_task = self._session._call_method(
+                    self._session._get_vim(),
+                    "CopyVirtualDisk_Task",
+                    service_content.virtualDiskManager,
+                    sourceName=vmdk_file_path_before_snapshot,
+                    sourceDatacenter=dc_ref,
+                    destName=dest_vmdk_file_location,
+                    destDatacenter=dc_ref,
+                    destSpec=copy_spec,
+                    force=False)
+                self._session._wait_for_task(instance['uuid'],
+                                             copy_disk_task)
             LOG.debug(_("Copied disk data before snapshot of the VM"),
                       instance=instance)
 
@@ -450,22 +492,29 @@ class VMwareVMOps(object):
 
         cookies = self._session._get_vim().client.options.transport.cookiejar
 
+        def _update_upload_progress(transferred, total):
+            self._update_instance_progress(context, instance, transferred,
+                                           total)
+
         def _upload_vmdk_to_image_repository():
             # Upload the contents of -flat.vmdk file which has the disk data.
             LOG.debug(_("Uploading image %s") % snapshot_name,
                       instance=instance)
-            vmware_images.upload_image(
-                context,
-                snapshot_name,
-                instance,
-                os_type=os_type,
-                adapter_type=adapter_type,
-                image_version=1,
-                host=self._session._host_ip,
-                data_center_name=self._get_datacenter_name_and_ref()[1],
-                datastore_name=datastore_name,
-                cookies=cookies,
-                file_path="vmware-tmp/%s-flat.vmdk" % random_name)
+            dc_name = self._get_datacenter_name_and_ref()[1]
+            with self._session._heavy_task():
+                vmware_images.upload_image(
+                    context,
+                    snapshot_name,
+                    instance,
+                    os_type=os_type,
+                    adapter_type=adapter_type,
+                    image_version=1,
+                    host=self._session._host_ip,
+                    data_center_name=dc_name,
+                    datastore_name=datastore_name,
+                    cookies=cookies,
+                    file_path="vmware-tmp/%s-flat.vmdk" % random_name,
+                    progress_callback=_update_upload_progress)
             LOG.debug(_("Uploaded image %s") % snapshot_name,
                       instance=instance)
 
@@ -535,14 +584,22 @@ class VMwareVMOps(object):
                                                     "ResetVM_Task", vm_ref)
             self._session._wait_for_task(instance['uuid'], reset_task)
             LOG.debug(_("Did hard reboot of VM"), instance=instance)
+            self._update_inventory()
 
     def destroy(self, instance, network_info):
         """
         Destroy a VM instance. Steps followed are:
         1. Power off the VM, if it is in poweredOn state.
         2. Un-register a VM.
-        3. Delete the contents of the folder holding the VM related data.
+        3. Queue the folder holding the VM related data for deletion, which
+           the folder reaper does in the background.
+        Up to vmwareapi_max_concurrent_destroys instances are destroyed at
+        the same time, the others waiting for their turn.
         """
+        with self._destroy_semaphore:
+            self._destroy(instance, network_info)
+
+    def _destroy(self, instance, network_info):
         try:
             vm_ref = self._get_vm_ref_from_the_name(instance.name)
             if vm_ref is None:
@@ -553,16 +610,13 @@ class VMwareVMOps(object):
                         "get_object_properties",
                         None, vm_ref, "VirtualMachine", lst_properties)
             pwr_state = None
+            vm_config_pathname = None
             for elem in props:
-                vm_config_pathname = None
                 for prop in elem.propSet:
                     if prop.name == "runtime.powerState":
                         pwr_state = prop.val
                     elif prop.name == "config.files.vmPathName":
                         vm_config_pathname = prop.val
-            if vm_config_pathname:
-                _ds_path = vm_util.split_datastore_path(vm_config_pathname)
-                datastore_name, vmx_file_path = _ds_path
             # Power off the VM if it is in PoweredOn state.
             if pwr_state == "poweredOn":
                 LOG.debug(_("Powering off the VM"), instance=instance)
@@ -577,7 +631,9 @@ class VMwareVMOps(object):
                 LOG.debug(_("Unregistering the VM"), instance=instance)
                 self._session._call_method(self._session._get_vim(),
                         "UnregisterVM", vm_ref)
+                self._vm_ref_cache.pop(instance.name, None)
                 LOG.debug(_("Unregistered the VM"), instance=instance)
+                self._update_inventory()
             except Exception, excep:
                 LOG.warn(_("In vmwareapi:vmops:destroy, got this exception"
                            " while un-registering the VM: %s") % str(excep),
@@ -585,32 +641,19 @@ class VMwareVMOps(object):
 
             self.unplug_vifs(instance, network_info)
 
-            # Delete the folder holding the VM related content on
-            # the datastore.
-            try:
+            # Queue the folder holding the VM related content on the
+            # datastore for deletion.
+            if vm_config_pathname:
+                datastore_name, vmx_file_path = vm_util.split_datastore_path(
+                                                    vm_config_pathname)
                 dir_ds_compliant_path = vm_util.build_datastore_path(
                                  datastore_name,
                                  os.path.dirname(vmx_file_path))
-                LOG.debug(_("Deleting contents of the VM from "
-                            "datastore %(datastore_name)s") %
-                           {'datastore_name': datastore_name},
-                          instance=instance)
-                delete_task = self._session._call_method(
-                    self._session._get_vim(),
-                    "DeleteDatastoreFile_Task",
-                    self._session._get_vim().get_service_content().fileManager,
-                    name=dir_ds_compliant_path)
-                self._session._wait_for_task(instance['uuid'], delete_task)
-                LOG.debug(_("Deleted contents of the VM from "
-                            "datastore %(datastore_name)s") %
+                LOG.debug(_("Queued the contents of the VM for deletion "
+                            "from datastore %(datastore_name)s") %
                            {'datastore_name': datastore_name},
                           instance=instance)
-            except Exception, excep:
-                LOG.warn(_("In vmwareapi:vmops:destroy, "
-                             "got this exception while deleting"
-                             " the VM contents from the disk: %s")
-                             % str(excep),
-                         instance=instance)
+                self._folder_reaper.reap(dir_ds_compliant_path)
         except Exception, exc:
             LOG.exception(exc, instance=instance)
 
@@ -638,6 +681,7 @@ class VMwareVMOps(object):
                     "SuspendVM_Task", vm_ref)
             self._session._wait_for_task(instance['uuid'], suspend_task)
             LOG.debug(_("Suspended the VM"), instance=instance)
+            self._update_inventory()
         # Raise Exception if VM is poweredOff
         elif pwr_state == "poweredOff":
             reason = _("instance is powered off and can not be suspended.")
@@ -662,6 +706,7 @@ class VMwareVMOps(object):
                                        "PowerOnVM_Task", vm_ref)
             self._session._wait_for_task(instance['uuid'], suspend_task)
             LOG.debug(_("Resumed the VM"), instance=instance)
+            self._update_inventory()
         else:
             reason = _("instance is not in a suspended state")
             raise exception.InstanceResumeFailure(reason=reason)
@@ -672,24 +717,106 @@ class VMwareVMOps(object):
         if vm_ref is None:
             raise exception.InstanceNotFound(instance_id=instance['name'])
 
+        if self._inventory_is_active():
+            props = self._inventory.get_properties("VirtualMachine", vm_ref)
+            if props is not None:
+                return self._get_info_from_props(props)
+
         lst_properties = ["summary.config.numCpu",
                     "summary.config.memorySizeMB",
                     "runtime.powerState"]
-        vm_props = self._session._call_method(vim_util,
-                    "get_object_properties", None, vm_ref, "VirtualMachine",
+        try:
+            vm_props = self._session._call_method(vim_util,
+                        "get_object_properties", None, vm_ref,
+                        "VirtualMachine", lst_properties)
+        except error_util.VimFaultException, excep:
+            # The cached reference is stale, e.g. the VM was removed from
+            # the host behind our back. Look it up afresh.
+            if (error_util.FAULT_MANAGED_OBJECT_NOT_FOUND not in
+                    excep.fault_list):
+                raise
+            self._refresh_vm_ref_cache()
+            vm_ref = self._vm_ref_cache.get(instance['name'])
+            if vm_ref is None:
+                raise exception.InstanceNotFound(
+                                    instance_id=instance['name'])
+            vm_props = self._session._call_method(vim_util,
+                        "get_object_properties", None, vm_ref,
+                        "VirtualMachine", lst_properties)
+        props = {}
+        for elem in vm_props:
+            for prop in elem.propSet:
+                props[prop.name] = prop.val
+        return self._get_info_from_props(props)
+
+    def get_info_bulk(self, instances):
+        """
+        Return data about the VM instances, keyed by the instance uuid. The
+        properties of all the VMs are fetched in a single call.
+        """
+        try:
+            return self._get_info_bulk(instances)
+        except error_util.VimFaultException, excep:
+            # Some of the cached references are stale. Look them up afresh
+            # and try once more.
+            if (error_util.FAULT_MANAGED_OBJECT_NOT_FOUND not in
+                    excep.fault_list):
+                raise
+            self._refresh_vm_ref_cache()
+            return self._get_info_bulk(instances)
+
+    def _get_info_bulk(self, instances):
+        """Return data about the VM instances, keyed by the instance uuid."""
+        if ([i for i in instances if i['name'] not in self._vm_ref_cache] and
+                not self._vm_ref_cache_misses_are_fresh()):
+            self._refresh_vm_ref_cache()
+        vm_refs = {}
+        for instance in instances:
+            vm_ref = self._vm_ref_cache.get(instance['name'])
+            if vm_ref is not None:
+                vm_refs[vim_util.get_mo_ref_key(vm_ref)] = (vm_ref,
+                                                            instance['uuid'])
+        if not vm_refs:
+            return {}
+
+        infos = {}
+        if self._inventory_is_active():
+            for vm_ref, instance_uuid in vm_refs.itervalues():
+                props = self._inventory.get_properties("VirtualMachine",
+                                                       vm_ref)
+                if props is not None:
+                    infos[instance_uuid] = self._get_info_from_props(props)
+            if len(infos) == len(vm_refs):
+                return infos
+
+        lst_properties = ["summary.config.numCpu",
+                    "summary.config.memorySizeMB",
+                    "runtime.powerState"]
+        vms = self._session._call_method(vim_util,
+                    "get_properties_for_a_collection_of_objects",
+                    "VirtualMachine",
+                    [vm_ref for vm_ref, instance_uuid in vm_refs.itervalues()],
                     lst_properties)
+        for vm in vms:
+            props = {}
+            for prop in vm.propSet:
+                props[prop.name] = prop.val
+            instance_uuid = vm_refs[vim_util.get_mo_ref_key(vm.obj)][1]
+            infos[instance_uuid] = self._get_info_from_props(props)
+        return infos
+
+    def _get_info_from_props(self, props):
+        """Builds the VM info out of the VM properties."""
         max_mem = None
         pwr_state = None
         num_cpu = None
-        for elem in vm_props:
-            for prop in elem.propSet:
-                if prop.name == "summary.config.numCpu":
-                    num_cpu = int(prop.val)
-                elif prop.name == "summary.config.memorySizeMB":
-                    # In MB, but we want in KB
-                    max_mem = int(prop.val) * 1024
-                elif prop.name == "runtime.powerState":
-                    pwr_state = VMWARE_POWER_STATES[prop.val]
+        if "summary.config.numCpu" in props:
+            num_cpu = int(props["summary.config.numCpu"])
+        if "summary.config.memorySizeMB" in props:
+            # In MB, but we want in KB
+            max_mem = int(props["summary.config.memorySizeMB"]) * 1024
+        if "runtime.powerState" in props:
+            pwr_state = VMWARE_POWER_STATES[props["runtime.powerState"]]
 
         return {'state': pwr_state,
                 'max_mem': max_mem,
@@ -723,15 +850,11 @@ class VMwareVMOps(object):
         else:
             return ""
 
-    def _set_machine_id(self, client_factory, instance, network_info):
+    def _get_machine_id_str(self, network_info):
         """
-        Set the machine id of the VM for guest tools to pick up and reconfigure
-        the network interfaces.
+        Gets the machine id of the VM for guest tools to pick up and
+        reconfigure the network interfaces.
         """
-        vm_ref = self._get_vm_ref_from_the_name(instance.name)
-        if vm_ref is None:
-            raise exception.InstanceNotFound(instance_id=instance.id)
-
         machine_id_str = ''
         for (network, info) in network_info:
             # TODO(vish): add support for dns2
@@ -753,29 +876,60 @@ class VMwareVMOps(object):
                                       info['broadcast'],
                                       dns])
             machine_id_str = machine_id_str + interface_str + '#'
+        return machine_id_str
 
-        machine_id_change_spec = vm_util.get_machine_id_change_spec(
-                                 client_factory, machine_id_str)
-
-        LOG.debug(_("Reconfiguring VM instance to set the machine id "
-                  "with ip - %(ip_addr)s") %
-                  {'ip_addr': ip_v4['ip']},
-                  instance=instance)
-        reconfig_task = self._session._call_method(self._session._get_vim(),
-                           "ReconfigVM_Task", vm_ref,
-                           spec=machine_id_change_spec)
-        self._session._wait_for_task(instance['uuid'], reconfig_task)
-        LOG.debug(_("Reconfigured VM instance to set the machine id "
-                  "with ip - %(ip_addr)s") %
-                  {'ip_addr': ip_v4['ip']},
+    def _update_instance_progress(self, context, instance, step,
+                                  total_steps):
+        """Update instance progress percent to reflect current step number.
+        """
+        progress = round(float(step) / total_steps * 100)
+        LOG.debug(_("Updating progress to %(progress)d"), locals(),
                   instance=instance)
+        self._virtapi.instance_update(context, instance['uuid'],
+                                      {'progress': progress})
+
+    def manage_image_cache(self, context, all_instances):
+        """
+        Removes the cached images the instances have stopped using, and the
+        folders of the instances left on the datastores.
+        """
+        self._image_cache.verify_base_images(context, all_instances)
+        self._folder_reaper.sweep_orphans(self._datastore_selector,
+                set(instance['name'] for instance in all_instances))
 
     def _get_datacenter_name_and_ref(self):
         """Get the datacenter name and the reference."""
+        if self._cluster is not None:
+            if self._cluster_datacenter is None:
+                self._cluster_datacenter = self._get_cluster_datacenter()
+            return self._cluster_datacenter
         dc_obj = self._session._call_method(vim_util, "get_objects",
                 "Datacenter", ["name"])
         return dc_obj[0].obj, dc_obj[0].propSet[0].val
 
+    def _get_cluster_res_pool(self):
+        """Get the reference of the resource pool of the cluster."""
+        if self._cluster_res_pool is None:
+            self._cluster_res_pool = self._session._call_method(vim_util,
+                        "get_dynamic_property", self._cluster,
+                        "ClusterComputeResource", "resourcePool")
+        return self._cluster_res_pool
+
+    def _get_cluster_datacenter(self):
+        """
+        Get the reference and name of the datacenter of the cluster, walking
+        up the folders it is in.
+        """
+        parent = self._session._call_method(vim_util, "get_dynamic_property",
+                        self._cluster, "ClusterComputeResource", "parent")
+        while parent._type != "Datacenter":
+            parent = self._session._call_method(vim_util,
+                        "get_dynamic_property", parent, parent._type,
+                        "parent")
+        dc_name = self._session._call_method(vim_util, "get_dynamic_property",
+                        parent, "Datacenter", "name")
+        return parent, dc_name
+
     def _path_exists(self, ds_browser, ds_path):
         """Check if the path exists on the datastore."""
         search_task = self._session._call_method(self._session._get_vim(),
@@ -784,38 +938,68 @@ class VMwareVMOps(object):
                                    datastorePath=ds_path)
         # Wait till the state changes from queued or running.
         # If an error state is returned, it means that the path doesn't exist.
-        while True:
-            task_info = self._session._call_method(vim_util,
-                                       "get_dynamic_property",
-                                       search_task, "Task", "info")
-            if task_info.state in ['queued', 'running']:
-                time.sleep(2)
-                continue
-            break
+        task_info = self._session._wait_for_task_completion(search_task)
         if task_info.state == "error":
             return False
         return True
 
-    def _mkdir(self, ds_path):
+    def _get_vm_ref_from_the_name(self, vm_name):
         """
-        Creates a directory at the path specified. If it is just "NAME",
-        then a directory with this name is created at the topmost level of the
-        DataStore.
+        Get reference to the VM with the name specified. The reference is
+        served from the cache, which is refreshed from the inventory on a
+        miss unless the miss is fresh enough to be trusted.
         """
-        LOG.debug(_("Creating directory with path %s") % ds_path)
-        self._session._call_method(self._session._get_vim(), "MakeDirectory",
-                    self._session._get_vim().get_service_content().fileManager,
-                    name=ds_path, createParentDirectories=False)
-        LOG.debug(_("Created directory with path %s") % ds_path)
+        vm_ref = self._vm_ref_cache.get(vm_name)
+        if vm_ref is None and not self._vm_ref_cache_misses_are_fresh():
+            self._refresh_vm_ref_cache()
+            vm_ref = self._vm_ref_cache.get(vm_name)
+        return vm_ref
 
-    def _get_vm_ref_from_the_name(self, vm_name):
-        """Get reference to the VM with the name specified."""
-        vms = self._session._call_method(vim_util, "get_objects",
-                    "VirtualMachine", ["name"])
-        for vm in vms:
-            if vm.propSet[0].val == vm_name:
-                return vm.obj
-        return None
+    def _vm_ref_cache_misses_are_fresh(self):
+        """
+        Checks if the cache was refreshed recently enough for the VMs
+        missing from it to be taken not to exist.
+        """
+        return (self._vm_ref_cache.refreshed_at is not None and
+                timeutils.utcnow_ts() - self._vm_ref_cache.refreshed_at <
+                CONF.vmwareapi_vm_ref_cache_miss_ttl)
+
+    def _refresh_vm_ref_cache(self):
+        """
+        Refresh the VM name to reference cache from the inventory. The
+        results are merged into the cache, as VMs may be created or
+        unregistered while the VMs are paged through.
+        """
+        cached = dict(self._vm_ref_cache)
+        vm_ref_cache = {}
+        if self._inventory_is_active():
+            for vm_ref, props in self._inventory.get_objects(
+                                                    "VirtualMachine"):
+                vm_ref_cache[props.get("name")] = vm_ref
+        else:
+            for vm in self._session._iter_objects("VirtualMachine",
+                                                  ["name"]):
+                vm_ref_cache[vm.propSet[0].val] = vm.obj
+        # The VMs gone from the host are dropped, unless they were cached
+        # again meanwhile, and the VMs unregistered meanwhile are not added
+        # back.
+        for vm_name, vm_ref in cached.iteritems():
+            if (vm_name not in vm_ref_cache and
+                    self._vm_ref_cache.get(vm_name) is vm_ref):
+                del self._vm_ref_cache[vm_name]
+        for vm_name, vm_ref in vm_ref_cache.iteritems():
+            if vm_name in self._vm_ref_cache or vm_name not in cached:
+                self._vm_ref_cache[vm_name] = vm_ref
+        self._vm_ref_cache.refreshed_at = timeutils.utcnow_ts()
+
+    def _inventory_is_active(self):
+        """Checks if the inventory mirror can serve the queries."""
+        return self._inventory is not None and self._inventory.is_active()
+
+    def _update_inventory(self):
+        """Picks up the changes made by this driver in the inventory mirror."""
+        if self._inventory_is_active():
+            self._inventory.update()
 
     def plug_vifs(self, instance, network_info):
         """Plug VIFs into networks."""
@@ -17,38 +17,89 @@
 """
 Utility functions for Image transfer.
 """
-import StringIO
+from eventlet import greenthread
+from eventlet import queue
 
 from nova import exception
 from nova.image import glance
+from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
 from nova.virt.vmwareapi import io_util
 from nova.virt.vmwareapi import read_write_util
+from nova.virt.vmwareapi import vmdk_util
 
 LOG = logging.getLogger(__name__)
 
+vmware_images_opts = [
+    cfg.IntOpt('vmwareapi_transfer_streams',
+               default=4,
+               help='The number of concurrent HTTP range requests the disk '
+                    'files are read from the datastore with. Ranges whose '
+                    'read fails are read again. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    cfg.IntOpt('vmwareapi_transfer_range_size_mb',
+               default=8,
+               help='The size (MB) of the ranges the disk files are read '
+                    'from the datastore in. '
+                    'Used only if compute_driver is '
+                    'vmwareapi.VMWareESXDriver.'),
+    cfg.BoolOpt('vmwareapi_compress_snapshots',
+                default=False,
+                help='Should the snapshots be uploaded as streamOptimized '
+                     'vmdk images, whose zero blocks are left out and the '
+                     'rest compressed? '
+                     'Used only if compute_driver is '
+                     'vmwareapi.VMWareESXDriver.'),
+    ]
+
+CONF = cfg.CONF
+CONF.register_opts(vmware_images_opts)
+
 QUEUE_BUFFER_SIZE = 10
+STREAM_OPTIMIZED = "streamOptimized"
 
 
 def start_transfer(context, read_file_handle, data_size,
         write_file_handle=None, image_service=None, image_id=None,
-        image_meta=None):
+        image_meta=None, open_range=None, progress_callback=None,
+        stream_optimized=False):
     """Start the data transfer from the reader to the writer.
     Reader writes to the pipe and the writer reads from the pipe. This means
     that the total transfer time boils down to the slower of the read/write
-    and not the addition of the two times."""
+    and not the addition of the two times. If open_range is given, the data
+    is read as concurrent ranges opened by it instead of from the read file
+    handle. The progress callback is called with the bytes transferred and
+    the data size as the transfer goes on. The data size is None if it is not
+    known ahead. If stream_optimized is set, the Glance image is a
+    streamOptimized vmdk, which is written out as flat data of the data
+    size."""
 
     if not image_meta:
         image_meta = {}
 
     # The pipe that acts as an intermediate store of data for reader to write
     # to and writer to grab from.
-    thread_safe_pipe = io_util.ThreadSafePipe(QUEUE_BUFFER_SIZE, data_size)
-    # The read thread. In case of glance it is the instance of the
-    # GlanceFileRead class. The glance client read returns an iterator
-    # and this class wraps that iterator to provide datachunks in calls
-    # to read.
-    read_thread = io_util.IOThread(read_file_handle, thread_safe_pipe)
+    thread_safe_pipe = io_util.ThreadSafePipe(QUEUE_BUFFER_SIZE, data_size,
+                                              progress_callback)
+    # The read thread. In case of VMWare - Glance transfer, it reads from
+    # the VMWare HTTP file read handle.
+    if open_range:
+        read_thread = io_util.RangeReadThread(open_range, thread_safe_pipe,
+                data_size, CONF.vmwareapi_transfer_range_size_mb * 1024 * 1024,
+                max(CONF.vmwareapi_transfer_streams, 1))
+    elif read_file_handle:
+        read_thread = io_util.IOThread(read_file_handle, thread_safe_pipe)
+    # In case of Glance - VMWare transfer, the Glance client writes the image
+    # data chunks straight to the pipe as they are received, so that no more
+    # than the pipe holds is kept in memory.
+    elif image_service and image_id:
+        output = thread_safe_pipe
+        if stream_optimized:
+            output = vmdk_util.StreamOptimizedWriteFile(thread_safe_pipe,
+                                                        data_size)
+        read_thread = io_util.GlanceReadThread(context, output,
+                image_service, image_id)
 
     # In case of Glance - VMWare transfer, we just need a handle to the
     # HTTP Connection that is to send transfer data to the VMWare datastore.
@@ -65,9 +116,19 @@ def start_transfer(context, read_file_handle, data_size,
     read_event = read_thread.start()
     write_event = write_thread.start()
     try:
-        # Wait on the read and write events to signal their end
-        read_event.wait()
+        # Wait on whichever of the read and write events signals its end
+        # first, so that a failure of either side is not left waiting on the
+        # other one, which would be blocked on the pipe.
+        if _wait_for_first(read_event, write_event) is write_event:
+            read_event.wait()
+        if data_size is None:
+            thread_safe_pipe.write_eof()
+        elif stream_optimized and not read_thread.output.done:
+            raise exception.NovaException(_("The streamOptimized vmdk image "
+                                            "ended before its end of stream "
+                                            "marker"))
         write_event.wait()
+        _log_transfer_stats(thread_safe_pipe.get_stats())
     except Exception, exc:
         # In case of any of the reads or writes raising an exception,
         # stop the threads so that we un-necessarily don't keep the other one
@@ -81,21 +142,53 @@ def start_transfer(context, read_file_handle, data_size,
     finally:
         # No matter what, try closing the read and write handles, if it so
         # applies.
-        read_file_handle.close()
+        if read_file_handle:
+            read_file_handle.close()
         if write_file_handle:
             write_file_handle.close()
 
 
+def _wait_for_first(*events):
+    """Wait for the first of the events to be sent and return it, or raise
+    its exception."""
+    sent = queue.LightQueue()
+
+    def _wait(event):
+        try:
+            event.wait()
+            sent.put((event, None))
+        except Exception, exc:
+            sent.put((event, exc))
+
+    waiters = [greenthread.spawn(_wait, event) for event in events]
+    try:
+        event, exc = sent.get()
+    finally:
+        for waiter in waiters:
+            waiter.kill()
+    if exc is not None:
+        raise exc
+    return event
+
+
+def _log_transfer_stats(stats):
+    """Log the statistics of a completed transfer. The time waited on either
+    side tells whether the source or the destination held the transfer up.
+    """
+    LOG.info(_("Transferred %(transferred)d bytes in %(duration).2f seconds "
+               "at %(rate).2f MB/s. Waited %(empty_wait).2f seconds for the "
+               "source and %(full_wait).2f seconds for the destination, with "
+               "%(occupancy).1f of %(maxsize)d chunks in the pipe on "
+               "average") % stats)
+
+
 def fetch_image(context, image, instance, **kwargs):
     """Download image from the glance image server."""
     LOG.debug(_("Downloading image %s from glance image server") % image,
               instance=instance)
     (image_service, image_id) = glance.get_remote_image_service(context, image)
     metadata = image_service.show(context, image_id)
-    file_size = int(metadata['size'])
-    f = StringIO.StringIO()
-    image_service.download(context, image_id, f)
-    read_file_handle = read_write_util.GlanceFileRead(f)
+    file_size = _get_flat_size(metadata)
     write_file_handle = read_write_util.VMwareHTTPWriteFile(
                                 kwargs.get("host"),
                                 kwargs.get("data_center_name"),
@@ -103,24 +196,67 @@ def fetch_image(context, image, instance, **kwargs):
                                 kwargs.get("cookies"),
                                 kwargs.get("file_path"),
                                 file_size)
-    start_transfer(context, read_file_handle, file_size,
-                   write_file_handle=write_file_handle)
+    start_transfer(context, None, file_size,
+                   write_file_handle=write_file_handle,
+                   image_service=image_service, image_id=image_id,
+                   progress_callback=kwargs.get("progress_callback"),
+                   stream_optimized=_is_stream_optimized(metadata))
     LOG.debug(_("Downloaded image %s from glance image server") % image,
               instance=instance)
 
 
+def _is_stream_optimized(image_meta):
+    return (image_meta.get("properties", {}).get("vmware_disktype") ==
+            STREAM_OPTIMIZED)
+
+
+def _get_flat_size(image_meta):
+    """Get the size of the flat vmdk data of the image, which for a
+    streamOptimized image is not the size of the image."""
+    if _is_stream_optimized(image_meta):
+        return int(image_meta["properties"]["vmware_flat_size"])
+    return int(image_meta["size"])
+
+
+def upload_vmdk_descriptor(context, descriptor, instance, **kwargs):
+    """Write the descriptor of a vmdk file to the datastore."""
+    LOG.debug(_("Writing the vmdk descriptor %s to the datastore") %
+              kwargs.get("file_path"), instance=instance)
+    write_file_handle = read_write_util.VMwareHTTPWriteFile(
+                                kwargs.get("host"),
+                                kwargs.get("data_center_name"),
+                                kwargs.get("datastore_name"),
+                                kwargs.get("cookies"),
+                                kwargs.get("file_path"),
+                                len(descriptor))
+    try:
+        write_file_handle.write(descriptor)
+    finally:
+        write_file_handle.close()
+
+
 def upload_image(context, image, instance, **kwargs):
     """Upload the snapshotted vm disk file to Glance image server."""
     LOG.debug(_("Uploading image %s to the Glance image server") % image,
               instance=instance)
-    read_file_handle = read_write_util.VMwareHTTPReadFile(
+
+    def _open_range(offset=0, length=None):
+        return read_write_util.VMwareHTTPReadFile(
                                 kwargs.get("host"),
                                 kwargs.get("data_center_name"),
                                 kwargs.get("datastore_name"),
                                 kwargs.get("cookies"),
-                                kwargs.get("file_path"))
-    file_size = read_file_handle.get_size()
-    (image_service, image_id) = glance.get_remote_image_service(context, image)
+                                kwargs.get("file_path"),
+                                offset=offset, length=length)
+
+    # The first byte is asked for to learn the size of the file, and whether
+    # the host serves ranges of it. If it does not, the whole file comes
+    # back and is read as a single stream.
+    read_file_handle = _open_range(0, 1)
+    file_size = read_file_handle.get_total_size()
+    transfer_size = file_size
+    open_range = None
+    progress_callback = kwargs.get("progress_callback")
     # The properties and other fields that we need to set for the image.
     image_metadata = {"is_public": True,
                       "disk_format": "vmdk",
@@ -131,9 +267,27 @@ def upload_image(context, image, instance, **kwargs):
                                      "vmware_ostype": kwargs.get("os_type"),
                                      "vmware_image_version":
                                             kwargs.get("image_version")}}
-    start_transfer(context, read_file_handle, file_size,
+    if CONF.vmwareapi_compress_snapshots:
+        # The size of the streamOptimized vmdk is known only once it is
+        # written, so the progress of the upload is not reported.
+        read_file_handle.close()
+        read_file_handle = vmdk_util.StreamOptimizedReadFile(_open_range(),
+                                file_size, kwargs.get("adapter_type"))
+        transfer_size = None
+        progress_callback = None
+        image_metadata["properties"].update({
+                "vmware_disktype": STREAM_OPTIMIZED,
+                "vmware_flat_size": file_size})
+    elif read_file_handle.is_range():
+        read_file_handle.close()
+        read_file_handle = None
+        open_range = _open_range
+    (image_service, image_id) = glance.get_remote_image_service(context, image)
+    start_transfer(context, read_file_handle, transfer_size,
                    image_service=image_service,
-                   image_id=image_id, image_meta=image_metadata)
+                   image_id=image_id, image_meta=image_metadata,
+                   open_range=open_range,
+                   progress_callback=progress_callback)
     LOG.debug(_("Uploaded image %s to the Glance image server") % image,
               instance=instance)
 
@@ -149,7 +303,7 @@ def get_vmdk_size_and_properties(context, image, instance):
               instance=instance)
     (image_service, image_id) = glance.get_remote_image_service(context, image)
     meta_data = image_service.show(context, image_id)
-    size, properties = meta_data["size"], meta_data["properties"]
+    size, properties = _get_flat_size(meta_data), meta_data["properties"]
     LOG.debug(_("Got image size of %(size)s for the image %(image)s") %
               locals(), instance=instance)
     return size, properties